@@ -1,14 +1,23 @@
 # app/api/v1/routes_context.py
 
 import json
-from fastapi import APIRouter, Query, Request
+import os
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session as OrmSession
 
 from app.db.session import SessionLocal
-from app.db.models import Message, SummaryS4, SummaryS60
+from app.schemas.context import ContextBatchRequest
+from app.services.context_builder import build_context_pack, build_context_packs, context_etag, latest_turn_id
+from app.services.latest_summaries import get_latest_summaries, invalidate_latest_summaries, latest_summary_ids
 
 router = APIRouter()
 
+# 批量 ContextPack：一次最多多少个 session；每块多少个 session 一起查（也是流式输出的粒度）
+CONTEXT_BATCH_MAX = int(os.getenv("CONTEXT_BATCH_MAX", "5000"))
+CONTEXT_BATCH_CHUNK = int(os.getenv("CONTEXT_BATCH_CHUNK", "200"))
+
 
 def get_db():
     db = SessionLocal()
@@ -18,127 +27,80 @@ def get_db():
         db.close()
 
 
-def _safe_json_loads(s: str):
-    if not s:
-        return None
-    try:
-        return json.loads(s)
-    except Exception:
-        # 如果历史脏数据不是 JSON，就原样返回
-        return s
-
-
-# ----------------------------
-# MCP: gateway_ctx
-# 说明：
-# - 这里不要写 /api/v1 前缀（外面通常已经加了 /api/v1）
-# - GET 用于“我还活着”
-# - POST 用于 tools/list（平台扫描工具时会用到）
-# ----------------------------
-
-    # 平台要工具列表
-    if method == "tools/list":
-        return {
-            "jsonrpc": "2.0",
-            "id": data.get("id", 1),
-            "result": {
-                "tools": [
-                    {
-                        "name": "echo",
-                        "description": "Return the input text as output.",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {"text": {"type": "string"}},
-                            "required": ["text"],
-                        },
-                    }
-                ]
-            },
-        }
-
-    # 其他方法先明确报错（别给 404）
-    return {
-        "jsonrpc": "2.0",
-        "id": data.get("id", 1),
-        "error": {"code": -32601, "message": f"Unsupported method: {method}"},
-    }
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    # 弱比较：W/ 前缀不参与比较
+    return "*" in tags or etag.removeprefix("W/") in {t.removeprefix("W/") for t in tags}
 
 
 @router.get("/sessions/{session_id}/context")
 def get_context(
+    request: Request,
     session_id: str,
     recent: int = Query(16, ge=1, le=200),
+    db: OrmSession = Depends(get_db),
 ):
     """
     统一出口：返回 ContextPack（最新 s4 / s60 + 最近消息）
-    """
-    db: OrmSession = next(get_db())
-
-    # 最新 S4 / S60
-    s4_row = (
-        db.query(SummaryS4)
-        .filter(SummaryS4.session_id == session_id)
-        .order_by(SummaryS4.to_turn.desc())
-        .first()
-    )
-    s60_row = (
-        db.query(SummaryS60)
-        .filter(SummaryS60.session_id == session_id)
-        .order_by(SummaryS60.to_turn.desc())
-        .first()
-    )
-
-    # 最近 N 条消息（按 turn_id）
-    msgs = (
-        db.query(Message)
-        .filter(Message.session_id == session_id)
-        .order_by(Message.turn_id.desc())
-        .limit(recent)
-        .all()
-    )
-    msgs = list(reversed(msgs))
-
-    latest = (
-        db.query(Message)
-        .filter(Message.session_id == session_id)
-        .order_by(Message.turn_id.desc())
-        .first()
-    )
-
-    out = {
-        "session_id": session_id,
-        "s4": None,
-        "s60": None,
-        "recent": [
-            {
-                "role": m.role,
-                "turn_id": m.turn_id,
-                "user_turn": m.user_turn,
-                "content": m.content,
-            }
-            for m in msgs
-        ],
-        "meta": {
-            "latest_turn_id": latest.turn_id if latest else None,
-            "latest_user_turn": latest.user_turn if latest else None,
-        },
-    }
-
-    if s4_row:
-        out["s4"] = {
-            "range": [s4_row.from_turn, s4_row.to_turn],
-            "summary": _safe_json_loads(s4_row.summary_json),
-            "created_at": s4_row.created_at.isoformat() if s4_row.created_at else None,
-            "model": s4_row.model,
-        }
-
-    if s60_row:
-        out["s60"] = {
-            "range": [s60_row.from_turn, s60_row.to_turn],
-            "summary": _safe_json_loads(s60_row.summary_json),
-            "created_at": s60_row.created_at.isoformat() if s60_row.created_at else None,
-            "model": s60_row.model,
-        }
-
-    return out
 
+    带 ETag：(最新 turn_id, 最新摘要 id, recent)。客户端带 If-None-Match 轮询时，
+    没有新消息、新摘要就直接 304（三次只取 id 的索引查找，不走摘要缓存），不读消息正文。
+    """
+    last_turn_id = latest_turn_id(db, session_id)
+    summary_ids = latest_summary_ids(db, session_id)
+    etag = context_etag(session_id, recent, last_turn_id=last_turn_id, summary_ids=summary_ids)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+
+    # 本进程的摘要缓存比库旧（别的 worker 刚写的）：先丢掉，别把旧摘要配上新 ETag
+    cached = get_latest_summaries(db, session_id)
+    if (cached.s4_id, cached.s60_id) != summary_ids:
+        invalidate_latest_summaries(session_id, broadcast=False)
+
+    pack = build_context_pack(db, session_id, recent=recent)
+    # 两次查询之间来了新消息：按 pack 实际内容重新算，别把旧 ETag 配上新内容
+    if pack["meta"]["latest_turn_id"] != last_turn_id:
+        headers["ETag"] = context_etag(
+            session_id, recent, last_turn_id=pack["meta"]["latest_turn_id"], summary_ids=summary_ids
+        )
+    return JSONResponse(content=pack, headers=headers)
+
+
+@router.post("/sessions/context/batch")
+def get_context_batch(
+    body: ContextBatchRequest,
+    request: Request,
+    db: OrmSession = Depends(get_db),
+):
+    """
+    多个 session 的 ContextPack（面板 / proactive decider 用，代替 N 次 /sessions/{id}/context）。
+    每块 CONTEXT_BATCH_CHUNK 个 session 走一组分组查询。
+    Accept: application/x-ndjson 时按块流式输出，一行一个 pack；否则返回 {"items": [...]}。
+    """
+    ids = list(dict.fromkeys(body.session_ids))
+    if not 1 <= body.recent <= 200:
+        raise HTTPException(status_code=422, detail="recent must be in [1, 200]")
+    if len(ids) > CONTEXT_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"too many session_ids (max {CONTEXT_BATCH_MAX})")
+    chunks = [ids[i:i + CONTEXT_BATCH_CHUNK] for i in range(0, len(ids), CONTEXT_BATCH_CHUNK)]
+
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        def _stream():
+            # 流式响应在依赖清理之后还在跑：自己开、自己关
+            own = SessionLocal()
+            try:
+                for chunk in chunks:
+                    for pack in build_context_packs(own, chunk, recent=body.recent):
+                        yield json.dumps(pack, ensure_ascii=False) + "\n"
+            finally:
+                own.close()
+
+        return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+    items = []
+    for chunk in chunks:
+        items.extend(build_context_packs(db, chunk, recent=body.recent))
+    return JSONResponse(content={"items": items})
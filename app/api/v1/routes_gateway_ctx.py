@@ -10,6 +10,9 @@ import httpx
 from fastapi import APIRouter, Request, Response
 from fastapi.responses import JSONResponse
 
+from app.core.tracing import SpanKind, has_active_span, inject_headers, start_span
+from app.services.metrics import record_gateway_ctx_cache, record_stage
+
 router = APIRouter()
 JSON_UTF8 = "application/json; charset=utf-8"
 
@@ -584,10 +587,12 @@ async def _call_dify_anchor(keyword: str, user: str = "mcp") -> Dict[str, Any]:
     if DIFY_WORKFLOW_ID_ANCHOR:
         payload["workflow_id"] = DIFY_WORKFLOW_ID_ANCHOR
 
-    async with httpx.AsyncClient(timeout=DIFY_TIMEOUT_SECS) as client:
-        r = await client.post(url, headers=headers, json=payload)
-        r.raise_for_status()
-        return r.json()
+    with start_span("dify.workflow_run", kind=SpanKind.CLIENT, attributes={"dify.keyword": keyword}) as span:
+        async with httpx.AsyncClient(timeout=DIFY_TIMEOUT_SECS) as client:
+            r = await client.post(url, headers=inject_headers(headers), json=payload)
+            span.set_attribute("http.status_code", r.status_code)
+            r.raise_for_status()
+            return r.json()
 
 
 def _extract_outputs(dify_resp: Dict[str, Any]) -> Dict[str, Any]:
@@ -610,6 +615,18 @@ def _extract_outputs(dify_resp: Dict[str, Any]) -> Dict[str, Any]:
 
 
 async def _handle_jsonrpc(request: Request, msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    method = str(msg.get("method", "") or "")
+    params = (msg.get("params", {}) or {}) if isinstance(msg, dict) else {}
+    # HTTP 进来时 middleware 已经从 traceparent 续上；只有没有 active span 时才读 params._meta
+    meta = params.get("_meta") if isinstance(params, dict) else None
+    carrier = meta if (isinstance(meta, dict) and not has_active_span()) else None
+    attrs = {"mcp.method": method, "mcp.tool": params.get("name") if isinstance(params, dict) else None}
+    kind = SpanKind.SERVER if carrier else SpanKind.INTERNAL
+    with start_span(f"mcp.{method or 'unknown'}", kind=kind, carrier=carrier, attributes=attrs):
+        return await _dispatch_jsonrpc(request, msg)
+
+
+async def _dispatch_jsonrpc(request: Request, msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     _id = msg.get("id", None)
     method = msg.get("method", "")
     params = (msg.get("params", {}) or {}) if isinstance(msg, dict) else {}
@@ -700,7 +717,9 @@ async def _handle_jsonrpc(request: Request, msg: Dict[str, Any]) -> Optional[Dic
     if hit:
         cache_miss_reason = "expired" if (now - hit[0] > CACHE_TTL_SECS) else "bypassed"
 
-    if hit and (now - hit[0] <= CACHE_TTL_SECS):
+    cache_hit = bool(hit and (now - hit[0] <= CACHE_TTL_SECS))
+    record_gateway_ctx_cache(cache_hit)
+    if cache_hit:
         ctx, res_obj = hit[1], hit[2]
         evidence_cached = res_obj.get("evidence") if isinstance(res_obj, dict) else []
         debug = _debug_fields(
@@ -721,6 +740,7 @@ async def _handle_jsonrpc(request: Request, msg: Dict[str, Any]) -> Optional[Dic
         t1 = time.perf_counter()
         dify = await _call_dify_anchor(keyword=keyword, user=user)
         ms_dify = (time.perf_counter() - t1) * 1000
+        record_stage("mcp.gateway_ctx", "dify", ms_dify)
 
         outs = _extract_outputs(dify)
         picked = (outs.get("result") or "").strip() or (outs.get("chat_text") or "").strip()
@@ -743,6 +763,7 @@ async def _handle_jsonrpc(request: Request, msg: Dict[str, Any]) -> Optional[Dic
                 t2 = time.perf_counter()
                 dify2 = await _call_dify_anchor(keyword=fallback_keyword, user=user)
                 ms_dify2 = (time.perf_counter() - t2) * 1000
+                record_stage("mcp.gateway_ctx", "dify_fallback", ms_dify2)
                 outs2 = _extract_outputs(dify2)
                 picked2 = (outs2.get("result") or "").strip() or (outs2.get("chat_text") or "").strip()
                 ctx2 = _truncate_ctx(picked2)
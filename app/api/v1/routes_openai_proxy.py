@@ -4,6 +4,7 @@ import os
 import json
 import uuid
 import re
+import time
 import base64
 from datetime import datetime
 from typing import Any, Dict, List, Optional, AsyncGenerator, Tuple
@@ -11,12 +12,17 @@ from typing import Any, Dict, List, Optional, AsyncGenerator, Tuple
 import httpx
 from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
 from sqlalchemy.orm import Session as OrmSession
 
 from app.db.session import SessionLocal
-from app.db.models import SummaryS4, SummaryS60
+from app.core.tracing import SpanKind, inject_headers, start_span
 from app.services.chat_service import append_user_and_assistant
+from app.services.latest_summaries import get_latest_summaries
+from app.services.metrics import StageTimings, upstream_label
+from app.services.token_budget import apply_token_budget, build_trimmed_history_note, estimate_tokens
+from app.services.upstream_limiter import UpstreamLimiterError, UpstreamPermit, acquire_upstream
 
 router = APIRouter()
 
@@ -49,14 +55,6 @@ def get_db() -> OrmSession:
 # -----------------------------
 # Utils
 # -----------------------------
-def _safe_json_loads(s: str):
-    if not s:
-        return None
-    try:
-        return json.loads(s)
-    except Exception:
-        return s
-
 def _generate_thread_id() -> str:
     ts = datetime.utcnow().strftime("%Y%m%d%H%M")
     return f"rk:th:{ts}:{uuid.uuid4().hex[:12]}"
@@ -124,36 +122,6 @@ def _compact_summary_block(s4: Optional[Dict[str, Any]], s60: Optional[Dict[str,
         + "\n【End】"
     )
 
-def _fetch_latest_summaries(db: OrmSession, session_id: str) -> Dict[str, Any]:
-    s4_row = (
-        db.query(SummaryS4)
-        .filter(SummaryS4.session_id == session_id)
-        .order_by(SummaryS4.to_turn.desc())
-        .first()
-    )
-    s60_row = (
-        db.query(SummaryS60)
-        .filter(SummaryS60.session_id == session_id)
-        .order_by(SummaryS60.to_turn.desc())
-        .first()
-    )
-    out = {"s4": None, "s60": None}
-    if s4_row:
-        out["s4"] = {
-            "range": [s4_row.from_turn, s4_row.to_turn],
-            "summary": _safe_json_loads(s4_row.summary_json),
-            "created_at": s4_row.created_at.isoformat() if s4_row.created_at else None,
-            "model": s4_row.model,
-        }
-    if s60_row:
-        out["s60"] = {
-            "range": [s60_row.from_turn, s60_row.to_turn],
-            "summary": _safe_json_loads(s60_row.summary_json),
-            "created_at": s60_row.created_at.isoformat() if s60_row.created_at else None,
-            "model": s60_row.model,
-        }
-    return out
-
 def _inject_system(messages: List[Dict[str, Any]], system_blocks: List[str]) -> List[Dict[str, Any]]:
     blocks = [b for b in (system_blocks or []) if b and b.strip()]
     if not blocks:
@@ -211,6 +179,22 @@ def _build_debug_headers(user_text: str, kw: str) -> Dict[str, str]:
         "X-Debug-Keyword-B64": keyword_b64,
     }
 
+async def _release_on_loop(permit: UpstreamPermit) -> None:
+    # 必须是 async：同步的 background 会被 Starlette 丢进线程池，
+    # 而 limiter 的状态和等待者的 future 只能在事件循环线程里动
+    permit.release()
+
+
+def _build_limiter_headers(permit: Optional[UpstreamPermit]) -> Dict[str, str]:
+    if permit is None:
+        return {}
+    snap = permit.limiter.snapshot()
+    return {
+        "X-Upstream-Queue-Ms": f"{permit.queued_ms:.1f}",
+        "X-Upstream-Limit": str(snap["limit"]),
+        "X-Upstream-Inflight": str(snap["inflight"]),
+    }
+
 def _parse_stream_flag(body: Dict[str, Any]) -> bool:
     sv = body.get("stream", False)
     if sv is True:
@@ -376,16 +360,18 @@ async def _call_local_gateway_ctx(
                 "text": text,
                 "user": user,
                 "summaries": summaries or {},
-            }
+            },
+            # MCP 约定的元数据位：非 HTTP 传输时也能续上 trace
+            "_meta": inject_headers(),
         }
     }
 
-    headers = {
+    headers = inject_headers({
         "Content-Type": "application/json",
         "ngrok-skip-browser-warning": "1",
         # 让本机 gateway_ctx 按你现在兼容的版本返回
         "MCP-Protocol-Version": os.getenv("MCP_PROTOCOL_VERSION", "2025-06-18"),
-    }
+    })
 
     async with httpx.AsyncClient(timeout=LOCAL_MCP_TIMEOUT) as client:
         r = await client.post(LOCAL_MCP_GATEWAY_URL, headers=headers, json=payload)
@@ -482,70 +468,98 @@ async def _proxy_stream_and_store(
     session_id: str,
     user_text: str,
     model_name: str,
+    permit: Optional[UpstreamPermit] = None,
+    timings: Optional[StageTimings] = None,
 ) -> AsyncGenerator[bytes, None]:
     full_parts: List[str] = []
     done = False
+    upstream_status: Optional[int] = None
+    upstream_retry_after: Optional[str] = None
+    t_upstream = time.perf_counter()
+    t_first: Optional[float] = None
 
-    async with httpx.AsyncClient(timeout=None) as client:
-        async with client.stream("POST", upstream_url, headers=headers, json=body) as r:
-            if r.status_code >= 400:
-                raw = await r.aread()
-                try:
-                    j = json.loads(raw.decode("utf-8", errors="ignore") or "{}")
-                    msg = j.get("error", {}).get("message") or j.get("message") or raw.decode("utf-8", errors="ignore")
-                except Exception:
-                    msg = raw.decode("utf-8", errors="ignore")
-                err = {"error": {"message": msg, "type": "upstream_error", "status": r.status_code}}
-                yield f"data: {json.dumps(err, ensure_ascii=False)}\n\n".encode("utf-8")
-                yield b"data: [DONE]\n\n"
-                return
-
-            async for line in r.aiter_lines():
-                if line is None:
-                    continue
-                if line == "":
-                    yield b"\n"
-                    continue
-
-                yield (line + "\n").encode("utf-8")
-
-                if not line.startswith("data:"):
-                    continue
-                data = line[len("data:"):].strip()
-                if data == "[DONE]":
-                    done = True
-                    break
-
-                try:
-                    j = json.loads(data)
-                    delta = (j.get("choices") or [{}])[0].get("delta", {})
-                    piece = delta.get("content")
-                    if piece:
-                        full_parts.append(piece)
-                except Exception:
-                    continue
-
-    full_text = "".join(full_parts).strip()
-
-    if full_text:
-        db2 = get_db()
+    try:
         try:
-            append_user_and_assistant(
-                db2,
-                session_id=session_id,
-                user_text=user_text,
-                assistant_text=full_text,
-                model_name=model_name,
-                s4_every_user_turns=int(os.getenv("S4_EVERY_USER_TURNS", "4")),
-                s60_every_user_turns=int(os.getenv("S60_EVERY_USER_TURNS", "30")),
-                s4_window_user_turns=int(os.getenv("S4_WINDOW_USER_TURNS", "4")),
-                s60_window_user_turns=int(os.getenv("S60_WINDOW_USER_TURNS", "30")),
-            )
+            with start_span("upstream.chat_completions", kind=SpanKind.CLIENT, attributes={
+                "http.url": upstream_url, "llm.model": model_name, "llm.stream": True,
+            }) as span:
+                async with httpx.AsyncClient(timeout=None) as client:
+                    async with client.stream("POST", upstream_url, headers=inject_headers(headers), json=body) as r:
+                        t_first = time.perf_counter()
+                        upstream_status = r.status_code
+                        upstream_retry_after = r.headers.get("retry-after")
+                        span.set_attribute("http.status_code", r.status_code)
+                        if r.status_code >= 400:
+                            raw = await r.aread()
+                            try:
+                                j = json.loads(raw.decode("utf-8", errors="ignore") or "{}")
+                                msg = j.get("error", {}).get("message") or j.get("message") or raw.decode("utf-8", errors="ignore")
+                            except Exception:
+                                msg = raw.decode("utf-8", errors="ignore")
+                            err = {"error": {"message": msg, "type": "upstream_error", "status": r.status_code}}
+                            yield f"data: {json.dumps(err, ensure_ascii=False)}\n\n".encode("utf-8")
+                            yield b"data: [DONE]\n\n"
+                            return
+
+                        async for line in r.aiter_lines():
+                            if line is None:
+                                continue
+                            if line == "":
+                                yield b"\n"
+                                continue
+
+                            yield (line + "\n").encode("utf-8")
+
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[len("data:"):].strip()
+                            if data == "[DONE]":
+                                done = True
+                                break
+
+                            try:
+                                j = json.loads(data)
+                                delta = (j.get("choices") or [{}])[0].get("delta", {})
+                                piece = delta.get("content")
+                                if piece:
+                                    full_parts.append(piece)
+                            except Exception:
+                                continue
         finally:
-            db2.close()
-
-    if not done:
-        yield b"\ndata: [DONE]\n\n"
+            # 整条流结束才归还并发名额（流式占用的是上游的整段生成时间）
+            if permit is not None:
+                permit.release(upstream_status, upstream_retry_after)
+            if timings is not None and t_first is not None:
+                timings.add("upstream_ttfb", (t_first - t_upstream) * 1000)
+                timings.add("stream", (time.perf_counter() - t_first) * 1000)
+
+        full_text = "".join(full_parts).strip()
+
+        if full_text:
+            db2 = get_db()
+            try:
+                result = append_user_and_assistant(
+                    db2,
+                    session_id=session_id,
+                    user_text=user_text,
+                    assistant_text=full_text,
+                    model_name=model_name,
+                    s4_every_user_turns=int(os.getenv("S4_EVERY_USER_TURNS", "4")),
+                    s60_every_user_turns=int(os.getenv("S60_EVERY_USER_TURNS", "30")),
+                    s4_window_user_turns=int(os.getenv("S4_WINDOW_USER_TURNS", "4")),
+                    s60_window_user_turns=int(os.getenv("S60_WINDOW_USER_TURNS", "30")),
+                )
+            finally:
+                db2.close()
+            if timings is not None:
+                timings.add_many(result.timings)
+
+        if not done:
+            yield b"\ndata: [DONE]\n\n"
+    finally:
+        # 流式响应头早已发出，流结束后的阶段只进 metrics
+        if timings is not None:
+            timings.observe()
 
 # -----------------------------
 # Main route: OpenAI compatible
@@ -560,6 +574,14 @@ async def chat_completions(request: Request):
     s4_scope = identity["s4_scope"]
     session_id = thread_id
 
+    upstream_base = os.getenv("UPSTREAM_BASE_URL", "https://openrouter.ai/api/v1")
+    upstream_url = _build_upstream_url(upstream_base)
+    timings = StageTimings(
+        "openai_proxy.chat_completions",
+        model=str(payload.get("model") or "unknown"),
+        upstream=upstream_label(upstream_url),
+    )
+
     messages = payload.get("messages") or []
     if not isinstance(messages, list):
         return JSONResponse({"error": {"message": "messages must be a list"}}, status_code=400)
@@ -572,28 +594,31 @@ async def chat_completions(request: Request):
     user_text = _last_user_text(messages)
 
     # summaries
-    db = get_db()
-    try:
-        sums = _fetch_latest_summaries(db, session_id=session_id)
-    finally:
-        db.close()
+    with timings.stage("db_read"):
+        db = get_db()
+        try:
+            latest = get_latest_summaries(db, session_id)
+        finally:
+            db.close()
 
-    s_block = _compact_summary_block(sums.get("s4"), sums.get("s60"))
+    s_block = latest.block("proxy_compact", _compact_summary_block)
 
     # ✅ 统一入口：每轮强制走本机 MCP gateway_ctx，proxy 不再直连 Dify
     anchor_block = ""
     kw = ""
     if ANCHOR_INJECT_ENABLED and FORCE_GATEWAY_EVERY_TURN:
-        kw = _extract_keywords(user_text, k=2)
+        with timings.stage("keyword"):
+            kw = _extract_keywords(user_text, k=2)
         # 使用稳定的会话标识，避免每次请求的 user 变化
         metadata = payload.get("metadata", {})
         stable_user = (metadata.get("gateway_user") or payload.get("user") or GATEWAY_CTX_USER)
-        ctx = await _call_local_gateway_ctx(
-            keyword=kw,
-            text=user_text,
-            user=stable_user,
-            summaries={"s4": sums.get("s4"), "s60": sums.get("s60")},
-        )
+        with timings.stage("gateway_ctx"):
+            ctx = await _call_local_gateway_ctx(
+                keyword=kw,
+                text=user_text,
+                user=stable_user,
+                summaries={"s4": latest.s4, "s60": latest.s60},
+            )
         anchor_block = _build_anchor_system_block(ctx)
 
     system_blocks = []
@@ -604,22 +629,53 @@ async def chat_completions(request: Request):
     writer_mode = _resolve_writer_mode(payload)
     system_blocks.append(_build_writer_constraint_block(writer_mode))
 
+    # token budget：超出预算的最旧历史由上面注入的 S4/S60 代替
+    with timings.stage("budget"):
+        messages, budget_report = apply_token_budget(
+            messages,
+            model=str(payload.get("model") or ""),
+            system_tokens=estimate_tokens("\n\n".join(system_blocks)),
+            max_output_tokens=payload.get("max_completion_tokens") or payload.get("max_tokens"),
+        )
+        trimmed_note = build_trimmed_history_note(budget_report, has_summary=bool(s_block))
+        if trimmed_note:
+            system_blocks.insert(1 if s_block else 0, trimmed_note)
+    budget_headers = budget_report.headers()
+
     messages2 = _inject_system(messages, system_blocks)
 
-    upstream_base = os.getenv("UPSTREAM_BASE_URL", "https://openrouter.ai/api/v1")
     try:
         headers = _build_upstream_headers()
     except RuntimeError as e:
         return JSONResponse({"error": {"message": str(e)}}, status_code=500)
 
-    upstream_url = _build_upstream_url(upstream_base)
-
     body = dict(payload)
     body["messages"] = messages2
 
     stream = _parse_stream_flag(body)
     model_name = str(body.get("model") or "unknown")
 
+    # 上游并发准入（AIMD）：排队失败直接回 429，不把压力转嫁给上游
+    try:
+        permit = await acquire_upstream(upstream_url, headers.get("Authorization", ""), thread_id)
+    except UpstreamLimiterError as e:
+        resp = JSONResponse(
+            {"error": {"message": "gateway upstream queue is saturated, retry later", "type": e.reason}},
+            status_code=429,
+        )
+        resp.headers["retry-after"] = str(int(e.retry_after + 0.999))
+        resp.headers["x-upstream-url"] = upstream_url
+        resp.headers["x-thread-id"] = thread_id
+        resp.headers["x-session-id"] = session_id
+        for k, v in budget_headers.items():
+            resp.headers[k] = v
+        resp.headers["server-timing"] = timings.server_timing()
+        timings.observe()
+        return resp
+    limiter_headers = _build_limiter_headers(permit)
+    if permit is not None:
+        timings.add("queue", permit.queued_ms)
+
     # 给你加个可观测：返回上游地址
     if stream:
         debug_headers = _build_debug_headers(user_text, kw if ANCHOR_INJECT_ENABLED and FORCE_GATEWAY_EVERY_TURN else "")
@@ -631,6 +687,8 @@ async def chat_completions(request: Request):
                 session_id=session_id,
                 user_text=user_text,
                 model_name=model_name,
+                permit=permit,
+                timings=timings,
             ),
             media_type="text/event-stream",
             headers={
@@ -643,29 +701,54 @@ async def chat_completions(request: Request):
                 "X-Agent-Id": agent_id,
                 "X-S4-Scope": s4_scope,
                 "X-Session-Id": session_id,
+                "Server-Timing": timings.server_timing(),
+                **limiter_headers,
+                **budget_headers,
                 **debug_headers,
             },
+            # 兜底：generator 没被迭代（客户端提前断开）时也要归还名额；release 是幂等的
+            background=BackgroundTask(_release_on_loop, permit) if permit is not None else None,
         )
 
-    async with httpx.AsyncClient(timeout=None) as client:
-        r = await client.post(upstream_url, headers=headers, json=body)
-        if r.status_code >= 400:
-            ct = r.headers.get("content-type", "")
-            if ct.startswith("application/json"):
-                resp = JSONResponse(r.json(), status_code=r.status_code)
-            else:
-                resp = JSONResponse({"error": {"message": r.text}}, status_code=r.status_code)
-            resp.headers["x-upstream-url"] = upstream_url
-            resp.headers["x-thread-id"] = thread_id
-            resp.headers["x-memory-id"] = memory_id
-            resp.headers["x-agent-id"] = agent_id
-            resp.headers["x-s4-scope"] = s4_scope
-            resp.headers["x-session-id"] = session_id
-            for k, v in _build_debug_headers(user_text, kw if ANCHOR_INJECT_ENABLED and FORCE_GATEWAY_EVERY_TURN else "").items():
-                resp.headers[k] = v
-            return resp
-
-        data = r.json()
+    upstream_status: Optional[int] = None
+    upstream_retry_after: Optional[str] = None
+    try:
+        with timings.stage("upstream"):
+            async with httpx.AsyncClient(timeout=None) as client:
+                r = await client.post(upstream_url, headers=inject_headers(headers), json=body)
+                upstream_status = r.status_code
+                upstream_retry_after = r.headers.get("retry-after")
+    except Exception:
+        # 连接失败 / 超时也要进阶段直方图（upstream 阶段已由 stage() 记下耗时），再往上抛
+        timings.observe()
+        raise
+    finally:
+        if permit is not None:
+            permit.release(upstream_status, upstream_retry_after)
+
+    if r.status_code >= 400:
+        ct = r.headers.get("content-type", "")
+        if ct.startswith("application/json"):
+            resp = JSONResponse(r.json(), status_code=r.status_code)
+        else:
+            resp = JSONResponse({"error": {"message": r.text}}, status_code=r.status_code)
+        resp.headers["x-upstream-url"] = upstream_url
+        resp.headers["x-thread-id"] = thread_id
+        resp.headers["x-memory-id"] = memory_id
+        resp.headers["x-agent-id"] = agent_id
+        resp.headers["x-s4-scope"] = s4_scope
+        resp.headers["x-session-id"] = session_id
+        for k, v in limiter_headers.items():
+            resp.headers[k] = v
+        for k, v in budget_headers.items():
+            resp.headers[k] = v
+        resp.headers["server-timing"] = timings.server_timing()
+        timings.observe()
+        for k, v in _build_debug_headers(user_text, kw if ANCHOR_INJECT_ENABLED and FORCE_GATEWAY_EVERY_TURN else "").items():
+            resp.headers[k] = v
+        return resp
+
+    data = r.json()
 
     data = _apply_tool_empty_content_compat(data)
 
@@ -678,7 +761,7 @@ async def chat_completions(request: Request):
     if assistant_text:
         db2 = get_db()
         try:
-            append_user_and_assistant(
+            result = append_user_and_assistant(
                 db2,
                 session_id=session_id,
                 user_text=user_text,
@@ -691,6 +774,7 @@ async def chat_completions(request: Request):
             )
         finally:
             db2.close()
+        timings.add_many(result.timings)
 
     resp = JSONResponse(data)
     resp.headers["x-upstream-url"] = upstream_url
@@ -699,6 +783,12 @@ async def chat_completions(request: Request):
     resp.headers["x-agent-id"] = agent_id
     resp.headers["x-s4-scope"] = s4_scope
     resp.headers["x-session-id"] = session_id
+    for k, v in limiter_headers.items():
+        resp.headers[k] = v
+    for k, v in budget_headers.items():
+        resp.headers[k] = v
+    resp.headers["server-timing"] = timings.server_timing()
+    timings.observe()
     for k, v in _build_debug_headers(user_text, kw if ANCHOR_INJECT_ENABLED and FORCE_GATEWAY_EVERY_TURN else "").items():
         resp.headers[k] = v
     return resp
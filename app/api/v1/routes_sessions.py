@@ -1,11 +1,12 @@
 import json
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session as OrmSession
 from app.db.session import SessionLocal
 from app.db.models import SummaryS4, SummaryS60
 from app.db.models import Session as ChatSession
-from app.services.summarizer import get_recent_debug_events
+from app.services.debug_events import DEBUG_EVENTS_BACKEND, read_debug_events
+from app.services.chat_service import scoped_token_total, scoped_tokens_by_user_turn
 
 router = APIRouter()
 
@@ -45,11 +46,42 @@ def get_summaries(session_id: str, db: OrmSession = Depends(get_db)):
 
 
 @router.get("/sessions/{session_id}/summaries/debug")
-def get_summaries_debug(session_id: str, limit: int = 80):
+def get_summaries_debug(session_id: str, limit: int = 80, cursor: str | None = None):
+    """最近的摘要调试事件；翻更旧的一页时把上次返回的 next_cursor 传回来。"""
+    try:
+        events, next_cursor = read_debug_events(session_id, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(
+        content={
+            "session_id": session_id,
+            "backend": DEBUG_EVENTS_BACKEND,
+            "events": events,
+            "next_cursor": next_cursor,
+        },
+        media_type="application/json; charset=utf-8",
+    )
+
+@router.get("/sessions/{session_id}/tokens")
+def get_scope_tokens(
+    session_id: str,
+    scope: str = "thread",
+    thread_id: str | None = None,
+    memory_id: str | None = None,
+    agent_id: str | None = None,
+    last_user_turns: int = 30,
+    db: OrmSession = Depends(get_db),
+):
+    """按 scope 的累计 token（来自 content_tokens），给摘要窗口 / 上下文裁剪做决策。"""
+    scope_type = scope if scope in ("thread", "memory") else "thread"
+    kw = dict(session_id=session_id, scope_type=scope_type, thread_id=thread_id, memory_id=memory_id, agent_id=agent_id)
+    per_turn = scoped_tokens_by_user_turn(db, last_user_turns=last_user_turns, **kw)
     return JSONResponse(
         content={
             "session_id": session_id,
-            "events": get_recent_debug_events(session_id=session_id, limit=limit),
+            "scope": scope_type,
+            "total_tokens": scoped_token_total(db, **kw),
+            "user_turns": [{"user_turn": ut, "tokens": t, "cumulative_tokens": c} for ut, t, c in per_turn],
         },
         media_type="application/json; charset=utf-8",
     )
@@ -1,7 +1,10 @@
 import os
 from dotenv import load_dotenv
 from celery import Celery
+from celery.signals import beat_init, worker_init, worker_process_init
 from app.core.config import CELERY_BROKER_URL, CELERY_RESULT_BACKEND
+from app.core.config import SILENCE_DISPATCH_SECS, SILENCE_SCAN_SECS, SILENCE_SCHEDULER_BACKEND
+from app.core.tracing import setup_celery_tracing
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"), override=True)
 
@@ -23,12 +26,44 @@ celery.conf.update(
     beat_schedule={
         "scan-triggers-every-60-seconds": {
             "task": "app.tasks.scan_triggers",
-            "schedule": 60.0,
+            "schedule": SILENCE_SCAN_SECS,
       },
         "process-trigger-jobs-every-30-seconds": {
             "task": "app.tasks.process_trigger_jobs",
             "schedule": 30.0,
-      }
+      },
+        "reconcile-summary-jobs-every-60-seconds": {
+            "task": "app.tasks.reconcile_summary_jobs",
+            "schedule": 60.0,
+      },
+        # 沉默触发：redis 调度时按到期时间派发，上面的全量扫描降频成对账（SILENCE_SCAN_SECS）
+        **({
+            "dispatch-silence-triggers": {
+                "task": "app.tasks.dispatch_silence_triggers",
+                "schedule": SILENCE_DISPATCH_SECS,
+            }
+        } if SILENCE_SCHEDULER_BACKEND == "redis" else {}),
 
     }
 )
+
+# trace context 走 Celery message header（publish 注入，worker prerun 续上）
+setup_celery_tracing("gateway-worker")
+
+# 数据库连接池按进程角色配置（DB_ROLE 显式设置时以它为准）
+@worker_init.connect
+def _db_worker_init(**_):
+    from app.db.session import configure_engine
+    configure_engine("worker")
+
+
+@worker_process_init.connect
+def _db_worker_process_init(**_):
+    from app.db.session import reset_engine_after_fork
+    reset_engine_after_fork()
+
+
+@beat_init.connect
+def _db_beat_init(**_):
+    from app.db.session import configure_engine
+    configure_engine("beat")
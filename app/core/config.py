@@ -7,3 +7,8 @@ def env(key: str, default: str = "") -> str:
 REDIS_URL = env("REDIS_URL", "redis://redis:6379/0")
 CELERY_BROKER_URL = env("CELERY_BROKER_URL", REDIS_URL)
 CELERY_RESULT_BACKEND = env("CELERY_RESULT_BACKEND", "redis://redis:6379/1")
+
+# 沉默触发调度（见 app/services/silence_scheduler.py；celery_app 的 beat 定时也读这里）
+SILENCE_SCHEDULER_BACKEND = env("SILENCE_SCHEDULER_BACKEND", "none").strip().lower()
+SILENCE_DISPATCH_SECS = float(env("SILENCE_DISPATCH_SECS", "10"))
+SILENCE_SCAN_SECS = float(env("SILENCE_SCAN_SECS", "900" if SILENCE_SCHEDULER_BACKEND == "redis" else "60"))
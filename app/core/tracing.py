@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import functools
+import os
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional, Sequence
+
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+from opentelemetry.propagate import extract, inject
+from opentelemetry.trace import Link, SpanKind, Status, StatusCode
+
+# -----------------------------
+# 端到端 tracing（OpenTelemetry）
+#
+# proxy -> loopback gateway_ctx(JSON-RPC) -> Dify -> upstream -> chat_once -> run_s4/run_s60 -> summarizer LLM
+# 以及 Celery 任务：trace context 通过 HTTP header / MCP params._meta / Celery message header 传递。
+#
+# TRACE_EXPORTER:
+#   none（默认，API 走 no-op，几乎零开销）
+#   file    -> 追加写 JSONL 到 TRACE_FILE（默认 ./traces.jsonl）
+#   otlp    -> OTLP/HTTP collector（需要 opentelemetry-exporter-otlp-proto-http，endpoint 读 OTEL_EXPORTER_OTLP_ENDPOINT）
+#   console -> stdout
+# -----------------------------
+
+TRACE_EXPORTER = (os.getenv("TRACE_EXPORTER", "none") or "none").strip().lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "./traces.jsonl").strip() or "./traces.jsonl"
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+
+tracer = trace.get_tracer("gateway")
+_initialized = False
+
+
+def init_tracing(service_name: str) -> None:
+    """每个进程调一次（web 启动 / celery worker_process_init）；重复调用无副作用。"""
+    global _initialized
+    if _initialized or TRACE_EXPORTER in ("", "none", "off", "0"):
+        return
+    _initialized = True
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": service_name}),
+        sampler=ParentBased(TraceIdRatioBased(TRACE_SAMPLE_RATIO)),
+    )
+
+    if TRACE_EXPORTER == "file":
+        out = open(TRACE_FILE, "a", encoding="utf-8")
+        exporter = ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+    elif TRACE_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        exporter = OTLPSpanExporter()
+    else:
+        exporter = ConsoleSpanExporter()
+
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    print(f"[tracing] service={service_name} exporter={TRACE_EXPORTER} pid={os.getpid()}")
+
+
+def inject_headers(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """把当前 trace context（traceparent/tracestate）写进 outgoing headers。"""
+    carrier: Dict[str, str] = dict(headers or {})
+    inject(carrier)
+    return carrier
+
+
+def has_active_span() -> bool:
+    return trace.get_current_span().get_span_context().is_valid
+
+
+@contextmanager
+def start_span(
+    name: str,
+    *,
+    kind: SpanKind = SpanKind.INTERNAL,
+    carrier: Optional[Mapping[str, Any]] = None,
+    links_from: Optional[Mapping[str, Any]] = None,
+    attributes: Optional[Dict[str, Any]] = None,
+) -> Iterator[trace.Span]:
+    """
+    - carrier：从 header/_meta 里续上上游的 trace（作为 parent）
+    - links_from：只建立 link，不作为 parent（例如 job 是之前某个 trace 创建的）
+    """
+    parent = extract(carrier) if carrier else None
+    links = []
+    if links_from:
+        linked = trace.get_current_span(extract(links_from)).get_span_context()
+        if linked.is_valid:
+            links.append(Link(linked))
+    attrs = {k: v for k, v in (attributes or {}).items() if v is not None}
+    with tracer.start_as_current_span(name, context=parent, kind=kind, links=links, attributes=attrs) as span:
+        yield span
+
+
+def traced(name: str, *, attrs_from: Sequence[str] = ("session_id", "thread_id")) -> Callable:
+    """同步函数装饰器：整个调用包一层 span，attrs_from 里的 kwargs 记成 attribute。"""
+
+    def deco(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            attrs = {f"gateway.{k}": str(kwargs[k]) for k in attrs_from if kwargs.get(k) is not None}
+            with start_span(name, attributes=attrs) as span:
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    mark_error(span, e)
+                    raise
+
+        return wrapper
+
+    return deco
+
+
+def mark_error(span: trace.Span, exc: BaseException) -> None:
+    span.record_exception(exc)
+    span.set_status(Status(StatusCode.ERROR, str(exc)[:200]))
+
+
+class TracingMiddleware:
+    """纯 ASGI middleware：流式响应也在 span 里（BaseHTTPMiddleware 会提前结束）。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope.get("type") != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers") or []}
+        name = f"{scope.get('method', 'GET')} {scope.get('path', '')}"
+        with start_span(name, kind=SpanKind.SERVER, carrier=headers) as span:
+            span.set_attribute("http.method", scope.get("method", ""))
+            span.set_attribute("http.target", scope.get("path", ""))
+
+            async def send_wrapper(message):
+                if message.get("type") == "http.response.start":
+                    status = int(message.get("status") or 0)
+                    span.set_attribute("http.status_code", status)
+                    if status >= 500:
+                        span.set_status(Status(StatusCode.ERROR))
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            except Exception as e:
+                mark_error(span, e)
+                raise
+
+
+# -----------------------------
+# Celery：publish 时注入 message header，worker 执行时续上
+# -----------------------------
+_CELERY_SPAN_KEY = "_otel_span_token"
+
+
+def setup_celery_tracing(service_name: str) -> None:
+    from celery import signals
+
+    @signals.worker_process_init.connect(weak=False)
+    def _init_worker(**_kwargs):
+        init_tracing(service_name)
+
+    @signals.beat_init.connect(weak=False)
+    def _init_beat(**_kwargs):
+        init_tracing(f"{service_name}-beat")
+
+    @signals.before_task_publish.connect(weak=False)
+    def _inject(headers=None, **_kwargs):
+        if isinstance(headers, dict):
+            inject(headers)
+
+    @signals.task_prerun.connect(weak=False)
+    def _prerun(task_id=None, task=None, **_kwargs):
+        if task is None:
+            return
+        req = task.request
+        carrier = {k: getattr(req, k, None) for k in ("traceparent", "tracestate") if getattr(req, k, None)}
+        parent = extract(carrier) if carrier else None
+        span = tracer.start_span(f"celery.task {task.name}", context=parent, kind=SpanKind.CONSUMER)
+        span.set_attribute("celery.task_id", task_id or "")
+        token = otel_context.attach(trace.set_span_in_context(span))
+        setattr(req, _CELERY_SPAN_KEY, (span, token))
+
+    @signals.task_postrun.connect(weak=False)
+    def _postrun(task=None, state=None, **_kwargs):
+        if task is None:
+            return
+        pair = getattr(task.request, _CELERY_SPAN_KEY, None)
+        if not pair:
+            return
+        span, token = pair
+        span.set_attribute("celery.state", state or "")
+        span.end()
+        otel_context.detach(token)
+        setattr(task.request, _CELERY_SPAN_KEY, None)
+
+    @signals.task_failure.connect(weak=False)
+    def _failure(sender=None, exception=None, **_kwargs):
+        pair = getattr(getattr(sender, "request", None), _CELERY_SPAN_KEY, None)
+        if pair and exception is not None:
+            mark_error(pair[0], exception)
@@ -1,5 +1,5 @@
-from .session import engine, Base
+from .session import Base, get_engine
 from . import models  # noqa
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
@@ -1,3 +1,4 @@
+import os
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -18,11 +19,15 @@ if config.config_file_name is not None:
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
-from app.db.session import Base
+from app.db.session import Base, DATABASE_URL, normalize_database_url
 from app.db import models  # noqa: F401
 
 target_metadata = Base.metadata
 
+# 和应用用同一个库：设置了 DATABASE_URL 时覆盖 alembic.ini 里的 sqlalchemy.url（% 要转义给 configparser）
+if os.getenv("DATABASE_URL"):
+    config.set_main_option("sqlalchemy.url", normalize_database_url(DATABASE_URL).replace("%", "%%"))
+
 #这样之后你再加表/改字段，只需要 alembic revision --autogenerate，不会被“补库地狱”折磨。
 
 # other values from the config, defined by the needs of env.py,
@@ -0,0 +1,42 @@
+"""add scope_counters table
+
+Revision ID: 3c7a9e1f5b20
+Revises: 6f8c0b1a2d34
+Create Date: 2026-03-10 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3c7a9e1f5b20"
+down_revision: Union[str, Sequence[str], None] = "6f8c0b1a2d34"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "scope_counters",
+        sa.Column("scope_key", sa.String(), nullable=False),
+        sa.Column("scope_type", sa.String(), nullable=False),
+        sa.Column("session_id", sa.String(), nullable=True),
+        sa.Column("thread_id", sa.String(), nullable=True),
+        sa.Column("memory_id", sa.String(), nullable=True),
+        sa.Column("agent_id", sa.String(), nullable=True),
+        sa.Column("user_turns", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("tokens", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("scope_key"),
+    )
+    op.create_index(op.f("ix_scope_counters_scope_type"), "scope_counters", ["scope_type"], unique=False)
+    op.create_index(op.f("ix_scope_counters_session_id"), "scope_counters", ["session_id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_scope_counters_session_id"), table_name="scope_counters")
+    op.drop_index(op.f("ix_scope_counters_scope_type"), table_name="scope_counters")
+    op.drop_table("scope_counters")
@@ -0,0 +1,47 @@
+"""composite indexes for hot queries
+
+Revision ID: 5b7f2c9d4e61
+Revises: 8d2e4b6a1c93
+Create Date: 2026-03-13 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5b7f2c9d4e61"
+down_revision: Union[str, Sequence[str], None] = "8d2e4b6a1c93"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (index name, table, columns)；和 models.py 的 __table_args__ 保持一致
+INDEXES = [
+    ("ix_messages_session_role_turn", "messages", ["session_id", "role", "turn_id", "user_turn"]),
+    ("ix_messages_session_thread_role_turn", "messages", ["session_id", "thread_id", "role", "turn_id", "user_turn"]),
+    ("ix_messages_memory_agent_role_turn", "messages", ["memory_id", "agent_id", "role", "turn_id", "user_turn"]),
+    ("ix_messages_session_user_turn", "messages", ["session_id", "user_turn", "turn_id"]),
+    ("ix_summaries_s4_session_to_turn", "summaries_s4", ["session_id", "to_turn"]),
+    ("ix_summaries_s4_scope_to_turn", "summaries_s4",
+     ["session_id", "scope_type", "thread_id", "memory_id", "agent_id", "to_turn"]),
+    ("ix_summaries_s60_session_to_turn", "summaries_s60", ["session_id", "to_turn"]),
+    ("ix_summaries_s60_scope_to_turn", "summaries_s60",
+     ["session_id", "scope_type", "thread_id", "memory_id", "agent_id", "to_turn"]),
+    ("ix_trigger_jobs_session_type_created", "trigger_jobs", ["session_id", "trigger_type", "created_at"]),
+    ("ix_trigger_jobs_status_scheduled", "trigger_jobs", ["status", "scheduled_at"]),
+]
+
+
+def upgrade() -> None:
+    # 大表上线：Postgres 可以改成 CREATE INDEX CONCURRENTLY（需在 autocommit_block 里执行）
+    for name, table, cols in INDEXES:
+        op.create_index(name, table, cols)
+    # 让 SQLite / Postgres 的优化器拿到新索引的统计信息
+    op.execute("ANALYZE")
+
+
+def downgrade() -> None:
+    for name, table, _cols in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,39 @@
+"""atomic turn allocation: sessions.last_user_turn + unique (session_id, turn_id)
+
+Revision ID: 8d2e4b6a1c93
+Revises: 3c7a9e1f5b20
+Create Date: 2026-03-12 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8d2e4b6a1c93"
+down_revision: Union[str, Sequence[str], None] = "3c7a9e1f5b20"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("sessions", sa.Column("last_user_turn", sa.Integer(), nullable=True, server_default="0"))
+
+    # 分配器从 session 行递增，先把计数对齐到已有消息
+    op.execute(
+        """
+        UPDATE sessions SET
+            last_turn_id = COALESCE((SELECT MAX(m.turn_id) FROM messages m WHERE m.session_id = sessions.id), 0),
+            last_user_turn = COALESCE((SELECT MAX(m.user_turn) FROM messages m WHERE m.session_id = sessions.id), 0)
+        """
+    )
+
+    # 已有重复 turn_id 时这里会失败：先人工清理（SELECT session_id, turn_id, COUNT(*) ... HAVING COUNT(*) > 1）
+    op.create_index("uq_messages_session_turn", "messages", ["session_id", "turn_id"], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index("uq_messages_session_turn", table_name="messages")
+    op.drop_column("sessions", "last_user_turn")
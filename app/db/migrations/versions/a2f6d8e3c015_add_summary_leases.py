@@ -0,0 +1,34 @@
+"""add summary_leases table
+
+Revision ID: a2f6d8e3c015
+Revises: c8d4f2a6e917
+Create Date: 2026-03-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a2f6d8e3c015"
+down_revision: Union[str, Sequence[str], None] = "c8d4f2a6e917"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "summary_leases",
+        sa.Column("lease_key", sa.String(), primary_key=True),
+        sa.Column("owner", sa.String(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index("ix_summary_leases_expires_at", "summary_leases", ["expires_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_summary_leases_expires_at", table_name="summary_leases")
+    op.drop_table("summary_leases")
@@ -0,0 +1,35 @@
+"""add debug_events ring table
+
+Revision ID: c8d4f2a6e917
+Revises: e41a7c3b9d05
+Create Date: 2026-03-16 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c8d4f2a6e917"
+down_revision: Union[str, Sequence[str], None] = "e41a7c3b9d05"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "debug_events",
+        sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column("session_id", sa.String(), nullable=True),
+        sa.Column("stage", sa.String(), nullable=False, server_default=""),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("payload_json", sa.Text(), nullable=False),
+    )
+    op.create_index("ix_debug_events_session_id", "debug_events", ["session_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_debug_events_session_id", table_name="debug_events")
+    op.drop_table("debug_events")
@@ -0,0 +1,36 @@
+"""add summary_cache table
+
+Revision ID: e41a7c3b9d05
+Revises: 5b7f2c9d4e61
+Create Date: 2026-03-14 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e41a7c3b9d05"
+down_revision: Union[str, Sequence[str], None] = "5b7f2c9d4e61"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "summary_cache",
+        sa.Column("cache_key", sa.String(), primary_key=True),
+        sa.Column("model", sa.String(), nullable=True),
+        sa.Column("value_json", sa.Text(), nullable=False),
+        sa.Column("hits", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index("ix_summary_cache_expires_at", "summary_cache", ["expires_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_summary_cache_expires_at", table_name="summary_cache")
+    op.drop_table("summary_cache")
@@ -1,6 +1,6 @@
 import uuid
 from datetime import datetime
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.orm import relationship
 
 from .session import Base
@@ -17,6 +17,7 @@ class Session(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow)
     last_turn_id = Column(Integer, default=0)
+    last_user_turn = Column(Integer, default=0)
     meta_json = Column(Text, default="{}")
     proactive_enabled = Column(Boolean, nullable=True, default=False)
     silence_threshold_min = Column(Integer, nullable=True, default=240)
@@ -48,6 +49,55 @@ class Message(Base):
 
     session = relationship("Session", back_populates="messages")
 
+    # 热查询用的复合索引（见 scripts/check_query_plans.py）；末尾带 user_turn 让只取 user_turn 的查询走覆盖索引
+    __table_args__ = (
+        Index("uq_messages_session_turn", "session_id", "turn_id", unique=True),
+        Index("ix_messages_session_role_turn", "session_id", "role", "turn_id", "user_turn"),
+        Index("ix_messages_session_thread_role_turn", "session_id", "thread_id", "role", "turn_id", "user_turn"),
+        Index("ix_messages_memory_agent_role_turn", "memory_id", "agent_id", "role", "turn_id", "user_turn"),
+        Index("ix_messages_session_user_turn", "session_id", "user_turn", "turn_id"),
+    )
+
+class ScopeCounter(Base):
+    """按 scope 维护的 user_turn / token 计数，和 message 插入同一个事务里递增。"""
+    __tablename__ = "scope_counters"
+    scope_key = Column(String, primary_key=True)   # JSON: [scope_type, a, b]，null 表示该维度不过滤
+    scope_type = Column(String, index=True, nullable=False)  # thread / memory
+    session_id = Column(String, index=True, nullable=True)
+    thread_id = Column(String, nullable=True)
+    memory_id = Column(String, nullable=True)
+    agent_id = Column(String, nullable=True)
+    user_turns = Column(Integer, nullable=False, default=0)
+    tokens = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class SummaryCache(Base):
+    """摘要 LLM 结果缓存：key = sha256(system, user, model, temperature)，过期由 expires_at 控制。"""
+    __tablename__ = "summary_cache"
+    cache_key = Column(String, primary_key=True)
+    model = Column(String, nullable=True)
+    value_json = Column(Text, nullable=False)
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True, nullable=False)
+
+class SummaryLease(Base):
+    """摘要租约：lease_key = dedupe_key，同一窗口同一时刻只有一个进程调 LLM；过期可被接管。"""
+    __tablename__ = "summary_leases"
+    lease_key = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True, nullable=False)
+
+class DebugEvent(Base):
+    """摘要调试事件环形表（DEBUG_EVENTS_BACKEND=db）：自增 id 即翻页游标，超过上限的旧行在写入时删除。"""
+    __tablename__ = "debug_events"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String, index=True, nullable=True)
+    stage = Column(String, nullable=False, default="")
+    created_at = Column(DateTime, default=datetime.utcnow)
+    payload_json = Column(Text, nullable=False)
+
 class SummaryS4(Base):
     __tablename__ = "summaries_s4"
     id = Column(String, primary_key=True, default=gen_id)
@@ -67,6 +117,11 @@ class SummaryS4(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     meta_json = Column(Text, default="{}")
 
+    __table_args__ = (
+        Index("ix_summaries_s4_session_to_turn", "session_id", "to_turn"),
+        Index("ix_summaries_s4_scope_to_turn", "session_id", "scope_type", "thread_id", "memory_id", "agent_id", "to_turn"),
+    )
+
 class SummaryS60(Base):
     __tablename__ = "summaries_s60"
     id = Column(String, primary_key=True, default=gen_id)
@@ -86,6 +141,11 @@ class SummaryS60(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     meta_json = Column(Text, default="{}")
 
+    __table_args__ = (
+        Index("ix_summaries_s60_session_to_turn", "session_id", "to_turn"),
+        Index("ix_summaries_s60_scope_to_turn", "session_id", "scope_type", "thread_id", "memory_id", "agent_id", "to_turn"),
+    )
+
 class TriggerJob(Base):
     __tablename__ = "trigger_jobs"
     id = Column(String, primary_key=True, default=gen_id)
@@ -103,6 +163,11 @@ class TriggerJob(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     meta_json = Column(Text, default="{}")
 
+    __table_args__ = (
+        Index("ix_trigger_jobs_session_type_created", "session_id", "trigger_type", "created_at"),
+        Index("ix_trigger_jobs_status_scheduled", "status", "scheduled_at"),
+    )
+
 
 class OutboxMessage(Base):
     __tablename__ = "outbox_messages"
@@ -1,7 +1,117 @@
-from sqlalchemy import create_engine
+from typing import Any, Dict, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-DATABASE_URL = "sqlite:///./gateway.db"  # MVP用SQLite，以后可改Postgres
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+from app.core.config import env
+
+# -----------------------------
+# DATABASE_URL 驱动的 engine 配置（按进程角色 web / worker / beat 选连接池大小）
+#
+#   DATABASE_URL   默认 sqlite:///./gateway.db；postgres:// / postgresql:// 自动补成 postgresql+psycopg://
+#   DB_ROLE        web（默认）/ worker / beat；不设时 celery worker / beat 启动信号里自动切换
+#   DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_TIMEOUT / DB_POOL_RECYCLE  覆盖角色默认值
+#
+# Postgres：pool_pre_ping + pool_recycle，application_name=gateway-<role> 方便在 pg_stat_activity 里区分
+# SQLite：每个连接设置 WAL + synchronous=NORMAL + busy_timeout + mmap_size + cache_size，
+#         web 和 worker 同时读写同一个文件时读不再被写阻塞，写锁冲突会等 busy_timeout 而不是立刻 "database is locked"
+# -----------------------------
+
+DATABASE_URL = env("DATABASE_URL", "sqlite:///./gateway.db")
+DB_ROLE = env("DB_ROLE", "").strip().lower()
+
+SQLITE_JOURNAL_MODE = env("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = env("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(env("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(env("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(env("SQLITE_CACHE_SIZE_KB", str(64 * 1024)))
+
+# (pool_size, max_overflow)：web 并发请求多；worker 每个子进程串行跑任务；beat 只做定时扫描
+_ROLE_POOL = {
+    "web": (10, 20),
+    "worker": (4, 4),
+    "beat": (1, 1),
+}
+
+
+def normalize_database_url(url: str) -> str:
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg://" + url[len(prefix):]
+    return url
+
+
+def _pool_kwargs(role: str) -> Dict[str, Any]:
+    size, overflow = _ROLE_POOL.get(role, _ROLE_POOL["web"])
+    return {
+        "pool_size": int(env("DB_POOL_SIZE", str(size))),
+        "max_overflow": int(env("DB_MAX_OVERFLOW", str(overflow))),
+        "pool_timeout": int(env("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(env("DB_POOL_RECYCLE", "1800")),
+    }
+
+
+def _set_sqlite_pragmas(dbapi_conn, _record) -> None:
+    cur = dbapi_conn.cursor()
+    try:
+        cur.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cur.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")  # 负数 = KiB
+    finally:
+        cur.close()
+
+
+def make_engine(url: Optional[str] = None, *, role: Optional[str] = None) -> Engine:
+    url = normalize_database_url(url or DATABASE_URL)
+    role = role or DB_ROLE or "web"
+    u = make_url(url)
+
+    if u.get_backend_name() == "sqlite":
+        memory = u.database in (None, "", ":memory:")
+        kwargs: Dict[str, Any] = {
+            # pysqlite 自己的锁等待（秒）；和 PRAGMA busy_timeout 一致
+            "connect_args": {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000.0},
+        }
+        if not memory:
+            kwargs.update(_pool_kwargs(role))
+        eng = create_engine(url, **kwargs)
+        if not memory:
+            event.listen(eng, "connect", _set_sqlite_pragmas)
+    else:
+        connect_args: Dict[str, Any] = {}
+        if u.get_backend_name() == "postgresql":
+            connect_args["application_name"] = f"gateway-{role}"
+        eng = create_engine(url, pool_pre_ping=True, connect_args=connect_args, **_pool_kwargs(role))
+
+    print(f"[db] engine role={role} url={u.render_as_string(hide_password=True)}")
+    return eng
+
+
+engine = make_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
+
+
+def get_engine() -> Engine:
+    return engine
+
+
+def configure_engine(role: str) -> Engine:
+    """
+    按进程角色重建 engine，并把 SessionLocal 重新绑定过去（celery worker / beat 启动时调用）。
+    显式设置了 DB_ROLE 时以它为准。旧 engine 用 dispose(close=False)：fork 出来的子进程不能关父进程的连接。
+    """
+    global engine
+    old = engine
+    engine = make_engine(role=DB_ROLE or role)
+    SessionLocal.configure(bind=engine)
+    old.dispose(close=False)
+    return engine
+
+
+def reset_engine_after_fork() -> None:
+    """prefork 子进程里调用：丢掉从父进程继承的连接池，之后按需重新建连。"""
+    engine.dispose(close=False)
@@ -2,6 +2,7 @@ from fastapi import FastAPI, APIRouter
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 
+from app.core.tracing import TracingMiddleware, init_tracing
 from app.db.init_db import init_db
 from app.api.v1 import routes_chat, routes_health, routes_context
 from app.api.v1.routes_sessions import router as sessions_router
@@ -10,11 +11,16 @@ from app.api.v1.routes_telegram import router as telegram_router
 from app.api.v1.routes_anchor_mcp import router as anchor_mcp_router
 from app.api.v1.routes_gateway_ctx import router as gateway_ctx_router
 from app.api.v1.routes_openai_proxy import router as openai_proxy_router
+from app.api.v1.routes_metrics import router as metrics_router
 
 load_dotenv()
 
 app = FastAPI(title="Listopia Gateway", version="0.1.0")
 
+# tracing：TRACE_EXPORTER=none 时是 no-op
+init_tracing("gateway-web")
+app.add_middleware(TracingMiddleware)
+
 # 初始化数据库（建表）
 init_db()
 
@@ -33,6 +39,9 @@ app.include_router(gateway_ctx_router, prefix="/api/v1/mcp", tags=["mcp"])
 # OpenAI proxy（保持原样）
 app.include_router(openai_proxy_router)
 
+# Prometheus 抓取入口（按惯例挂在根路径 /metrics）
+app.include_router(metrics_router)
+
 # Debug: 列出所有路由路径
 debug_router = APIRouter()
 
@@ -0,0 +1,6 @@
+from typing import List
+from pydantic import BaseModel
+
+class ContextBatchRequest(BaseModel):
+    session_ids: List[str]
+    recent: int = 16
@@ -1,69 +1,139 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import Optional, Dict, Any, List
-
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List, Tuple
+
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session as OrmSession
 
+from app.core.tracing import traced
+
 # 你项目里的模型路径可能不同：如果这里报错，把 traceback 发我
 from app.db.models import Session, Message
-from app.services.summarizer import run_s4, run_s60
+from app.services.scope_counters import bump_scope_counters, get_scope_tokens, get_scope_user_turns, lookup_spec
+from app.services.silence_scheduler import DEFAULT_SILENCE_THRESHOLD_MIN, schedule_silence
+from app.services.summary_jobs import dispatch_summary_jobs, enqueue_summary_job, touch_debounced_jobs
+from app.services.tokenizer import count_tokens
+
+# S4 生成模式（见 summarizer）：2 = 整窗重算（默认），3 = 增量（上一版 + 新增消息，定期整窗刷新）
+S4_SUMMARY_VERSION = int(os.getenv("S4_SUMMARY_VERSION", "2"))
 
 
 def _now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
 
-def _get_or_create_session(db: OrmSession, session_id: str) -> Session:
-    s = db.query(Session).filter(Session.id == session_id).first()
-    if s:
-        return s
-    s = Session(id=session_id)
-    # 如果你 Session 表有 created_at/updated_at 等字段，这里可补
-    db.add(s)
-    db.commit()
-    db.refresh(s)
-    return s
+def _ensure_session(db: OrmSession, session_id: str) -> None:
+    """不支持 ON CONFLICT 的方言用：savepoint 里插入，撞主键说明别人已建好。不 commit。"""
+    if db.query(Session.id).filter(Session.id == session_id).first():
+        return
+    try:
+        with db.begin_nested():
+            db.add(Session(id=session_id))
+    except IntegrityError:
+        pass
 
 
-def _next_turn_id(db: OrmSession, session_id: str) -> int:
-    last = (
-        db.query(Message.turn_id)
-        .filter(Message.session_id == session_id)
-        .order_by(Message.turn_id.desc())
-        .first()
-    )
-    return (last[0] if last else 0) + 1
+def _alloc_columns(sessions):
+    return (sessions.c.last_turn_id, sessions.c.last_user_turn, sessions.c.proactive_enabled, sessions.c.silence_threshold_min)
+
+
+def _alloc_result(row, n_messages: int) -> Tuple[int, int, Optional[int]]:
+    last_turn_id, last_user_turn = int(row[0]), int(row[1])
+    silence_threshold = (row[3] or DEFAULT_SILENCE_THRESHOLD_MIN) if row[2] else None
+    return last_user_turn, last_turn_id - n_messages + 1, silence_threshold
 
 
-def _next_user_turn(db: OrmSession, session_id: str) -> int:
-    # user_turn 在你的表里：对 user 消息递增；assistant 用同一个值
-    last = (
-        db.query(Message.user_turn)
-        .filter(Message.session_id == session_id)
-        .order_by(Message.turn_id.desc())
-        .first()
+def _allocate_turn_ids(db: OrmSession, session_id: str, *, n_messages: int = 2) -> Tuple[int, int, Optional[int]]:
+    """
+    从 session 行原子分配 (user_turn, 第一条消息的 turn_id, 沉默阈值)。
+    UPDATE 先拿行锁（Postgres 行锁 / SQLite 写锁），并发写同一个 thread 不会拿到相同的 turn_id；
+    支持 RETURNING 的方言一条语句完成，否则同事务内再读一次。
+    user_turn 对 user 消息递增；assistant 用同一个值。
+    沉默阈值：proactive_enabled 时为 silence_threshold_min（分钟），否则 None（不用排沉默调度）。
+    """
+    stmt = (
+        update(Session)
+        .where(Session.id == session_id)
+        .values(
+            last_turn_id=func.coalesce(Session.last_turn_id, 0) + n_messages,
+            last_user_turn=func.coalesce(Session.last_user_turn, 0) + 1,
+        )
+        .execution_options(synchronize_session=False)
     )
-    last_ut = last[0] if last and last[0] is not None else 0
-    return last_ut + 1
+    columns = _alloc_columns(Session.__table__)
+    if db.get_bind().dialect.update_returning:
+        row = db.execute(stmt.returning(*columns)).first()
+    else:
+        db.execute(stmt)
+        row = db.execute(select(*columns).where(Session.id == session_id)).first()
+    if row is None:
+        raise RuntimeError(f"session not found when allocating turn ids: {session_id}")
+    return _alloc_result(row, n_messages)
+
+
+_UPSERT_STMTS: Dict[str, Any] = {}
+
+
+def _session_upsert_stmt(dialect_name: str):
+    # 语句按方言只构造一次（参数走 bindparam），每轮省掉 SQL 表达式构造开销
+    stmt = _UPSERT_STMTS.get(dialect_name)
+    if stmt is None:
+        insert_fn = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}[dialect_name]
+        sessions = Session.__table__
+        stmt = insert_fn(sessions).values(
+            id=bindparam("sid"),
+            last_turn_id=bindparam("n"),
+            last_user_turn=1,
+            created_at=bindparam("now"),
+            updated_at=bindparam("now"),
+        )
+        stmt = _UPSERT_STMTS[dialect_name] = stmt.on_conflict_do_update(
+            index_elements=[sessions.c.id],
+            set_={
+                "last_turn_id": func.coalesce(sessions.c.last_turn_id, 0) + bindparam("n"),
+                "last_user_turn": func.coalesce(sessions.c.last_user_turn, 0) + 1,
+                "updated_at": bindparam("now"),
+            },
+        ).returning(*_alloc_columns(sessions))
+    return stmt
+
+
+def _upsert_session_and_allocate(db: OrmSession, session_id: str, *, n_messages: int = 2) -> Tuple[int, int, Optional[int]]:
+    """
+    session 不存在就建、存在就递增计数，一条 INSERT ... ON CONFLICT DO UPDATE ... RETURNING 完成
+    （SQLite >= 3.35 / Postgres）。其它方言退回 _ensure_session + _allocate_turn_ids。
+    """
+    dialect = db.get_bind().dialect
+    if dialect.name not in ("sqlite", "postgresql") or not dialect.insert_returning:
+        _ensure_session(db, session_id)
+        return _allocate_turn_ids(db, session_id, n_messages=n_messages)
 
+    row = db.execute(
+        _session_upsert_stmt(dialect.name),
+        {"sid": session_id, "n": n_messages, "now": datetime.utcnow()},
+    ).first()
+    return _alloc_result(row, n_messages)
 
-def _count_scoped_user_turns(
-    db: OrmSession,
+
+def _apply_scope_filters(
+    q,
     *,
     session_id: str,
     scope_type: str,
     thread_id: Optional[str],
     memory_id: Optional[str],
     agent_id: Optional[str],
-) -> int:
+):
     # NOTE:
     # - thread scope: count inside the current session/thread timeline.
     # - memory scope: count across sessions, keyed by memory_id (+agent_id),
     #   so A/B thread hopping can still accumulate scoped user turns.
-    q = db.query(Message).filter(Message.role == "user")
-
     if scope_type == "thread":
         q = q.filter(Message.session_id == session_id)
         if thread_id is not None:
@@ -76,10 +146,128 @@ def _count_scoped_user_turns(
         # Safety fallback: if memory identifiers are missing, avoid scanning global history.
         if memory_id is None and agent_id is None:
             q = q.filter(Message.session_id == session_id)
+    return q
 
+
+def _count_scoped_user_turns(
+    db: OrmSession,
+    *,
+    session_id: str,
+    scope_type: str,
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+    counters: Optional[Dict[str, int]] = None,
+) -> int:
+    # 本轮 bump 已经带回了计数就直接用；否则读 scope_counters（O(1)）；计数行还没有时回退 COUNT
+    if counters:
+        key = lookup_spec(
+            session_id=session_id,
+            scope_type=scope_type,
+            thread_id=thread_id,
+            memory_id=memory_id,
+            agent_id=agent_id,
+        ).key
+        if key in counters:
+            return counters[key]
+    n = get_scope_user_turns(
+        db,
+        session_id=session_id,
+        scope_type=scope_type,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+    )
+    if n is not None:
+        return n
+    q = db.query(Message).filter(Message.role == "user")
+    q = _apply_scope_filters(
+        q,
+        session_id=session_id,
+        scope_type=scope_type,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+    )
     return q.count()
 
 
+def scoped_token_total(
+    db: OrmSession,
+    *,
+    session_id: str,
+    scope_type: str = "thread",
+    thread_id: Optional[str] = None,
+    memory_id: Optional[str] = None,
+    agent_id: Optional[str] = None,
+) -> int:
+    """scope 内（user + assistant）累计 content_tokens：优先读 scope_counters（O(1)），计数行还没有时回退 SUM。"""
+    n = get_scope_tokens(
+        db,
+        session_id=session_id,
+        scope_type=scope_type,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+    )
+    if n is not None:
+        return n
+    q = db.query(func.coalesce(func.sum(Message.content_tokens), 0))
+    q = _apply_scope_filters(
+        q,
+        session_id=session_id,
+        scope_type=scope_type,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+    )
+    return int(q.scalar() or 0)
+
+
+def scoped_tokens_by_user_turn(
+    db: OrmSession,
+    *,
+    session_id: str,
+    scope_type: str = "thread",
+    thread_id: Optional[str] = None,
+    memory_id: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    last_user_turns: int = 30,
+) -> List[Tuple[int, int, int]]:
+    """
+    最近 N 个 user_turn 的 (user_turn, tokens, 从最新往回的累计 tokens)，按 user_turn 倒序。
+    摘要窗口 / 上下文裁剪可以直接按累计值找切点，不用加载正文。
+    user_turn 是按 session 编号的：memory scope 跨 session，这里的逐轮明细仍只看本 session
+    （和摘要窗口 _build_scope_query 一样），否则不同 session 的同号 user_turn 会被加在一起。
+    """
+    q = db.query(
+        Message.user_turn,
+        func.coalesce(func.sum(Message.content_tokens), 0),
+    ).filter(Message.user_turn.isnot(None))
+    q = _apply_scope_filters(
+        q,
+        session_id=session_id,
+        scope_type=scope_type,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+    )
+    if scope_type == "memory":
+        q = q.filter(Message.session_id == session_id)
+    rows = (
+        q.group_by(Message.user_turn)
+        .order_by(Message.user_turn.desc())
+        .limit(max(1, int(last_user_turns)))
+        .all()
+    )
+    out: List[Tuple[int, int, int]] = []
+    running = 0
+    for ut, tokens in rows:
+        running += int(tokens or 0)
+        out.append((int(ut), int(tokens or 0), running))
+    return out
+
+
 @dataclass
 class ChatOnceResult:
     session_id: str
@@ -88,8 +276,11 @@ class ChatOnceResult:
     user_turn_triggered_s60: bool
     user_message_turn_id: int
     assistant_message_turn_id: int
+    # 分阶段耗时（毫秒），给 proxy 的 Server-Timing / metrics 用
+    timings: Dict[str, float] = field(default_factory=dict)
 
 
+@traced("chat_once")
 def chat_once(
     db: OrmSession,
     session_id: str,
@@ -114,11 +305,11 @@ def chat_once(
     assistant 的 user_turn 与当轮 user 相同，不递增。
     """
 
-    session = _get_or_create_session(db, session_id)
+    # 一轮只提交一次：session upsert + 两条消息 + scope 计数 + 摘要入队 同一个事务
+    t_persist = time.perf_counter()
 
-    # 计算 turn/user_turn
-    user_turn = _next_user_turn(db, session_id)
-    user_turn_id = _next_turn_id(db, session_id)
+    # 计算 turn/user_turn（session 行原子分配，不再 ORDER BY turn_id DESC 反查）
+    user_turn, user_turn_id, silence_threshold = _upsert_session_and_allocate(db, session_id, n_messages=2)
     assistant_turn_id = user_turn_id + 1
 
     # 写 user message
@@ -128,6 +319,7 @@ def chat_once(
         user_turn=user_turn,
         role="user",
         content=user_text,
+        content_tokens=count_tokens(user_text),
         created_at=_now_utc(),
         thread_id=thread_id,
         memory_id=memory_id,
@@ -143,6 +335,7 @@ def chat_once(
         user_turn=user_turn,
         role="assistant",
         content=assistant_text,
+        content_tokens=count_tokens(assistant_text),
         created_at=_now_utc(),
         thread_id=thread_id,
         memory_id=memory_id,
@@ -151,13 +344,17 @@ def chat_once(
     )
     db.add(m_asst)
 
-    # 更新 session 的 last_turn_id / last_user_turn（如果 Session 有这些字段）
-    if hasattr(session, "last_turn_id"):
-        session.last_turn_id = assistant_turn_id
-    if hasattr(session, "last_user_turn"):
-        session.last_user_turn = user_turn
-
-    db.commit()
+    # scope 计数和消息同一事务提交（flush 后种子化 COUNT 才数得到这两条）
+    db.flush()
+    counters = bump_scope_counters(
+        db,
+        session_id=session_id,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+        user_turns=1,
+        tokens=(m_user.content_tokens or 0) + (m_asst.content_tokens or 0),
+    )
 
     effective_s4_scope = (s4_scope or "thread").lower()
     if effective_s4_scope == "auto":
@@ -172,6 +369,7 @@ def chat_once(
         thread_id=thread_id,
         memory_id=memory_id,
         agent_id=agent_id,
+        counters=counters,
     )
     s60_scope_user_turn = _count_scoped_user_turns(
         db,
@@ -180,15 +378,18 @@ def chat_once(
         thread_id=thread_id,
         memory_id=memory_id,
         agent_id=agent_id,
+        counters=counters,
     )
 
     # 触发 summarizer（to_user_turn 是 scope 内的 user_turn）
     triggered_s4 = (s4_scope_user_turn % s4_every_user_turns == 0)
     triggered_s60 = (s60_scope_user_turn % s60_every_user_turns == 0)
 
+    # 摘要只入队（和消息同一事务），提交后再执行 / 投递；防抖中的 job 先按这条新消息顺延
+    touch_debounced_jobs(db, session_id=session_id)
+    jobs = []
     if triggered_s4:
-        run_s4(
-            db,
+        jobs.append(enqueue_summary_job(db, "s4", session_id=session_id, params=dict(
             session_id=session_id,
             to_user_turn=s4_scope_user_turn,
             window_user_turn=s4_window_user_turns,
@@ -197,12 +398,11 @@ def chat_once(
             memory_id=memory_id,
             agent_id=agent_id,
             s4_scope=effective_s4_scope,
-            summary_version=2,
-        )
+            summary_version=S4_SUMMARY_VERSION,
+        )))
 
     if triggered_s60:
-        run_s60(
-            db,
+        jobs.append(enqueue_summary_job(db, "s60", session_id=session_id, params=dict(
             session_id=session_id,
             to_user_turn=s60_scope_user_turn,
             window_user_turn=s60_window_user_turns,
@@ -211,7 +411,18 @@ def chat_once(
             memory_id=memory_id,
             agent_id=agent_id,
             summary_version=1,
-        )
+        )))
+
+    db.commit()
+    ms_persist = (time.perf_counter() - t_persist) * 1000
+
+    # 沉默调度：这条 user 消息把截止时间顺延到 现在 + 阈值（只对 proactive session）
+    if silence_threshold is not None:
+        schedule_silence(session_id, datetime.utcnow() + timedelta(minutes=silence_threshold))
+
+    t_summarize = time.perf_counter()
+    dispatch_summary_jobs(db, [j.id for j in jobs if j is not None])
+    ms_summarize = (time.perf_counter() - t_summarize) * 1000
 
     return ChatOnceResult(
         session_id=session_id,
@@ -220,6 +431,7 @@ def chat_once(
         user_turn_triggered_s60=triggered_s60,
         user_message_turn_id=user_turn_id,
         assistant_message_turn_id=assistant_turn_id,
+        timings={"persist": ms_persist, "summarize": ms_summarize},
     )
 
 
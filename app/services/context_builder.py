@@ -1,19 +1,11 @@
-import json
-from typing import Any, Dict, List, Optional
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
 
+from sqlalchemy import func
 from sqlalchemy.orm import Session as OrmSession
 
-from app.db.models import Message, SummaryS4, SummaryS60
-
-
-def _safe_json_loads(s: Optional[str]) -> Optional[Dict[str, Any]]:
-    if not s:
-        return None
-    try:
-        return json.loads(s)
-    except Exception:
-        # 如果 summary_json 存了脏内容，至少别让接口炸
-        return {"_raw": s}
+from app.db.models import Message
+from app.services.latest_summaries import LatestSummaries, get_latest_summaries, get_latest_summaries_many
 
 
 def build_context_pack(
@@ -31,39 +23,26 @@ def build_context_pack(
     注意：这里“返回给前端”用；真正喂给 LLM 的 prompt 文本建议在 decider/telegram handler 里再组装。
     """
 
-    s4_row = (
-        db.query(SummaryS4)
-        .filter(SummaryS4.session_id == session_id)
-        .order_by(SummaryS4.to_turn.desc())
-        .first()
-    )
-    s60_row = (
-        db.query(SummaryS60)
-        .filter(SummaryS60.session_id == session_id)
-        .order_by(SummaryS60.to_turn.desc())
-        .first()
-    )
+    # 摘要走进程内缓存（命中时不查库）；latest 就是 recent 的最后一条，不再单独查
+    latest_summaries = get_latest_summaries(db, session_id)
 
-    msgs: List[Message] = (
-        db.query(Message)
+    rows = (
+        db.query(Message.role, Message.turn_id, Message.user_turn, Message.content)
         .filter(Message.session_id == session_id)
         .order_by(Message.turn_id.desc())
         .limit(recent)
         .all()
     )
-    msgs = list(reversed(msgs))
+    return _pack(session_id, latest_summaries, list(reversed(rows)), include_meta)
 
-    latest = (
-        db.query(Message)
-        .filter(Message.session_id == session_id)
-        .order_by(Message.turn_id.desc())
-        .first()
-    )
 
+def _pack(session_id: str, latest_summaries: LatestSummaries, rows: List[Any], include_meta: bool) -> Dict[str, Any]:
+    # rows 按 turn_id 正序
+    latest = rows[-1] if rows else None
     pack: Dict[str, Any] = {
         "session_id": session_id,
-        "s4": None,
-        "s60": None,
+        "s4": latest_summaries.s4,
+        "s60": latest_summaries.s60,
         "recent": [
             {
                 "role": m.role,
@@ -71,26 +50,10 @@ def build_context_pack(
                 "user_turn": m.user_turn,
                 "content": m.content,
             }
-            for m in msgs
+            for m in rows
         ],
     }
 
-    if s4_row:
-        pack["s4"] = {
-            "range": [s4_row.from_turn, s4_row.to_turn],
-            "summary": _safe_json_loads(s4_row.summary_json),
-            "created_at": s4_row.created_at.isoformat() if s4_row.created_at else None,
-            "model": s4_row.model,
-        }
-
-    if s60_row:
-        pack["s60"] = {
-            "range": [s60_row.from_turn, s60_row.to_turn],
-            "summary": _safe_json_loads(s60_row.summary_json),
-            "created_at": s60_row.created_at.isoformat() if s60_row.created_at else None,
-            "model": s60_row.model,
-        }
-
     if include_meta:
         pack["meta"] = {
             "latest_turn_id": latest.turn_id if latest else None,
@@ -98,3 +61,65 @@ def build_context_pack(
         }
 
     return pack
+
+
+def build_context_packs(
+    db: OrmSession,
+    session_ids: List[str],
+    recent: int = 16,
+    include_meta: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    多个 session 的 ContextPack（面板 / proactive decider 一次要一批）。
+    和逐个调 build_context_pack 结果一样，但整批只有固定几条 SQL：
+      - 最近 N 条：ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY turn_id DESC) <= N
+      - 最新 S4 / S60：缓存没命中的 session 一起分组取第一（见 get_latest_summaries_many）
+    按传入顺序返回（重复 id 只返回一次）；批太大时由调用方分块（routes_context 按块流式输出）。
+    """
+    ids = list(dict.fromkeys(session_ids))
+    if not ids:
+        return []
+    summaries = get_latest_summaries_many(db, ids)
+
+    by_session: Dict[str, List[Any]] = {sid: [] for sid in ids}
+    for r in _recent_messages_query(db, ids, recent).all():
+        by_session[r.session_id].append(r)
+
+    return [_pack(sid, summaries[sid], by_session[sid], include_meta) for sid in ids]
+
+
+def _recent_messages_query(db: OrmSession, session_ids: List[str], recent: int):
+    rn = func.row_number().over(partition_by=Message.session_id, order_by=Message.turn_id.desc()).label("rn")
+    sub = (
+        db.query(Message.session_id, Message.role, Message.turn_id, Message.user_turn, Message.content, rn)
+        .filter(Message.session_id.in_(session_ids))
+        .subquery()
+    )
+    return (
+        db.query(sub.c.session_id, sub.c.role, sub.c.turn_id, sub.c.user_turn, sub.c.content)
+        .filter(sub.c.rn <= recent)
+        .order_by(sub.c.session_id, sub.c.turn_id.asc())
+    )
+
+
+def latest_turn_id(db: OrmSession, session_id: str) -> Optional[int]:
+    """只走 (session_id, turn_id) 唯一索引的一次查找，给条件 GET 判断有没有新消息用。"""
+    return db.query(func.max(Message.turn_id)).filter(Message.session_id == session_id).scalar()
+
+
+def context_etag(
+    session_id: str,
+    recent: int,
+    *,
+    last_turn_id: Optional[int],
+    summary_ids: Tuple[Optional[str], Optional[str]],
+) -> str:
+    """
+    ContextPack 的弱 ETag：(最新 turn_id, 最新 S4 / S60 的 id, recent)。
+    消息只追加、摘要只新增，这几个不变内容就不变。
+    summary_ids 要来自 latest_summary_ids（直接查库）：进程内缓存可能落后（别的 worker 写的、
+    防抖后没有新 turn 的摘要），拿它算会在内容已经变了的时候回 304。
+    """
+    s4_id, s60_id = summary_ids
+    raw = f"{session_id}:{last_turn_id or 0}:{s4_id or ''}:{s60_id or ''}:{recent}"
+    return 'W/"ctx-' + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20] + '"'
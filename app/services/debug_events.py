@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import re
+import threading
+import zlib
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, or_, select
+
+from app.db.models import DebugEvent
+
+# -----------------------------
+# 摘要调试事件（/sessions/{id}/summaries/debug 的数据源）
+#
+# DEBUG_EVENTS_BACKEND:
+#   memory（默认）-> 进程内环形缓冲，和以前一样只看得到本进程的事件
+#   db             -> debug_events 环形表，web / worker 共用；超过 DEBUG_EVENTS_MAX 的旧行在 flush 时删掉
+#   redis          -> DEBUG_EVENTS_REDIS_URL（默认 REDIS_URL）上的 stream，XADD MAXLEN ~ 自动截断
+#   none           -> 关闭（快照一律不构造）
+# DEBUG_EVENTS_SAMPLE_RATE：按 session_id 哈希抽样（同一个会话要么全记、要么全不记），默认 1 = 全记
+# DEBUG_EVENTS_MAX：保留的事件条数上限
+#
+# db / redis 先写进程内缓冲，由 flush_debug_events() 批量落库：摘要 job 提交之后调用，
+# 不在调用方的写事务里再开一个连接去抢 SQLite 写锁。读接口之前也会先 flush 本进程的缓冲。
+# -----------------------------
+
+DEBUG_EVENTS_BACKEND = (os.getenv("DEBUG_EVENTS_BACKEND", "memory") or "memory").strip().lower()
+DEBUG_EVENTS_SAMPLE_RATE = float(os.getenv("DEBUG_EVENTS_SAMPLE_RATE", "1"))
+DEBUG_EVENTS_MAX = int(os.getenv("DEBUG_EVENTS_MAX", "2000"))
+_REDIS_STREAM = "debug_events"
+_REDIS_ID_RE = re.compile(r"\d+(-\d+)?")
+_INT_ID_RE = re.compile(r"\d+")
+
+_lock = threading.Lock()
+_memory: deque = deque(maxlen=DEBUG_EVENTS_MAX)
+_memory_seq = 0
+# db / redis 的待写缓冲；满了丢最旧的（调试数据，不值得阻塞主流程）
+_pending: deque = deque(maxlen=DEBUG_EVENTS_MAX)
+_redis_client = None
+
+
+def debug_enabled(session_id: Optional[str] = None) -> bool:
+    """这个会话的事件会不会被记录。调用方据此决定要不要构造昂贵的快照。"""
+    if DEBUG_EVENTS_BACKEND not in {"memory", "db", "redis"} or DEBUG_EVENTS_SAMPLE_RATE <= 0:
+        return False
+    if DEBUG_EVENTS_SAMPLE_RATE >= 1 or not session_id:
+        return True
+    bucket = zlib.crc32(session_id.encode("utf-8")) / 0xFFFFFFFF
+    return bucket < DEBUG_EVENTS_SAMPLE_RATE
+
+
+def lazy(fn: Callable[[], Dict[str, Any]]) -> Callable[[], Dict[str, Any]]:
+    """只算一次的 extra：同一个快照要挂到多个事件上时用。"""
+    cache: List[Dict[str, Any]] = []
+
+    def _get() -> Dict[str, Any]:
+        if not cache:
+            cache.append(fn())
+        return cache[0]
+
+    return _get
+
+
+def push_debug_event(event: Dict[str, Any], *, extra: Optional[Callable[[], Dict[str, Any]]] = None) -> None:
+    """
+    记录一条事件。event 里放便宜的字段（stage / session_id / to_turn ...），
+    extra 是构造快照的回调，只有抽样命中时才调用。任何异常都吞掉，调试数据不影响主流程。
+    """
+    global _memory_seq
+    try:
+        event = event or {}
+        if not debug_enabled(event.get("session_id")):
+            return
+        payload = {"ts": datetime.utcnow().isoformat(), **event}
+        if extra is not None:
+            payload.update(extra())
+        with _lock:
+            if DEBUG_EVENTS_BACKEND == "memory":
+                _memory_seq += 1
+                _memory.append((_memory_seq, payload))
+            else:
+                _pending.append(payload)
+    except Exception:
+        pass
+
+
+def _redis():
+    global _redis_client
+    if _redis_client is None:
+        import redis
+
+        from app.core.config import REDIS_URL
+
+        url = os.getenv("DEBUG_EVENTS_REDIS_URL", "") or REDIS_URL
+        _redis_client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis_client
+
+
+def _trim_db(db) -> None:
+    max_id = db.execute(select(func.max(DebugEvent.id))).scalar()
+    if max_id is not None and max_id > DEBUG_EVENTS_MAX:
+        db.execute(delete(DebugEvent).where(DebugEvent.id <= max_id - DEBUG_EVENTS_MAX))
+
+
+def flush_debug_events() -> int:
+    """把本进程缓冲的事件批量写到共享后端。返回写入条数。"""
+    if DEBUG_EVENTS_BACKEND not in {"db", "redis"}:
+        return 0
+    with _lock:
+        batch = list(_pending)
+        _pending.clear()
+    if not batch:
+        return 0
+    try:
+        if DEBUG_EVENTS_BACKEND == "redis":
+            pipe = _redis().pipeline(transaction=False)
+            for payload in batch:
+                pipe.xadd(
+                    _REDIS_STREAM,
+                    {"sid": payload.get("session_id") or "", "data": json.dumps(payload, ensure_ascii=False)},
+                    maxlen=DEBUG_EVENTS_MAX,
+                    approximate=True,
+                )
+            pipe.execute()
+        else:
+            from app.db.session import SessionLocal
+
+            db = SessionLocal()
+            try:
+                db.add_all([
+                    DebugEvent(
+                        session_id=payload.get("session_id"),
+                        stage=str(payload.get("stage") or ""),
+                        created_at=datetime.utcnow(),
+                        payload_json=json.dumps(payload, ensure_ascii=False),
+                    )
+                    for payload in batch
+                ])
+                db.flush()
+                _trim_db(db)
+                db.commit()
+            finally:
+                db.close()
+    except Exception as e:
+        print(f"[debug_events] flush failed backend={DEBUG_EVENTS_BACKEND} n={len(batch)} err={e!r}")
+        return 0
+    return len(batch)
+
+
+atexit.register(flush_debug_events)
+
+
+def _matches(session_id: Optional[str], sid: Optional[str]) -> bool:
+    # 没有 session_id 的事件（全局缓存统计等）对所有会话可见，和以前的过滤口径一致
+    return not session_id or sid in (None, "", session_id)
+
+
+def _read_memory(session_id: Optional[str], before: Optional[int], limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+    with _lock:
+        items = list(_memory)
+    out: List[Tuple[int, Dict[str, Any]]] = []
+    for seq, payload in reversed(items):
+        if before is not None and seq >= before:
+            continue
+        if _matches(session_id, payload.get("session_id")):
+            out.append((seq, payload))
+            if len(out) >= limit:
+                break
+    return out
+
+
+def _read_db(session_id: Optional[str], before: Optional[int], limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        q = db.query(DebugEvent.id, DebugEvent.payload_json)
+        if session_id:
+            q = q.filter(or_(DebugEvent.session_id == session_id, DebugEvent.session_id.is_(None)))
+        if before is not None:
+            q = q.filter(DebugEvent.id < before)
+        rows = q.order_by(DebugEvent.id.desc()).limit(limit).all()
+    finally:
+        db.close()
+    return [(rid, json.loads(raw)) for rid, raw in rows]
+
+
+def _read_redis(session_id: Optional[str], before: Optional[str], limit: int) -> List[Tuple[str, Dict[str, Any]]]:
+    # stream 按 MAXLEN 有界，按会话过滤只能倒序扫；每批多取一些
+    r = _redis()
+    out: List[Tuple[str, Dict[str, Any]]] = []
+    upper = f"({before}" if before else "+"
+    while len(out) < limit:
+        batch = r.xrevrange(_REDIS_STREAM, max=upper, min="-", count=max(limit * 4, 200))
+        if not batch:
+            break
+        for sid_raw, fields in batch:
+            entry_id = sid_raw.decode() if isinstance(sid_raw, bytes) else sid_raw
+            sid = (fields.get(b"sid") or b"").decode("utf-8")
+            if _matches(session_id, sid):
+                out.append((entry_id, json.loads(fields[b"data"].decode("utf-8"))))
+                if len(out) >= limit:
+                    break
+        upper = f"({entry_id}"
+    return out
+
+
+def read_debug_events(
+    session_id: Optional[str] = None,
+    *,
+    cursor: Optional[str] = None,
+    limit: int = 80,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    倒着翻页：返回 cursor 之前（更旧）的最多 limit 条，页内按时间正序。
+    next_cursor 为 None 表示没有更旧的了；事件里的 "id" 就是它在后端的位置。
+    cursor 格式不对（不是本后端返回过的 id）时抛 ValueError。
+    """
+    limit = max(1, min(int(limit or 80), 1000))
+    cursor = (cursor or "").strip() or None
+    # redis 的 id 是 stream entry id（"ms-seq"），memory / db 是整数
+    pattern = _REDIS_ID_RE if DEBUG_EVENTS_BACKEND == "redis" else _INT_ID_RE
+    if cursor is not None and not pattern.fullmatch(cursor):
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    flush_debug_events()
+    if DEBUG_EVENTS_BACKEND == "redis":
+        rows = _read_redis(session_id, cursor, limit)
+    else:
+        before = int(cursor) if cursor else None
+        reader = _read_db if DEBUG_EVENTS_BACKEND == "db" else _read_memory
+        rows = reader(session_id, before, limit)
+    rows.reverse()
+    events = [{"id": str(rid), **payload} for rid, payload in rows]
+    next_cursor = str(rows[0][0]) if len(rows) >= limit else None
+    return events, next_cursor
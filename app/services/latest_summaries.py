@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session as OrmSession
+
+from app.db.models import SummaryS4, SummaryS60
+
+# -----------------------------
+# 最新 S4 / S60 的进程内缓存（proxy / context pack / brief / prompt_builder 共用）
+#
+# 摘要最多每 4 个 user turn 变一次，但每个请求都在查最新两行再 json.loads。
+# 这里按 (session_id, thread_id, memory_id, agent_id) 缓存解析好的摘要，以及按需渲染好的 prompt 块；
+# 摘要写入（run_s4 / run_s60 / 批量摘要提交之后）时按 session 失效。
+#
+# LATEST_SUMMARY_CACHE_TTL_SECS：兜底过期（默认 30，0 = 关闭缓存，每次查库）
+# LATEST_SUMMARY_CACHE_MAX：缓存的 session 数上限（LRU）
+# LATEST_SUMMARY_BUS：跨进程失效
+#   none  -> 只失效本进程（inline 摘要时 web 进程自己写自己读，够用）
+#   redis -> LATEST_SUMMARY_REDIS_URL（默认 REDIS_URL）上 pub/sub 广播 session_id；
+#            SUMMARY_DISPATCH=celery 时默认 redis（摘要在 worker 里写，web 要收到通知）
+# 订阅断开期间可能漏消息：重连时清空本进程缓存。
+# -----------------------------
+
+LATEST_SUMMARY_CACHE_TTL_SECS = float(os.getenv("LATEST_SUMMARY_CACHE_TTL_SECS", "30"))
+LATEST_SUMMARY_CACHE_MAX = int(os.getenv("LATEST_SUMMARY_CACHE_MAX", "5000"))
+_DEFAULT_BUS = "redis" if (os.getenv("SUMMARY_DISPATCH", "inline") or "").strip().lower() == "celery" else "none"
+LATEST_SUMMARY_BUS = (os.getenv("LATEST_SUMMARY_BUS", _DEFAULT_BUS) or _DEFAULT_BUS).strip().lower()
+_CHANNEL = "latest_summaries:invalidate"
+
+ScopeKey = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+@dataclass
+class LatestSummaries:
+    """缓存里的对象是共享的：调用方只读，不要改 s4 / s60。"""
+
+    s4: Optional[Dict[str, Any]] = None
+    s60: Optional[Dict[str, Any]] = None
+    s4_id: Optional[str] = None
+    s60_id: Optional[str] = None
+    blocks: Dict[str, str] = field(default_factory=dict)
+
+    def block(self, name: str, render: Callable[[Optional[Dict[str, Any]], Optional[Dict[str, Any]]], str]) -> str:
+        """按名字缓存渲染好的 prompt 块（同一个条目只渲染一次，失效时跟着一起丢）。"""
+        text = self.blocks.get(name)
+        if text is None:
+            text = render(self.s4, self.s60)
+            self.blocks[name] = text
+        return text
+
+
+_lock = threading.Lock()
+# session_id -> {scope_key: (expires_at, LatestSummaries)}；外层按 session 做 LRU
+_entries: "OrderedDict[str, Dict[ScopeKey, Tuple[float, LatestSummaries]]]" = OrderedDict()
+# 每个 session 的失效代数：查库前记下，写回缓存时代数变了就不写（查库期间有新摘要落地）
+_gens: Dict[str, int] = {}
+_bus_pid: Optional[int] = None
+_redis_client = None
+
+
+def _safe_json_loads(s: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not s:
+        return None
+    try:
+        return json.loads(s)
+    except Exception:
+        return {"_raw": s}
+
+
+def _view(row: Any) -> Optional[Dict[str, Any]]:
+    if row is None:
+        return None
+    return {
+        "range": [row.from_turn, row.to_turn],
+        "summary": _safe_json_loads(row.summary_json),
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "model": row.model,
+    }
+
+
+def _latest_row(db: OrmSession, model: Any, session_id: str, scope: ScopeKey, *columns: Any) -> Any:
+    q = db.query(*(columns or (model,))).filter(model.session_id == session_id)
+    for col, value in zip(("thread_id", "memory_id", "agent_id"), scope):
+        if value is not None:
+            q = q.filter(getattr(model, col) == value)
+    return q.order_by(model.to_turn.desc()).first()
+
+
+def latest_summary_ids(db: OrmSession, session_id: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    最新 S4 / S60 的 id，直接查库、不走缓存（两次 (session_id, to_turn) 索引查找，只取 id 列）。
+    给 ETag 这类"缓存可能落后就会答错"的地方用：别的 worker 写的摘要、防抖后没有新 turn 的摘要都看得到。
+    和 get_latest_summaries 同一个排序，取到的是同一行。
+    """
+    scope: ScopeKey = (None, None, None)
+    s4 = _latest_row(db, SummaryS4, session_id, scope, SummaryS4.id)
+    s60 = _latest_row(db, SummaryS60, session_id, scope, SummaryS60.id)
+    return (s4[0] if s4 else None), (s60[0] if s60 else None)
+
+
+def _load(db: OrmSession, session_id: str, scope: ScopeKey) -> LatestSummaries:
+    s4_row = _latest_row(db, SummaryS4, session_id, scope)
+    s60_row = _latest_row(db, SummaryS60, session_id, scope)
+    return LatestSummaries(
+        s4=_view(s4_row),
+        s60=_view(s60_row),
+        s4_id=s4_row.id if s4_row is not None else None,
+        s60_id=s60_row.id if s60_row is not None else None,
+    )
+
+
+def _latest_rows_query(db: OrmSession, model: Any, session_ids: List[str]):
+    # 每个 session 取 to_turn 最大的一行：ROW_NUMBER 分组取第一，一次查询覆盖整批
+    rn = func.row_number().over(
+        partition_by=model.session_id, order_by=(model.to_turn.desc(), model.created_at.desc())
+    ).label("rn")
+    sub = (
+        db.query(
+            model.id, model.session_id, model.from_turn, model.to_turn,
+            model.summary_json, model.created_at, model.model, rn,
+        )
+        .filter(model.session_id.in_(session_ids))
+        .subquery()
+    )
+    return db.query(sub).filter(sub.c.rn == 1)
+
+
+def _latest_rows_many(db: OrmSession, model: Any, session_ids: List[str]) -> Dict[str, Any]:
+    return {r.session_id: r for r in _latest_rows_query(db, model, session_ids).all()}
+
+
+def _cache_get(session_id: str, scope: ScopeKey, now: float) -> Tuple[Optional[LatestSummaries], int]:
+    """调用方持有 _lock。返回 (命中的值, 当前代数)。"""
+    per_session = _entries.get(session_id)
+    hit = per_session.get(scope) if per_session else None
+    if hit is not None and hit[0] > now:
+        _entries.move_to_end(session_id)
+        return hit[1], 0
+    return None, _gens.get(session_id, 0)
+
+
+def _cache_put(session_id: str, scope: ScopeKey, gen: int, value: LatestSummaries, now: float) -> None:
+    """调用方持有 _lock。"""
+    if _gens.get(session_id, 0) != gen:
+        return
+    _entries.setdefault(session_id, {})[scope] = (now + LATEST_SUMMARY_CACHE_TTL_SECS, value)
+    _entries.move_to_end(session_id)
+    while len(_entries) > LATEST_SUMMARY_CACHE_MAX:
+        _entries.popitem(last=False)
+
+
+def get_latest_summaries(
+    db: OrmSession,
+    session_id: str,
+    *,
+    thread_id: Optional[str] = None,
+    memory_id: Optional[str] = None,
+    agent_id: Optional[str] = None,
+) -> LatestSummaries:
+    """最新 S4 / S60（scope id 为 None 表示不按它过滤）。命中缓存时不碰数据库。"""
+    scope: ScopeKey = (thread_id, memory_id, agent_id)
+    if LATEST_SUMMARY_CACHE_TTL_SECS <= 0:
+        return _load(db, session_id, scope)
+
+    _ensure_bus()
+    now = time.monotonic()
+    with _lock:
+        hit, gen = _cache_get(session_id, scope, now)
+    if hit is not None:
+        return hit
+
+    value = _load(db, session_id, scope)
+    with _lock:
+        _cache_put(session_id, scope, gen, value, now)
+    return value
+
+
+def get_latest_summaries_many(db: OrmSession, session_ids: List[str]) -> Dict[str, LatestSummaries]:
+    """批量版（不按 scope 过滤）：先查缓存，没命中的一次性分组查（S4 / S60 各一条 SQL），再回填缓存。"""
+    scope: ScopeKey = (None, None, None)
+    cache_on = LATEST_SUMMARY_CACHE_TTL_SECS > 0
+    out: Dict[str, LatestSummaries] = {}
+    gens: Dict[str, int] = {}
+    now = time.monotonic()
+    if cache_on:
+        _ensure_bus()
+        with _lock:
+            for sid in session_ids:
+                hit, gens[sid] = _cache_get(sid, scope, now)
+                if hit is not None:
+                    out[sid] = hit
+    missing = [sid for sid in session_ids if sid not in out]
+    if not missing:
+        return out
+
+    s4_rows = _latest_rows_many(db, SummaryS4, missing)
+    s60_rows = _latest_rows_many(db, SummaryS60, missing)
+    for sid in missing:
+        s4_row, s60_row = s4_rows.get(sid), s60_rows.get(sid)
+        out[sid] = LatestSummaries(
+            s4=_view(s4_row),
+            s60=_view(s60_row),
+            s4_id=s4_row.id if s4_row is not None else None,
+            s60_id=s60_row.id if s60_row is not None else None,
+        )
+    if cache_on:
+        with _lock:
+            for sid in missing:
+                _cache_put(sid, scope, gens[sid], out[sid], now)
+    return out
+
+
+def _drop_local(session_id: str) -> None:
+    with _lock:
+        _entries.pop(session_id, None)
+        _gens[session_id] = _gens.get(session_id, 0) + 1
+        if len(_gens) > LATEST_SUMMARY_CACHE_MAX * 4:
+            # 代数表只增不减：太大时连缓存一起清掉重来（清空缓存本身就是安全的）
+            _gens.clear()
+            _entries.clear()
+
+
+def invalidate_latest_summaries(session_id: str, *, broadcast: bool = True) -> None:
+    """
+    摘要提交之后调用：本进程立即失效，并广播给其它进程。
+    broadcast=False：只丢本进程的（读路径发现缓存落后于库时用，不需要通知别人）。
+    """
+    _drop_local(session_id)
+    if not broadcast or LATEST_SUMMARY_BUS != "redis":
+        return
+    try:
+        _redis().publish(_CHANNEL, session_id)
+    except Exception as e:
+        print(f"[latest_summaries] publish failed session_id={session_id} err={e!r}")
+
+
+def _redis():
+    global _redis_client
+    if _redis_client is None:
+        import redis
+
+        from app.core.config import REDIS_URL
+
+        url = os.getenv("LATEST_SUMMARY_REDIS_URL", "") or REDIS_URL
+        _redis_client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis_client
+
+
+def _listen() -> None:
+    import redis
+
+    from app.core.config import REDIS_URL
+
+    url = os.getenv("LATEST_SUMMARY_REDIS_URL", "") or REDIS_URL
+    while True:
+        try:
+            # 订阅连接不能带 socket_timeout（listen 会一直阻塞等消息）
+            pubsub = redis.Redis.from_url(url, socket_connect_timeout=2).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(_CHANNEL)
+            # 断线期间的失效消息收不到：重新订阅后整体清空
+            with _lock:
+                _entries.clear()
+            for msg in pubsub.listen():
+                data = msg.get("data")
+                if isinstance(data, bytes):
+                    _drop_local(data.decode("utf-8"))
+        except Exception as e:
+            print(f"[latest_summaries] subscriber error err={e!r}; retry in 2s")
+            with _lock:
+                _entries.clear()
+            time.sleep(2)
+
+
+def _ensure_bus() -> None:
+    # fork 出来的 worker 进程里订阅线程不存在，按 pid 各起一个
+    global _bus_pid, _redis_client
+    if LATEST_SUMMARY_BUS != "redis" or _bus_pid == os.getpid():
+        return
+    with _lock:
+        if _bus_pid == os.getpid():
+            return
+        _bus_pid = os.getpid()
+        _redis_client = None
+        _entries.clear()
+    threading.Thread(target=_listen, name="latest-summaries-bus", daemon=True).start()
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from app.core.tracing import start_span
+
+# -----------------------------
+# 分阶段耗时：同一份数据既进 Server-Timing 响应头，也进 Prometheus /metrics
+# 注意：registry 是进程内的，多 worker 部署时每个 worker 各自被抓取
+# -----------------------------
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_SECONDS = Histogram(
+    "gateway_stage_seconds",
+    "Per-stage latency of a gateway request",
+    ["route", "stage", "model", "upstream"],
+    buckets=_LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "gateway_request_seconds",
+    "End-to-end latency of a gateway request (including stream duration)",
+    ["route", "model", "upstream"],
+    buckets=_LATENCY_BUCKETS,
+)
+GATEWAY_CTX_CACHE = Counter(
+    "gateway_ctx_cache_total",
+    "gateway_ctx cache lookups by result",
+    ["result"],
+)
+GATEWAY_CTX_CACHE_HIT_RATIO = Gauge(
+    "gateway_ctx_cache_hit_ratio",
+    "gateway_ctx cache hit ratio since process start",
+)
+SUMMARY_CACHE = Counter(
+    "summary_cache_total",
+    "summarizer LLM result cache lookups by result",
+    ["result"],
+)
+CELERY_QUEUE_LENGTH = Gauge(
+    "celery_queue_length",
+    "Pending messages in the Celery broker queue",
+    ["queue"],
+)
+UPSTREAM_LIMITER_STATE = Gauge(
+    "gateway_upstream_limiter",
+    "AIMD upstream limiter state",
+    ["upstream", "field"],
+)
+
+CELERY_METRICS_QUEUES = [
+    q.strip() for q in os.getenv("CELERY_METRICS_QUEUES", "default").split(",") if q.strip()
+]
+
+_cache_hits = 0
+_cache_lookups = 0
+
+
+def upstream_label(url: str) -> str:
+    # 只保留 host，避免 path/query 撑爆 label 基数
+    try:
+        return urlparse(url).netloc or url
+    except Exception:
+        return url or ""
+
+
+class StageTimings:
+    """一次请求的阶段耗时（毫秒）；observe() 时统一写入 Prometheus。"""
+
+    def __init__(self, route: str, *, model: str = "unknown", upstream: str = ""):
+        self.route = route
+        self.model = model
+        self.upstream = upstream
+        self.stages: List[Tuple[str, float]] = []
+        self._t0 = time.perf_counter()
+        self._observed = False
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        # 每个阶段同时是一个 span，trace 里的 hop 和 Server-Timing 一一对应
+        t = time.perf_counter()
+        try:
+            with start_span(f"stage.{name}", attributes={"gateway.route": self.route}):
+                yield
+        finally:
+            self.add(name, (time.perf_counter() - t) * 1000)
+
+    def add(self, name: str, ms: float) -> None:
+        self.stages.append((name, ms))
+
+    def add_many(self, timings: Optional[Dict[str, float]]) -> None:
+        for name, ms in (timings or {}).items():
+            self.add(name, ms)
+
+    def server_timing(self) -> str:
+        # Server-Timing: db_read;dur=1.2, keyword;dur=0.1, ...
+        return ", ".join(f"{name};dur={ms:.1f}" for name, ms in self.stages)
+
+    def observe(self) -> None:
+        """幂等：流式请求在 generator 的 finally 里调，早退分支也可能调。"""
+        if self._observed:
+            return
+        self._observed = True
+        for name, ms in self.stages:
+            STAGE_SECONDS.labels(self.route, name, self.model, self.upstream).observe(ms / 1000.0)
+        REQUEST_SECONDS.labels(self.route, self.model, self.upstream).observe(time.perf_counter() - self._t0)
+
+
+def record_stage(route: str, stage: str, ms: float, *, model: str = "", upstream: str = "") -> None:
+    STAGE_SECONDS.labels(route, stage, model, upstream).observe(ms / 1000.0)
+
+
+def record_gateway_ctx_cache(hit: bool) -> None:
+    global _cache_hits, _cache_lookups
+    _cache_lookups += 1
+    if hit:
+        _cache_hits += 1
+    GATEWAY_CTX_CACHE.labels("hit" if hit else "miss").inc()
+    GATEWAY_CTX_CACHE_HIT_RATIO.set(_cache_hits / _cache_lookups)
+
+
+def record_summary_cache(hit: bool) -> None:
+    SUMMARY_CACHE.labels("hit" if hit else "miss").inc()
+
+
+def _refresh_celery_queue_lengths() -> None:
+    try:
+        import redis
+
+        from app.core.config import CELERY_BROKER_URL
+
+        client = redis.Redis.from_url(CELERY_BROKER_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+        for q in CELERY_METRICS_QUEUES:
+            CELERY_QUEUE_LENGTH.labels(q).set(client.llen(q))
+    except Exception as e:
+        # broker 不可达时不影响 /metrics 其他指标
+        print(f"[metrics] celery queue length unavailable err={e}")
+
+
+def _refresh_limiter_state() -> None:
+    from app.services.upstream_limiter import limiter_snapshots
+
+    for name, snap in limiter_snapshots().items():
+        for field, value in snap.items():
+            UPSTREAM_LIMITER_STATE.labels(name, field).set(value)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    _refresh_celery_queue_lengths()
+    _refresh_limiter_state()
+    return generate_latest(), CONTENT_TYPE_LATEST
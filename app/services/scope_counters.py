@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, case, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as OrmSession
+
+from app.db.models import Message, ScopeCounter
+
+# -----------------------------
+# scope_counters：S4/S60 触发判断 O(1) 读计数，不再每轮 COUNT(*)
+#
+# 语义与 chat_service._apply_scope_filters 完全一致：
+#   thread scope：session_id + thread_id（thread_id 为 None 时不过滤 thread）
+#   memory scope：memory_id / agent_id（None 的维度不过滤；两者都 None 时退化为 session 全量）
+# 所以一条消息会落到多个 key（精确 key + 各维度通配 key），插入时一起递增。
+# 计数行缺失时（新 scope / 未回填）用一次 COUNT 种子化，之后只做 +1。
+# -----------------------------
+
+SCOPE_COUNTERS_ENABLED = os.getenv("SCOPE_COUNTERS_ENABLED", "1") == "1"
+
+
+@dataclass(frozen=True)
+class ScopeSpec:
+    scope_type: str
+    session_id: Optional[str] = None
+    thread_id: Optional[str] = None
+    memory_id: Optional[str] = None
+    agent_id: Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        if self.scope_type == "thread":
+            return json.dumps(["thread", self.session_id, self.thread_id], ensure_ascii=False)
+        return json.dumps(["memory", self.memory_id, self.agent_id], ensure_ascii=False)
+
+
+def lookup_spec(
+    *,
+    session_id: str,
+    scope_type: str,
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+) -> ScopeSpec:
+    """读计数时用的 key（对应一次 _count_scoped_user_turns 查询）。"""
+    if scope_type == "memory":
+        if memory_id is None and agent_id is None:
+            # 和 COUNT 的安全兜底一致：退化为 session 全量
+            return ScopeSpec("thread", session_id=session_id)
+        return ScopeSpec("memory", memory_id=memory_id, agent_id=agent_id)
+    return ScopeSpec("thread", session_id=session_id, thread_id=thread_id)
+
+
+def specs_for_message(
+    *,
+    session_id: str,
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+) -> List[ScopeSpec]:
+    """一条消息会被哪些 scope 查询数到。"""
+    specs = [ScopeSpec("thread", session_id=session_id)]
+    if thread_id is not None:
+        specs.append(ScopeSpec("thread", session_id=session_id, thread_id=thread_id))
+    if memory_id is not None:
+        specs.append(ScopeSpec("memory", memory_id=memory_id))
+    if agent_id is not None:
+        specs.append(ScopeSpec("memory", agent_id=agent_id))
+    if memory_id is not None and agent_id is not None:
+        specs.append(ScopeSpec("memory", memory_id=memory_id, agent_id=agent_id))
+    return specs
+
+
+def _filter_messages(q, spec: ScopeSpec):
+    if spec.scope_type == "thread":
+        q = q.filter(Message.session_id == spec.session_id)
+        if spec.thread_id is not None:
+            q = q.filter(Message.thread_id == spec.thread_id)
+        return q
+    if spec.memory_id is not None:
+        q = q.filter(Message.memory_id == spec.memory_id)
+    if spec.agent_id is not None:
+        q = q.filter(Message.agent_id == spec.agent_id)
+    return q
+
+
+def count_from_messages(db: OrmSession, spec: ScopeSpec) -> Tuple[int, int]:
+    """(user_turns, tokens) 的真值：种子化 / 回填 / 一致性检查都用它。"""
+    q = db.query(
+        func.coalesce(func.sum(case((Message.role == "user", 1), else_=0)), 0),
+        func.coalesce(func.sum(Message.content_tokens), 0),
+    )
+    user_turns, tokens = _filter_messages(q, spec).one()
+    return int(user_turns or 0), int(tokens or 0)
+
+
+_counters = ScopeCounter.__table__
+# 所有 key 的增量相同：一条 UPDATE ... WHERE scope_key IN (...) 搞定（expanding bindparam，编译结果可缓存）
+_BUMP_STMT = (
+    update(_counters)
+    .where(_counters.c.scope_key.in_(bindparam("keys", expanding=True)))
+    .values(
+        user_turns=_counters.c.user_turns + bindparam("d_user_turns"),
+        tokens=_counters.c.tokens + bindparam("d_tokens"),
+        updated_at=bindparam("now"),
+    )
+)
+
+
+def _seed_row(db: OrmSession, spec: ScopeSpec, d_user_turns: int, d_tokens: int) -> int:
+    user_turns, tokens = count_from_messages(db, spec)
+    try:
+        with db.begin_nested():
+            db.add(ScopeCounter(
+                scope_key=spec.key,
+                scope_type=spec.scope_type,
+                session_id=spec.session_id,
+                thread_id=spec.thread_id,
+                memory_id=spec.memory_id,
+                agent_id=spec.agent_id,
+                user_turns=user_turns,
+                tokens=tokens,
+                updated_at=datetime.utcnow(),
+            ))
+    except IntegrityError:
+        # 并发种子化：别人先插了。对方的 COUNT 在本事务提交前执行，数不到本事务的消息，
+        # 所以这里照常把本轮增量加上去（和 _BUMP_STMT 同一条 UPDATE），返回加完后的值
+        params = {"keys": [spec.key], "d_user_turns": d_user_turns, "d_tokens": d_tokens, "now": datetime.utcnow()}
+        db.execute(_BUMP_STMT, params)
+        row = db.execute(select(_counters.c.user_turns).where(_counters.c.scope_key == spec.key)).first()
+        return int(row[0]) if row else user_turns
+    return user_turns
+
+
+def bump_scope_counters(
+    db: OrmSession,
+    *,
+    session_id: str,
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+    user_turns: int,
+    tokens: int,
+) -> Dict[str, int]:
+    """
+    在 message 插入的同一个事务里调用（调用前要 flush，种子化 COUNT 才数得到新消息）。
+    不 commit，由调用方统一提交。
+    返回 {scope_key: 递增后的 user_turns}，同一轮的触发判断直接用，不用再读一次。
+    """
+    if not SCOPE_COUNTERS_ENABLED:
+        return {}
+    specs = {s.key: s for s in specs_for_message(
+        session_id=session_id, thread_id=thread_id, memory_id=memory_id, agent_id=agent_id
+    )}
+    params = {"keys": list(specs), "d_user_turns": user_turns, "d_tokens": tokens, "now": datetime.utcnow()}
+    if db.get_bind().dialect.update_returning:
+        rows = db.execute(_BUMP_STMT.returning(_counters.c.scope_key, _counters.c.user_turns), params).all()
+    else:
+        db.execute(_BUMP_STMT, params)
+        rows = db.execute(
+            select(_counters.c.scope_key, _counters.c.user_turns).where(_counters.c.scope_key.in_(list(specs)))
+        ).all()
+    values = {k: int(n) for k, n in rows}
+    for key, spec in specs.items():
+        if key not in values:
+            values[key] = _seed_row(db, spec, user_turns, tokens)
+    return values
+
+
+def _read_counter(db: OrmSession, column: Any, **scope: Any) -> Optional[int]:
+    if not SCOPE_COUNTERS_ENABLED:
+        return None
+    spec = lookup_spec(**scope)
+    row = db.query(column).filter(ScopeCounter.scope_key == spec.key).first()
+    return int(row[0]) if row else None
+
+
+def get_scope_user_turns(
+    db: OrmSession,
+    *,
+    session_id: str,
+    scope_type: str,
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+) -> Optional[int]:
+    """O(1) 主键读；计数行不存在（或功能关闭）返回 None，调用方回退 COUNT。"""
+    return _read_counter(
+        db,
+        ScopeCounter.user_turns,
+        session_id=session_id,
+        scope_type=scope_type,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+    )
+
+
+def get_scope_tokens(
+    db: OrmSession,
+    *,
+    session_id: str,
+    scope_type: str,
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+) -> Optional[int]:
+    """同 get_scope_user_turns，读累计 content_tokens；None 时调用方回退 SUM。"""
+    return _read_counter(
+        db,
+        ScopeCounter.tokens,
+        session_id=session_id,
+        scope_type=scope_type,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+    )
+
+
+def all_message_specs(db: OrmSession) -> List[ScopeSpec]:
+    """从 messages 里枚举出所有应当存在的计数 key（回填用）。"""
+    seen: Dict[str, ScopeSpec] = {}
+    rows = db.query(Message.session_id, Message.thread_id, Message.memory_id, Message.agent_id).distinct().all()
+    for sid, tid, mid, aid in rows:
+        for spec in specs_for_message(session_id=sid, thread_id=tid, memory_id=mid, agent_id=aid):
+            seen.setdefault(spec.key, spec)
+    return list(seen.values())
+
+
+def rebuild_scope_counters(db: OrmSession) -> int:
+    """全量回填：按 messages 重算所有 key，覆盖写入。返回写入的行数。"""
+    n = 0
+    now = datetime.utcnow()
+    for spec in all_message_specs(db):
+        user_turns, tokens = count_from_messages(db, spec)
+        db.merge(ScopeCounter(
+            scope_key=spec.key,
+            scope_type=spec.scope_type,
+            session_id=spec.session_id,
+            thread_id=spec.thread_id,
+            memory_id=spec.memory_id,
+            agent_id=spec.agent_id,
+            user_turns=user_turns,
+            tokens=tokens,
+            updated_at=now,
+        ))
+        n += 1
+    db.commit()
+    return n
+
+
+def check_scope_counters(db: OrmSession, *, fix: bool = False) -> List[Dict[str, object]]:
+    """一致性检查：计数行 vs messages 真值。fix=True 时直接修正。"""
+    problems: List[Dict[str, object]] = []
+    for row in db.query(ScopeCounter).all():
+        spec = ScopeSpec(row.scope_type, row.session_id, row.thread_id, row.memory_id, row.agent_id)
+        user_turns, tokens = count_from_messages(db, spec)
+        if (row.user_turns, row.tokens) != (user_turns, tokens):
+            problems.append({
+                "scope_key": row.scope_key,
+                "counter": {"user_turns": row.user_turns, "tokens": row.tokens},
+                "actual": {"user_turns": user_turns, "tokens": tokens},
+            })
+            if fix:
+                row.user_turns, row.tokens, row.updated_at = user_turns, tokens, datetime.utcnow()
+    if fix and problems:
+        db.commit()
+    return problems
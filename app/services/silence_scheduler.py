@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import json
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy.orm import Session as OrmSession
+
+from app.core.config import SILENCE_SCHEDULER_BACKEND
+from app.core.tracing import inject_headers
+from app.db.models import Message, Session as ChatSession, TriggerJob
+
+# -----------------------------
+# 沉默触发的事件驱动调度
+#
+# 以前 scan_triggers 每分钟把所有 proactive_enabled 的 session 捞出来、每个查两次（最后一条 user 消息、
+# 最近一次 silence job），没人沉默也是 O(sessions) 的活。现在：
+#   - chat_once 提交后把这个 session 的沉默截止时间（现在 + silence_threshold_min）写进 Redis ZSET
+#     （同一个 member 再写就是顺延）
+#   - dispatch_silence_triggers（beat 每 SILENCE_DISPATCH_SECS 秒）只弹出已到期的 session，
+#     按原规则（阈值 + 冷却）复核后建 TriggerJob；没到 / 在冷却期就按算出来的下一个时间点重新排上
+#   - scan_triggers 保留，降频成对账（SILENCE_SCAN_SECS）：补上漏排的（Redis 丢数据、
+#     proactive 开关在没有新消息时打开等），并顺手把下一次截止时间重新写回 ZSET
+#
+# SILENCE_SCHEDULER_BACKEND（app/core/config.py）：redis -> 上面这套；none（默认）-> 和以前一样每分钟全量扫描
+# SILENCE_DISPATCH_SECS（10）/ SILENCE_SCAN_SECS（redis 时 900，否则 60）：beat 定时，见 celery_app
+# SILENCE_SCHEDULER_REDIS_URL：默认 REDIS_URL
+# -----------------------------
+
+SILENCE_DISPATCH_BATCH = int(os.getenv("SILENCE_DISPATCH_BATCH", "200"))
+DEFAULT_SILENCE_THRESHOLD_MIN = 240
+DEFAULT_SILENCE_COOLDOWN_MIN = 120
+
+_ZSET = "silence:deadlines"
+# 取出到期的并同时删掉：多个 dispatcher 并发时每个 session 只会被一个拿到
+_POP_DUE = """
+local ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #ids > 0 then
+    redis.call('zrem', KEYS[1], unpack(ids))
+end
+return ids
+"""
+
+_redis_client = None
+
+
+def scheduler_enabled() -> bool:
+    return SILENCE_SCHEDULER_BACKEND == "redis"
+
+
+def _redis():
+    global _redis_client
+    if _redis_client is None:
+        import redis
+
+        from app.core.config import REDIS_URL
+
+        url = os.getenv("SILENCE_SCHEDULER_REDIS_URL", "") or REDIS_URL
+        _redis_client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis_client
+
+
+def _epoch(dt: datetime) -> float:
+    # 库里的时间都是 naive UTC
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+def schedule_silence(session_id: str, due_at: datetime) -> None:
+    """(重新)排上这个 session 的沉默截止时间。失败只打日志：对账扫描会补上。"""
+    if not scheduler_enabled():
+        return
+    try:
+        _redis().zadd(_ZSET, {session_id: _epoch(due_at)})
+    except Exception as e:
+        print(f"[silence_scheduler] schedule failed session_id={session_id} err={e!r}")
+
+
+def schedule_silence_many(deadlines: List[Tuple[str, datetime]]) -> None:
+    if not scheduler_enabled() or not deadlines:
+        return
+    try:
+        _redis().zadd(_ZSET, {sid: _epoch(due_at) for sid, due_at in deadlines})
+    except Exception as e:
+        print(f"[silence_scheduler] schedule failed n={len(deadlines)} err={e!r}")
+
+
+def pop_due_silence(now: datetime, limit: int = SILENCE_DISPATCH_BATCH) -> List[str]:
+    raw = _redis().eval(_POP_DUE, 1, _ZSET, _epoch(now), limit)
+    return [x.decode("utf-8") if isinstance(x, bytes) else x for x in raw or []]
+
+
+def evaluate_silence(db: OrmSession, s: ChatSession, now: datetime) -> Tuple[bool, Optional[datetime]]:
+    """
+    规则：最后一次 user 消息距今 >= threshold，且 cooldown 内没有有效的 silence job -> 建一个 TriggerJob（只 add）。
+    返回 (是否建了 job, 下一次需要再看的时间)；没有 user 消息时下一次为 None（等新消息来排）。
+    """
+    threshold_minutes = s.silence_threshold_min or DEFAULT_SILENCE_THRESHOLD_MIN
+    cooldown_minutes = s.silence_cooldown_min or DEFAULT_SILENCE_COOLDOWN_MIN
+
+    last_user = (db.query(Message.created_at)
+                 .filter(Message.session_id == s.id, Message.role == "user")
+                 .order_by(Message.turn_id.desc())
+                 .first())
+    if not last_user:
+        return False, None
+    last_user_at = last_user.created_at.replace(tzinfo=None)
+
+    silence_minutes = (now - last_user_at).total_seconds() / 60.0
+    if silence_minutes < threshold_minutes:
+        return False, last_user_at + timedelta(minutes=threshold_minutes)
+
+    # 冷却期（只看有效状态的任务）
+    recent_job = (db.query(TriggerJob.created_at)
+                  .filter(
+                      TriggerJob.session_id == s.id,
+                      TriggerJob.trigger_type == "silence",
+                      TriggerJob.status.in_(["queued", "running", "done"])
+                  )
+                  .order_by(TriggerJob.created_at.desc())
+                  .first())
+    if recent_job:
+        cooldown_until = recent_job.created_at + timedelta(minutes=cooldown_minutes)
+        if now < cooldown_until:
+            return False, cooldown_until
+
+    payload = {
+        "silence_minutes": round(silence_minutes, 1),
+        "threshold_minutes": threshold_minutes,
+        "cooldown_minutes": cooldown_minutes,
+    }
+    db.add(TriggerJob(
+        session_id=s.id,
+        trigger_type="silence",
+        trigger_payload_json=json.dumps(payload, ensure_ascii=False),
+        status="queued",
+        created_at=now,
+        # 记下创建时的 trace，process_trigger_jobs 处理时作为 span link 关联回来
+        meta_json=json.dumps({"trace": inject_headers()}, ensure_ascii=False),
+    ))
+    # 一直沉默的话，冷却期过后再提醒一次（和以前每分钟扫描的效果一致）
+    return True, now + timedelta(minutes=cooldown_minutes)
+
+
+def dispatch_due_silence(db: OrmSession, now: datetime) -> dict:
+    """弹出到期的 session，复核后建 job，并把下一次时间排回去。"""
+    session_ids = pop_due_silence(now)
+    if not session_ids:
+        return {"due": 0, "created": 0}
+    created = 0
+    deadlines: List[Tuple[str, datetime]] = []
+    try:
+        for s in db.query(ChatSession).filter(ChatSession.id.in_(session_ids)).all():
+            # 关掉 proactive 的直接丢掉（重新打开后由对账扫描或下一条消息排上）
+            if not s.proactive_enabled:
+                continue
+            made, next_due = evaluate_silence(db, s, now)
+            created += made
+            if next_due is not None:
+                deadlines.append((s.id, next_due))
+        db.commit()
+    except Exception:
+        # 已经从 ZSET 里弹出来了：原样排回去（仍然到期），下一轮 dispatch 重试，不用等对账扫描
+        schedule_silence_many([(sid, now) for sid in session_ids])
+        raise
+    schedule_silence_many(deadlines)
+    return {"due": len(session_ids), "created": created}
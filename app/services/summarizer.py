@@ -1,18 +1,39 @@
 import json
 import logging
 import os
-from collections import deque
+import random
+import re
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import requests
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 
+from app.core.tracing import SpanKind, inject_headers, start_span, traced
 from app.db.models import Message, SummaryS4, SummaryS60
+from app.services.debug_events import debug_enabled, lazy, push_debug_event, read_debug_events
+from app.services.latest_summaries import invalidate_latest_summaries
+from app.services.metrics import record_summary_cache
+from app.services.summarizer_client import post_chat_completions
+from app.services.summary_lock import summary_lease
+from app.services.summary_cache import cache_enabled, cache_get, cache_key, cache_put, cache_stats
+from app.services.tokenizer import count_tokens
+from app.services.transcript import S4_INPUT_MAX_TOKENS, S60_INPUT_MAX_TOKENS, budget_lines, build_transcript
 
 
 logger = logging.getLogger(__name__)
-_DEBUG_EVENTS: deque = deque(maxlen=200)
+
+# S60 输入来源：hierarchical（默认）= 上一段 S60 + 窗口内已有的 S4 + 未覆盖部分的原文；raw = 整段原文
+S60_MODE = (os.getenv("S60_MODE", "hierarchical") or "hierarchical").strip().lower()
+# 窗口内被 S4 覆盖的消息比例低于这个值时直接用原文（省不了多少，还多一层信息损失）
+S60_HIER_MIN_COVERAGE = float(os.getenv("S60_HIER_MIN_COVERAGE", "0.5"))
+# S4 模式按 summary_version 区分：2 = 每次整窗重算；3 = 增量（上一版 S4 + 之后新增的消息）
+S4_FULL_VERSION = 2
+S4_INCREMENTAL_VERSION = 3
+# 增量链最多连续这么多次，之后做一次整窗重算，防止误差一路累积
+S4_FULL_REFRESH_EVERY = int(os.getenv("S4_FULL_REFRESH_EVERY", "6"))
 
 
 
@@ -20,21 +41,14 @@ SUMMARY_VALUE_FIELDS: Tuple[str, ...] = ("goal", "state", "open_loops", "constra
 SUMMARY_LIST_FIELDS: Tuple[str, ...] = ("open_loops", "constraints", "tone_notes")
 
 
-def _push_debug_event(event: Dict[str, Any]) -> None:
-    try:
-        payload = {"ts": _now().isoformat(), **(event or {})}
-        _DEBUG_EVENTS.append(payload)
-    except Exception:
-        pass
+def _push_debug_event(event: Dict[str, Any], *, extra=None) -> None:
+    """事件存储见 debug_events；extra 是快照回调，会话没被抽中时不会调用。"""
+    push_debug_event(event, extra=extra)
 
 
 def get_recent_debug_events(session_id: Optional[str] = None, limit: int = 80) -> List[Dict[str, Any]]:
-    items = list(_DEBUG_EVENTS)
-    if session_id:
-        items = [x for x in items if x.get("session_id") in (None, session_id)]
-    if limit > 0:
-        items = items[-limit:]
-    return items
+    events, _ = read_debug_events(session_id, limit=limit)
+    return events
 
 # ===== 在文件顶部 imports 下面（或任意位置）新增 =====
 
@@ -145,24 +159,37 @@ def _summary_debug_snapshot(obj: Dict[str, Any]) -> Dict[str, Any]:
     return snapshot
 
 
+# 单次扫描的分类器 / 计数：都是预编译正则（C 层扫描），干净文本不分配任何东西
+_MOJIBAKE_MARKER_CHARS = "ÃÂæåèçäð"
+_SUSPECT_RE = re.compile("[" + _MOJIBAKE_MARKER_CHARS + "\u0080-\u009f]")
+_MARKER_RE = re.compile("[" + _MOJIBAKE_MARKER_CHARS + "]")
+_CTRL_RE = re.compile("[\u0080-\u009f]")
+_CJK_RE = re.compile("[\u4e00-\u9fff]")
+_BAD_LATIN_RUN_RE = re.compile("[æåèçÃÂ]+")
+# 早期 "中文足够就跳过" 判断用的标记（不含 è，和原实现一致）
+_STRONG_MARKER_RE = re.compile("[ÃÂæäåçð]")
+# 重编码搜索上限：最多 4 轮、每轮每个种子 2 种源编码，理论上限 31 个候选
+_RECODE_MAX_CANDIDATES = 32
+
+
+def _count_matches(pattern: "re.Pattern[str]", s: str) -> int:
+    return sum(1 for _ in pattern.finditer(s))
+
+
 def _count_cjk_chars(s: str) -> int:
-    return sum(1 for ch in s if "一" <= ch <= "鿿")
+    return _count_matches(_CJK_RE, s)
 
 
 def _strip_ctrl(s: str) -> str:
     # 去掉 U+0080..U+009F 控制字符（常见转码噪声）
-    return "".join(ch for ch in s if not ("\u0080" <= ch <= "\u009f"))
+    return _CTRL_RE.sub("", s) if _CTRL_RE.search(s) else s
 
 
 def _mojibake_score(text: str) -> int:
     if not text:
         return 0
     # 兼容两边：常见“UTF-8 被按 latin-1/cp1252 解码”污染标记 + 控制符噪声 + 异常拉丁串
-    marker_chars = ("Ã", "Â", "æ", "å", "è", "ç", "ä", "ð")
-    marker_hits = sum(text.count(m) for m in marker_chars)
-    ctrl_hits = _ctrl_char_count(text)
-    bad_latin_runs = _bad_latin_run_count(text)
-    return marker_hits + ctrl_hits + bad_latin_runs
+    return _count_matches(_MARKER_RE, text) + _ctrl_char_count(text) + _bad_latin_run_count(text)
 
 
 def _mojibake_markers_hit(text: str) -> List[str]:
@@ -170,8 +197,7 @@ def _mojibake_markers_hit(text: str) -> List[str]:
         return []
 
     hits: List[str] = []
-    marker_chars = ("Ã", "Â", "æ", "å", "è", "ç", "ä", "ð")
-    for marker in marker_chars:
+    for marker in ("Ã", "Â", "æ", "å", "è", "ç", "ä", "ð"):
         count = text.count(marker)
         if count > 0:
             hits.append(f"char:{marker}x{count}")
@@ -188,27 +214,18 @@ def _mojibake_markers_hit(text: str) -> List[str]:
 
 
 def _ctrl_char_count(text: str) -> int:
-    return sum(1 for ch in text if "\u0080" <= ch <= "\u009f")
+    return _count_matches(_CTRL_RE, text)
 
 
 def _bad_latin_run_count(text: str) -> int:
-    bad_chars = {"æ", "å", "è", "ç", "Ã", "Â"}
-    run_count = 0
-    in_run = False
-    for ch in text:
-        if ch in bad_chars:
-            if not in_run:
-                run_count += 1
-                in_run = True
-        else:
-            in_run = False
-    return run_count
+    return _count_matches(_BAD_LATIN_RUN_RE, text)
 
 
 def _looks_mojibake_text(text: str) -> bool:
-    return _mojibake_score(text) > 0 or _ctrl_char_count(text) > 0
+    return _SUSPECT_RE.search(text) is not None
 
 
+@lru_cache(maxsize=4096)
 def _try_recode(s: str, src: str) -> Optional[str]:
     byte_candidates = []
     for seed in (s, _strip_ctrl(s)):
@@ -227,39 +244,44 @@ def _try_recode(s: str, src: str) -> Optional[str]:
     return None
 
 
-def _maybe_repair_mojibake_text(
-    text: str,
-    *,
-    session_id: Optional[str] = None,
-    field_path: Optional[str] = None,
-) -> str:
-    """尝试修复“UTF-8 bytes 被按 latin-1/cp1252 解码后再传输”的文本污染。"""
-    if not text:
-        return text
+def _text_metrics(s: str) -> Dict[str, int]:
+    return {
+        "cjk_count": _count_cjk_chars(s),
+        "mojibake_marker_count": _mojibake_score(s),
+        "replacement_char_count": s.count("�"),
+        "ctrl_char_count": _ctrl_char_count(s),
+        "bad_latin_runs": _bad_latin_run_count(s),
+    }
 
+
+def _metrics_ordering_key(m: Dict[str, int]) -> Tuple[int, int, int, int, int]:
+    # 优先级：CJK 更多 > mojibake 更少 > 控制/替换字符更少 > 异常拉丁串更少
+    return (
+        m["cjk_count"],
+        -m["mojibake_marker_count"],
+        -(m["ctrl_char_count"] + m["replacement_char_count"]),
+        -m["bad_latin_runs"],
+        -m["replacement_char_count"],
+    )
+
+
+@lru_cache(maxsize=2048)
+def _repair_decision(text: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    可疑文本的修复结果（按字符串 hash 记忆化；同一段乱码在 summary 各字段 / 重试里反复出现）。
+    返回 (修复后文本, repair.decision 事件里和调用位置无关的部分；无需记录时为 None)。
+    """
     # 如果本来中文就足够、且没有明显 mojibake 标记，就只做控制字符清理
-    bad_markers = ("Ã", "Â", "æ", "ä", "å", "ç", "ð")
-    if _count_cjk_chars(text) >= 2 and not any(m in text for m in bad_markers):
-        return _strip_ctrl(text)
+    if _count_cjk_chars(text) >= 2 and not _STRONG_MARKER_RE.search(text):
+        return _strip_ctrl(text), None
 
-    def metrics(s: str) -> Dict[str, int]:
-        return {
-            "cjk_count": _count_cjk_chars(s),
-            "mojibake_marker_count": _mojibake_score(s),
-            "replacement_char_count": s.count("�"),
-            "ctrl_char_count": _ctrl_char_count(s),
-            "bad_latin_runs": _bad_latin_run_count(s),
-        }
+    scored: Dict[str, Dict[str, int]] = {}
 
-    def ordering_key(m: Dict[str, int]) -> tuple[int, int, int, int, int]:
-        # 优先级：CJK 更多 > mojibake 更少 > 控制/替换字符更少 > 异常拉丁串更少
-        return (
-            m["cjk_count"],
-            -m["mojibake_marker_count"],
-            -(m["ctrl_char_count"] + m["replacement_char_count"]),
-            -m["bad_latin_runs"],
-            -m["replacement_char_count"],
-        )
+    def metrics(s: str) -> Dict[str, int]:
+        m = scored.get(s)
+        if m is None:
+            m = scored[s] = _text_metrics(s)
+        return m
 
     original_score = _mojibake_score(text)
     max_rounds = 2 + (1 if original_score > 2 else 0) + (1 if original_score > 5 else 0)
@@ -278,20 +300,18 @@ def _maybe_repair_mojibake_text(
         if not next_round:
             break
         candidates.update(next_round)
+        if len(candidates) >= _RECODE_MAX_CANDIDATES:
+            break
 
     for candidate in candidates:
         cleaned = _strip_ctrl(candidate)
         current_metrics = metrics(cleaned)
 
         # 统一按指标排序，选择最优候选。
-        if ordering_key(current_metrics) > ordering_key(best_metrics):
+        if _metrics_ordering_key(current_metrics) > _metrics_ordering_key(best_metrics):
             best = cleaned
             best_metrics = current_metrics
 
-    # 若没有获得任何提升，保留原文本（仅清理控制字符）避免过修复
-    if not _looks_mojibake_text(text):
-        return _strip_ctrl(text)
-
     base_clean = _strip_ctrl(text)
     latin1_utf8 = _try_recode(base_clean, "latin-1")
     cp1252_utf8 = _try_recode(base_clean, "cp1252")
@@ -323,22 +343,33 @@ def _maybe_repair_mojibake_text(
         else:
             reason = "better_ordering_score"
 
-    _push_debug_event(
-        {
-            "stage": "repair.decision",
-            "session_id": session_id,
-            "field_path": field_path,
-            "raw_preview": text[:120],
-            "candidate_scores": candidate_scores,
-            "chosen": chosen,
-            "reason": reason,
-            "selected_preview": best[:120],
-            "total_candidates": len(candidates),
-            "max_rounds": max_rounds,
-        }
-    )
+    event = {
+        "raw_preview": text[:120],
+        "candidate_scores": candidate_scores,
+        "chosen": chosen,
+        "reason": reason,
+        "selected_preview": best[:120],
+        "total_candidates": len(candidates),
+        "max_rounds": max_rounds,
+    }
+    return _strip_ctrl(best), event
 
-    return _strip_ctrl(best)
+
+def _maybe_repair_mojibake_text(
+    text: str,
+    *,
+    session_id: Optional[str] = None,
+    field_path: Optional[str] = None,
+) -> str:
+    """尝试修复“UTF-8 bytes 被按 latin-1/cp1252 解码后再传输”的文本污染。"""
+    # 快速路径：没有任何标记字符 / 控制字符 -> 原样返回（绝大多数字段走这里）
+    if not text or _SUSPECT_RE.search(text) is None:
+        return text
+
+    repaired, event = _repair_decision(text)
+    if event is not None:
+        _push_debug_event({"stage": "repair.decision", "session_id": session_id, "field_path": field_path, **event})
+    return repaired
 
 
 def _repair_mojibake_in_obj(
@@ -365,69 +396,47 @@ def _repair_mojibake_in_obj(
 # ========= LLM（OpenAI-Compatible）=========
 
 
-def call_llm_json(
-    *,
-    system: str,
-    user: str,
-    model: str,
-    base_url: str,
-    api_key: str,
-    temperature: float = 0.2,
-    timeout_s: int = 45,
-    session_id: Optional[str] = None,
-) -> Dict[str, Any]:
-    """调用 OpenAI-compatible 的 /chat/completions，要求返回 JSON。
-
-    - 兼容 OpenRouter、LiteLLM、各种中转。
-    - 失败会抛异常，外层会记录 failed。
-    """
-
-    url = base_url.rstrip("/") + "/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
+# 响应诊断（原始字节 hex、requests 的编码探测、两次解码对比）只对抽样请求做；
+# SUMMARIZER_DEBUG=1 时全量，SUMMARIZER_DIAG_SAMPLE_RATE 为抽样比例（默认 0）
+SUMMARIZER_DEBUG = os.getenv("SUMMARIZER_DEBUG", "0") == "1"
+SUMMARIZER_DIAG_SAMPLE_RATE = float(os.getenv("SUMMARIZER_DIAG_SAMPLE_RATE", "0"))
+_MOJIBAKE_MARKERS = ("Ã", "Â", "æ", "ä", "å", "ç", "ð", "\u0085")
 
-    payload = {
-        "model": model,
-        "temperature": temperature,
-        "messages": [
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-        # 强制 JSON（多数兼容实现都支持；不支持也没关系，我们后面会兜底解析）
-        "response_format": {"type": "json_object"},
-    }
 
-    r = requests.post(url, headers=headers, json=payload, timeout=timeout_s)
-    r.raise_for_status()
+def _diagnostics_sampled() -> bool:
+    if SUMMARIZER_DEBUG:
+        return True
+    return SUMMARIZER_DIAG_SAMPLE_RATE > 0 and random.random() < SUMMARIZER_DIAG_SAMPLE_RATE
 
-    raw = r.content
-    text = raw.decode("utf-8", errors="replace")
 
+def _log_llm_response_diagnostics(r: Any, raw: bytes, text: str, *, session_id: Optional[str]) -> None:
+    # r.text / apparent_encoding 会触发 requests 的编码探测，只在这里用
+    requests_text = r.text or ""
+    apparent_encoding = getattr(r, "apparent_encoding", None)
     logger.warning(
         "LLM raw response diagnostics status=%s content_type=%s requests_encoding=%s apparent_encoding=%s raw_hex=%s text_preview=%r utf8_preview=%r",
         r.status_code,
         r.headers.get("content-type"),
         getattr(r, "encoding", None),
-        getattr(r, "apparent_encoding", None),
+        apparent_encoding,
         raw[:120].hex(),
-        (r.text or "")[:120],
+        requests_text[:120],
         text[:120],
     )
     _push_debug_event(
         {
             "stage": "call_llm_json.raw_response",
+            "session_id": session_id,
             "content_type": r.headers.get("content-type"),
             "requests_encoding": getattr(r, "encoding", None),
-            "apparent_encoding": getattr(r, "apparent_encoding", None),
+            "apparent_encoding": apparent_encoding,
             "raw_hex_120": raw[:120].hex(),
-            "requests_text_120": (r.text or "")[:120],
+            "requests_text_120": requests_text[:120],
             "forced_utf8_120": text[:120],
         }
     )
 
-    if any(m in text[:200] for m in ("Ã", "Â", "æ", "ä", "å", "ç", "ð", "\u0085")):
+    if any(m in text[:200] for m in _MOJIBAKE_MARKERS):
         logger.warning(
             "LLM raw response looks mojibake content_type=%s raw_hex=%s utf8_preview=%r",
             r.headers.get("content-type"),
@@ -435,20 +444,86 @@ def call_llm_json(
             text[:120],
         )
 
-    if r.text and text and r.text[:120] != text[:120]:
+    if requests_text and text and requests_text[:120] != text[:120]:
         logger.warning(
             "LLM response decode mismatch requests_text_preview=%r forced_utf8_preview=%r",
-            r.text[:120],
+            requests_text[:120],
             text[:120],
         )
         _push_debug_event(
             {
                 "stage": "call_llm_json.decode_mismatch",
-                "requests_text_120": r.text[:120],
+                "session_id": session_id,
+                "requests_text_120": requests_text[:120],
                 "forced_utf8_120": text[:120],
             }
         )
 
+
+def call_llm_json(
+    *,
+    system: str,
+    user: str,
+    model: str,
+    base_url: str,
+    api_key: str,
+    temperature: float = 0.2,
+    timeout_s: int = 45,
+    session_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """调用 OpenAI-compatible 的 /chat/completions，要求返回 JSON。
+
+    - 兼容 OpenRouter、LiteLLM、各种中转。
+    - 失败会抛异常，外层会记录 failed。
+    """
+
+    key = cache_key(system=system, user=user, model=model, temperature=temperature)
+    if cache_enabled():
+        cached = cache_get(key)
+        record_summary_cache(cached is not None)
+        _push_debug_event(
+            {
+                "stage": "call_llm_json.cache",
+                "session_id": session_id,
+                "hit": cached is not None,
+                "key": key[:16],
+                **cache_stats(),
+            }
+        )
+        if cached is not None:
+            return cached
+
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+
+    payload = {
+        "model": model,
+        "temperature": temperature,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ],
+        # 强制 JSON（多数兼容实现都支持；不支持时 client 会去掉再发，后面还有兜底解析）
+        "response_format": {"type": "json_object"},
+    }
+
+    with start_span("summarizer.llm", kind=SpanKind.CLIENT, attributes={"llm.model": model}) as span:
+        r = post_chat_completions(base_url, headers=inject_headers(headers), payload=payload, timeout_s=timeout_s)
+        span.set_attribute("http.status_code", r.status_code)
+        span.set_attribute("llm.attempts", getattr(r, "attempts", 1))
+        r.raise_for_status()
+
+    raw = r.content
+    text = raw.decode("utf-8", errors="replace")
+
+    # 诊断只在抽样命中或看起来像乱码时才做（稳态不付 hex / 编码探测的代价）；
+    # 每个响应只抽一次，原始字节诊断和下面的 content 调试事件要么一起出、要么都不出
+    sampled = _diagnostics_sampled()
+    if sampled or any(m in text[:200] for m in _MOJIBAKE_MARKERS):
+        _log_llm_response_diagnostics(r, raw, text, session_id=session_id)
+
     try:
         data = json.loads(text)
     except json.JSONDecodeError as e:
@@ -471,22 +546,33 @@ def call_llm_json(
         content = content.strip("`")
         content = content.replace("json\n", "", 1).strip()
 
-    _push_debug_event(
-        {
-            "stage": "call_llm_json.message_content",
-            "session_id": session_id,
-            "content_raw_preview_240": _truncate_preview(content, limit=240),
-            "content_raw_hex_120b": _truncate_hex_bytes(content, limit_bytes=120),
-        }
-    )
+    if sampled and debug_enabled(session_id):
+        _push_debug_event(
+            {
+                "stage": "call_llm_json.message_content",
+                "session_id": session_id,
+                "content_raw_preview_240": _truncate_preview(content, limit=240),
+                "content_raw_hex_120b": _truncate_hex_bytes(content, limit_bytes=120),
+            }
+        )
 
     if not content:
         raise RuntimeError(f"LLM empty content: {data}")
 
     try:
-        return json.loads(content)
+        obj = json.loads(content)
     except Exception as e:
-        raise RuntimeError(f"LLM returned non-JSON: {content[:200]}...") from e
+        # 没有 JSON mode 的上游常在 JSON 前后带说明文字：取最外层的 {...} 再试一次
+        lo, hi = content.find("{"), content.rfind("}")
+        try:
+            if lo < 0 or hi <= lo:
+                raise ValueError("no JSON object")
+            obj = json.loads(content[lo:hi + 1])
+        except Exception:
+            raise RuntimeError(f"LLM returned non-JSON: {content[:200]}...") from e
+    if isinstance(obj, dict):
+        cache_put(key, obj, model=model)
+    return obj
 
 
 def _repair_summary_value_fields(
@@ -554,7 +640,7 @@ def _default_summary_schema() -> Dict[str, Any]:
     }
 
 
-def _render_transcript(msgs: List[Message]) -> str:
+def _render_transcript(msgs: List[Any]) -> str:
     lines = []
     for m in msgs:
         role = m.role
@@ -563,7 +649,7 @@ def _render_transcript(msgs: List[Message]) -> str:
     return "\n".join(lines)
 
 
-def _summarize_with_optional_llm(transcript: str, *, level: str) -> Dict[str, Any]:
+def _summarize_with_optional_llm(transcript: str, *, level: str, instructions: str = "") -> Dict[str, Any]:
     """有配置就用 LLM，没配置就返回占位 schema（保证系统仍然跑通）。"""
 
     base_url = os.getenv("SUMMARIZER_BASE_URL", "").strip()
@@ -588,6 +674,7 @@ def _summarize_with_optional_llm(transcript: str, *, level: str) -> Dict[str, An
     user = (
         f"请对下面对话做{level}总结，输出 JSON。\n"
         "注意：不要使用‘寻求经济帮助/请求资助/对方愿意帮忙’等推断性措辞，除非原文明确提出。"
+        f"{instructions}"
         "\n\n--- 对话 ---\n"
         f"{transcript}\n"
         "--- 结束 ---"
@@ -611,8 +698,13 @@ def _summarize_s4_with_debug_events(
     *,
     session_id: str,
     to_turn: int,
+    previous: Optional[Dict[str, Any]] = None,
+    previous_to_turn: Optional[int] = None,
 ) -> Dict[str, Any]:
-    """S4 专用总结流程，拆分 raw/sanitize/repair 三阶段并记录事件。"""
+    """
+    S4 专用总结流程，拆分 raw/sanitize/repair 三阶段并记录事件。
+    传了 previous 就是增量模式：transcript 只包含 previous_to_turn 之后的新消息，在上一版基础上更新。
+    """
 
     base_url = os.getenv("SUMMARIZER_BASE_URL", "").strip()
     api_key = os.getenv("SUMMARIZER_API_KEY", "").strip()
@@ -620,30 +712,9 @@ def _summarize_s4_with_debug_events(
 
     if not base_url or not api_key:
         fallback = _default_summary_schema()
-        _push_debug_event(
-            {
-                "stage": "summary_from_llm_raw",
-                "session_id": session_id,
-                "to_turn": to_turn,
-                **_summary_debug_snapshot(fallback),
-            }
-        )
-        _push_debug_event(
-            {
-                "stage": "summary_after_sanitize",
-                "session_id": session_id,
-                "to_turn": to_turn,
-                **_summary_debug_snapshot(fallback),
-            }
-        )
-        _push_debug_event(
-            {
-                "stage": "summary_after_repair",
-                "session_id": session_id,
-                "to_turn": to_turn,
-                **_summary_debug_snapshot(fallback),
-            }
-        )
+        snapshot = lazy(lambda: _summary_debug_snapshot(fallback))
+        for stage in ("summary_from_llm_raw", "summary_after_sanitize", "summary_after_repair"):
+            _push_debug_event({"stage": stage, "session_id": session_id, "to_turn": to_turn}, extra=snapshot)
         return fallback
 
     system = (
@@ -658,13 +729,30 @@ def _summarize_s4_with_debug_events(
         "5) 如果信息不足，宁可写‘无明显推进/未提及’，不要编造。"
     )
 
-    user = (
-        "请对下面对话做短期总结，输出 JSON。\n"
-        "注意：不要使用‘寻求经济帮助/请求资助/对方愿意帮忙’等推断性措辞，除非原文明确提出。"
-        "\n\n--- 对话 ---\n"
-        f"{transcript}\n"
-        "--- 结束 ---"
-    )
+    if previous is None:
+        user = (
+            "请对下面对话做短期总结，输出 JSON。\n"
+            "注意：不要使用‘寻求经济帮助/请求资助/对方愿意帮忙’等推断性措辞，除非原文明确提出。"
+            "\n\n--- 对话 ---\n"
+            f"{transcript}\n"
+            "--- 结束 ---"
+        )
+        source_text = transcript
+    else:
+        previous_json = _safe_json_dumps(previous)
+        user = (
+            f"下面是截至 turn {previous_to_turn} 的上一版短期总结（JSON），以及此后新增的对话。"
+            "请在上一版基础上更新，输出完整的新 JSON：仍然成立的保留，已解决的 open_loops 移除，"
+            "新出现的目标/状态/约束覆盖旧的。\n"
+            "注意：不要使用‘寻求经济帮助/请求资助/对方愿意帮忙’等推断性措辞，除非原文明确提出。"
+            "\n\n--- 上一版总结 ---\n"
+            f"{previous_json}\n"
+            "--- 新增对话 ---\n"
+            f"{transcript}\n"
+            "--- 结束 ---"
+        )
+        # 上一版已经过 sanitize，合起来作为"原文"检查求助类措辞
+        source_text = f"{previous_json}\n{transcript}"
 
     raw_obj = call_llm_json(
         system=system,
@@ -680,18 +768,18 @@ def _summarize_s4_with_debug_events(
             "stage": "summary_from_llm_raw",
             "session_id": session_id,
             "to_turn": to_turn,
-            **_summary_debug_snapshot(raw_obj),
-        }
+        },
+        extra=lambda: _summary_debug_snapshot(raw_obj),
     )
 
-    sanitized_obj = _sanitize_summary(transcript, raw_obj)
+    sanitized_obj = _sanitize_summary(source_text, raw_obj)
     _push_debug_event(
         {
             "stage": "summary_after_sanitize",
             "session_id": session_id,
             "to_turn": to_turn,
-            **_summary_debug_snapshot(sanitized_obj),
-        }
+        },
+        extra=lambda: _summary_debug_snapshot(sanitized_obj),
     )
 
     repaired_obj = _repair_summary_with_rollback(
@@ -704,13 +792,25 @@ def _summarize_s4_with_debug_events(
             "stage": "summary_after_repair",
             "session_id": session_id,
             "to_turn": to_turn,
-            **_summary_debug_snapshot(repaired_obj),
-        }
+        },
+        extra=lambda: _summary_debug_snapshot(repaired_obj),
     )
 
     return repaired_obj
 
 
+# 窗口消息只取这些列：渲染 transcript + turn 范围 + 追溯 thread/memory/agent，不构造 ORM 对象
+_WINDOW_COLUMNS = (
+    Message.turn_id,
+    Message.user_turn,
+    Message.role,
+    Message.content,
+    Message.thread_id,
+    Message.memory_id,
+    Message.agent_id,
+)
+
+
 def _build_scope_query(
     db: Session,
     *,
@@ -719,8 +819,9 @@ def _build_scope_query(
     thread_id: Optional[str],
     memory_id: Optional[str],
     agent_id: Optional[str],
+    columns: Optional[Tuple[Any, ...]] = None,
 ):
-    q = db.query(Message).filter(Message.session_id == session_id)
+    q = db.query(*(columns or (Message,))).filter(Message.session_id == session_id)
 
     if scope_type == "thread":
         if thread_id is not None:
@@ -744,8 +845,38 @@ def _resolve_scope_user_turns(
     thread_id: Optional[str],
     memory_id: Optional[str],
     agent_id: Optional[str],
+    exact_window: bool = False,
 ) -> List[int]:
-    user_turn_rows = (
+    """
+    scope 内最近 window_user_turn 个不同的 user_turn（升序）。
+    只读 user_turn 一列、按 turn_id 倒序只取窗口大小（走覆盖索引），不再把整段历史连正文一起读出来。
+    exact_window=True（回填历史）：窗口结束在 scope 内第 to_user_turn 条 user 消息，而不是最新一条。
+    """
+    want = min(int(to_user_turn), int(window_user_turn))
+    if want <= 0:
+        return []
+
+    if exact_window:
+        rows = (
+            _build_scope_query(
+                db,
+                session_id=session_id,
+                scope_type=scope_type,
+                thread_id=thread_id,
+                memory_id=memory_id,
+                agent_id=agent_id,
+                columns=(Message.user_turn,),
+            )
+            .filter(Message.role == "user")
+            .filter(Message.user_turn.isnot(None))
+            .order_by(Message.turn_id.asc())
+            .offset(int(to_user_turn) - want)
+            .limit(want)
+            .all()
+        )
+        return list(dict.fromkeys(r[0] for r in rows))
+
+    q = (
         _build_scope_query(
             db,
             session_id=session_id,
@@ -753,32 +884,218 @@ def _resolve_scope_user_turns(
             thread_id=thread_id,
             memory_id=memory_id,
             agent_id=agent_id,
+            columns=(Message.user_turn,),
         )
         .filter(Message.role == "user")
+        .filter(Message.user_turn.isnot(None))
         .order_by(Message.turn_id.desc())
-        .limit(to_user_turn)
-        .all()
     )
 
-    ordered_user_turns: List[int] = []
-    seen = set()
-    for row in reversed(user_turn_rows):
-        ut = row.user_turn
-        if ut is None or ut in seen:
-            continue
-        seen.add(ut)
-        ordered_user_turns.append(ut)
+    fetch = want
+    while True:
+        rows = q.limit(fetch).all()
+        latest_first = list(dict.fromkeys(r[0] for r in rows))
+        if len(latest_first) >= want or len(rows) < fetch or fetch >= to_user_turn:
+            break
+        # 同一 user_turn 有多条 user 消息（旧数据）时窗口不够，扩大再取
+        fetch = min(fetch * 2, int(to_user_turn))
+
+    return list(reversed(latest_first[:want]))
 
-    if not ordered_user_turns:
+
+def _load_scope_window(
+    db: Session,
+    *,
+    session_id: str,
+    to_user_turn: int,
+    window_user_turn: int,
+    scope_type: str,
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+    exact_window: bool = False,
+) -> List[Any]:
+    """窗口内的全部消息（user + assistant，按 turn_id 升序）：一次列查询定窗口 + 一次取消息。"""
+    scoped_user_turns = _resolve_scope_user_turns(
+        db,
+        session_id=session_id,
+        to_user_turn=to_user_turn,
+        window_user_turn=window_user_turn,
+        scope_type=scope_type,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+        exact_window=exact_window,
+    )
+    if not scoped_user_turns:
         return []
 
-    return ordered_user_turns[-window_user_turn:]
+    return (
+        _build_scope_query(
+            db,
+            session_id=session_id,
+            scope_type=scope_type,
+            thread_id=thread_id,
+            memory_id=memory_id,
+            agent_id=agent_id,
+            columns=_WINDOW_COLUMNS,
+        )
+        .filter(Message.user_turn.in_(scoped_user_turns))
+        .order_by(Message.turn_id.asc())
+        .all()
+    )
+
+
+def _plan_s4_input(
+    db: Session,
+    *,
+    session_id: str,
+    scope_type: str,
+    msgs: List[Any],
+    summary_version: int,
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+) -> Tuple[List[Any], Optional[SummaryS4], Dict[str, Any]]:
+    """
+    决定这次 S4 用整窗还是增量。返回 (要渲染的消息, 增量基准行或 None, 写进 meta_json 的说明)。
+    增量：同一 scope 上一条 S4 + 它 to_turn 之后的新消息；没有可用基准 / 链太长时退回整窗。
+    """
+    plan: Dict[str, Any] = {"mode": "full", "depth": 0}
+    if summary_version != S4_INCREMENTAL_VERSION:
+        return msgs, None, plan
+
+    to_turn = msgs[-1].turn_id
+    base = (
+        db.query(SummaryS4)
+        .filter(SummaryS4.session_id == session_id)
+        .filter(SummaryS4.scope_type == scope_type)
+        .filter(SummaryS4.thread_id == thread_id)
+        .filter(SummaryS4.memory_id == memory_id)
+        .filter(SummaryS4.agent_id == agent_id)
+        .filter(SummaryS4.to_turn < to_turn)
+        .order_by(SummaryS4.to_turn.desc())
+        .first()
+    )
+    if base is None:
+        plan["reason"] = "no_base"
+        return msgs, None, plan
+    if _is_placeholder_summary(_safe_json_loads(base.summary_json)):
+        plan["reason"] = "placeholder_base"
+        return msgs, None, plan
+
+    base_meta = _safe_json_loads(base.meta_json) or {}
+    depth = int((base_meta.get("s4_plan") or {}).get("depth") or 0) + 1
+    if depth > S4_FULL_REFRESH_EVERY:
+        plan["reason"] = "refresh"
+        return msgs, None, plan
+
+    new_msgs = [m for m in msgs if m.turn_id > base.to_turn]
+    if not new_msgs:
+        return msgs, None, plan
+    plan.update({"mode": "incremental", "depth": depth, "base_id": base.id, "base_to_turn": base.to_turn})
+    return new_msgs, base, plan
 
 
 # ========= 对外：S4 / S60 =========
 
 
-def run_s4(
+@dataclass
+class SummaryWindow:
+    """
+    一个待总结的窗口。prepare 阶段读库得到；summarize 只调 LLM、不碰 db（可以放到线程池里并发）；
+    persist_window 写行。run_s4 / run_s60 串起来跑一个，summary_jobs.run_summary_batch 批量跑。
+    """
+
+    level: str  # s4 / s60
+    session_id: str
+    from_turn: int
+    to_turn: int
+    dedupe_key: str
+    row_fields: Dict[str, Any]
+    meta: Dict[str, Any]
+    mode: str
+    input_tokens: int
+    summarize: Callable[[], Dict[str, Any]]
+
+    @property
+    def lease_key(self) -> str:
+        return f"{self.session_id}:{self.dedupe_key}"
+
+    @property
+    def model_cls(self):
+        return SummaryS4 if self.level == "s4" else SummaryS60
+
+
+def window_exists(db: Session, w: SummaryWindow) -> bool:
+    cls = w.model_cls
+    return db.query(cls.id).filter(cls.session_id == w.session_id, cls.dedupe_key == w.dedupe_key).first() is not None
+
+
+def persist_window(db: Session, w: SummaryWindow, summary_obj: Dict[str, Any]):
+    """只 add 不 commit。"""
+    row = w.model_cls(
+        session_id=w.session_id,
+        dedupe_key=w.dedupe_key,
+        from_turn=w.from_turn,
+        to_turn=w.to_turn,
+        summary_json=_safe_json_dumps(summary_obj),
+        created_at=_now(),
+        meta_json=_safe_json_dumps(w.meta),
+        **w.row_fields,
+    )
+    db.add(row)
+    return row
+
+
+def window_result(db: Session, w: SummaryWindow, row: Any, summary_obj: Dict[str, Any]) -> Dict[str, Any]:
+    """提交之后调用：回读校验（S4）并拼返回值。"""
+    summary = summary_obj
+    if w.level == "s4":
+        db.refresh(row)
+        persisted_summary = _safe_json_loads(row.summary_json)
+        if persisted_summary != summary_obj:
+            logger.warning(
+                "S4 summary changed after DB persist session_id=%s to_turn=%s before=%r after=%r",
+                w.session_id,
+                w.to_turn,
+                summary_obj,
+                persisted_summary,
+            )
+            _push_debug_event(
+                {
+                    "stage": "run_s4.after_persist_changed",
+                    "session_id": w.session_id,
+                    "to_turn": w.to_turn,
+                    "before_preview": str(summary_obj)[:240],
+                    "after_preview": str(persisted_summary)[:240],
+                }
+            )
+        summary = persisted_summary or summary_obj
+    return {
+        "range": [w.from_turn, w.to_turn],
+        "summary": summary,
+        "created_at": row.created_at.isoformat(),
+        "model": w.row_fields["model"],
+        "mode": w.mode,
+    }
+
+
+def _run_window(db: Session, w: SummaryWindow, *, lock_wait_s: Optional[float]) -> Dict[str, Any]:
+    # 租约（session + dedupe_key）：同一窗口只有一个进程调 LLM；拿到之后再查一次（等待期间对方可能已经写完）
+    with summary_lease(w.lease_key, wait_s=lock_wait_s) as held:
+        if not held:
+            return {"skipped": True, "reason": "locked", "to_turn": w.to_turn}
+        if window_exists(db, w):
+            return {"skipped": True, "reason": "exists", "to_turn": w.to_turn}
+        summary_obj = w.summarize()
+        row = persist_window(db, w, summary_obj)
+        db.commit()
+        invalidate_latest_summaries(w.session_id)
+        return window_result(db, w, row, summary_obj)
+
+
+def prepare_s4_window(
     db: Session,
     *,
     session_id: str,
@@ -790,8 +1107,10 @@ def run_s4(
     agent_id: Optional[str] = None,
     s4_scope: str = "thread",
     summary_version: int = 2,
-) -> Dict[str, Any]:
-    """短期总结：按 user_turn 窗口。"""
+    collapsed_triggers: Optional[int] = None,
+    exact_window: bool = False,
+) -> Tuple[Optional[SummaryWindow], Optional[Dict[str, Any]]]:
+    """返回 (窗口, None)；不需要总结时返回 (None, skip 结果)。"""
 
     effective_scope = (s4_scope or "thread").lower()
     if effective_scope == "auto":
@@ -799,7 +1118,7 @@ def run_s4(
     if effective_scope not in {"thread", "memory"}:
         effective_scope = "thread"
 
-    scoped_user_turns = _resolve_scope_user_turns(
+    msgs = _load_scope_window(
         db,
         session_id=session_id,
         to_user_turn=to_user_turn,
@@ -808,26 +1127,11 @@ def run_s4(
         thread_id=thread_id,
         memory_id=memory_id,
         agent_id=agent_id,
-    )
-
-    msgs = (
-        _build_scope_query(
-            db,
-            session_id=session_id,
-            scope_type=effective_scope,
-            thread_id=thread_id,
-            memory_id=memory_id,
-            agent_id=agent_id,
-        )
-        .filter(Message.user_turn.in_(scoped_user_turns))
-        .order_by(Message.turn_id.asc())
-        .all()
-        if scoped_user_turns
-        else []
+        exact_window=exact_window,
     )
 
     if not msgs:
-        return {"skipped": True, "reason": "no messages"}
+        return None, {"skipped": True, "reason": "no messages"}
 
     from_turn = min(m.turn_id for m in msgs)
     to_turn = max(m.turn_id for m in msgs)
@@ -844,97 +1148,280 @@ def run_s4(
         .first()
     )
     if existed:
-        return {"skipped": True, "reason": "exists", "to_turn": to_turn}
-
-    transcript = _render_transcript(msgs)
-    summary_obj = _summarize_s4_with_debug_events(
-        transcript,
-        session_id=session_id,
-        to_turn=to_turn,
-    )
-    logger.debug(
-        "S4 summary preview before persist session_id=%s thread_id=%s to_turn=%s summary=%r",
-        session_id,
-        thread_id,
-        to_turn,
-        summary_obj,
-    )
-    _push_debug_event(
-        {
-            "stage": "run_s4.before_persist",
-            "session_id": session_id,
-            "to_turn": to_turn,
-            "summary_preview": str(summary_obj)[:240],
-        }
-    )
+        return None, {"skipped": True, "reason": "exists", "to_turn": to_turn}
 
     first_msg = msgs[0]
     trace_thread_id = thread_id or getattr(first_msg, "thread_id", None)
     trace_memory_id = memory_id or getattr(first_msg, "memory_id", None)
     trace_agent_id = agent_id or getattr(first_msg, "agent_id", None)
+
     dedupe_key = (
         f"s4:{effective_scope}:{trace_thread_id}:{trace_memory_id}:{trace_agent_id}:"
         f"{to_turn}:v{summary_version}"
     )
 
-    row = SummaryS4(
+    input_msgs, base, s4_plan = _plan_s4_input(
+        db,
         session_id=session_id,
         scope_type=effective_scope,
+        msgs=msgs,
+        summary_version=summary_version,
         thread_id=trace_thread_id,
         memory_id=trace_memory_id,
         agent_id=trace_agent_id,
-        summary_version=summary_version,
-        dedupe_key=dedupe_key,
-        from_turn=from_turn,
-        to_turn=to_turn,
-        summary_json=_safe_json_dumps(summary_obj),
-        model=model_name,
-        created_at=_now(),
-        meta_json=_safe_json_dumps(
-            {
-                "scope_type": effective_scope,
-                "thread_id": trace_thread_id,
-                "memory_id": trace_memory_id,
-                "agent_id": trace_agent_id,
-                "to_user_turn": to_user_turn,
-                "window_user_turn": window_user_turn,
-                "summary_version": summary_version,
-                "dedupe_key": dedupe_key,
-            }
-        ),
     )
-    db.add(row)
-    db.commit()
-    db.refresh(row)
-
-    persisted_summary = _safe_json_loads(row.summary_json)
-    if persisted_summary != summary_obj:
-        logger.warning(
-            "S4 summary changed after DB persist session_id=%s to_turn=%s before=%r after=%r",
+    transcript, transcript_report = build_transcript(input_msgs, budget=S4_INPUT_MAX_TOKENS)
+    s4_plan["transcript"] = transcript_report.as_dict()
+    previous = _safe_json_loads(base.summary_json) if base is not None else None
+    previous_to_turn = base.to_turn if base is not None else None
+    s4_plan["input_tokens"] = count_tokens(transcript) + (count_tokens(_safe_json_dumps(previous)) if previous else 0)
+
+    def summarize() -> Dict[str, Any]:
+        summary_obj = _summarize_s4_with_debug_events(
+            transcript,
+            session_id=session_id,
+            to_turn=to_turn,
+            previous=previous,
+            previous_to_turn=previous_to_turn,
+        )
+        logger.debug(
+            "S4 summary preview before persist session_id=%s thread_id=%s to_turn=%s summary=%r",
             session_id,
+            thread_id,
             to_turn,
             summary_obj,
-            persisted_summary,
         )
         _push_debug_event(
             {
-                "stage": "run_s4.after_persist_changed",
+                "stage": "run_s4.before_persist",
                 "session_id": session_id,
                 "to_turn": to_turn,
-                "before_preview": str(summary_obj)[:240],
-                "after_preview": str(persisted_summary)[:240],
+                "summary_preview": str(summary_obj)[:240],
+                "mode": s4_plan["mode"],
             }
         )
+        return summary_obj
 
-    return {
-        "range": [from_turn, to_turn],
-        "summary": persisted_summary or summary_obj,
-        "created_at": row.created_at.isoformat(),
-        "model": model_name,
+    return SummaryWindow(
+        level="s4",
+        session_id=session_id,
+        from_turn=from_turn,
+        to_turn=to_turn,
+        dedupe_key=dedupe_key,
+        row_fields={
+            "scope_type": effective_scope,
+            "thread_id": trace_thread_id,
+            "memory_id": trace_memory_id,
+            "agent_id": trace_agent_id,
+            "summary_version": summary_version,
+            "model": model_name,
+        },
+        meta={
+            "scope_type": effective_scope,
+            "thread_id": trace_thread_id,
+            "memory_id": trace_memory_id,
+            "agent_id": trace_agent_id,
+            "to_user_turn": to_user_turn,
+            "window_user_turn": window_user_turn,
+            "summary_version": summary_version,
+            "dedupe_key": dedupe_key,
+            "s4_plan": s4_plan,
+            **({"collapsed_triggers": collapsed_triggers} if collapsed_triggers is not None else {}),
+        },
+        mode=s4_plan["mode"],
+        input_tokens=s4_plan["input_tokens"],
+        summarize=summarize,
+    ), None
+
+
+@traced("summarizer.run_s4")
+def run_s4(
+    db: Session,
+    *,
+    session_id: str,
+    to_user_turn: int,
+    window_user_turn: int = 4,
+    model_name: str = "summarizer_mvp",
+    thread_id: Optional[str] = None,
+    memory_id: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    s4_scope: str = "thread",
+    summary_version: int = 2,
+    lock_wait_s: Optional[float] = None,
+    collapsed_triggers: Optional[int] = None,
+    exact_window: bool = False,
+) -> Dict[str, Any]:
+    """
+    短期总结：按 user_turn 窗口。
+    lock_wait_s：同一窗口别人在跑时等多久（默认 SUMMARY_LOCK_WAIT_SECS）；
+    collapsed_triggers：防抖合并掉的触发次数（summary_jobs 传入，记进 meta_json）；
+    exact_window：窗口按 to_user_turn 精确定位（回填历史用，默认取 scope 内最新的窗口）。
+    """
+    w, skip = prepare_s4_window(
+        db,
+        session_id=session_id,
+        to_user_turn=to_user_turn,
+        window_user_turn=window_user_turn,
+        model_name=model_name,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+        s4_scope=s4_scope,
+        summary_version=summary_version,
+        collapsed_triggers=collapsed_triggers,
+        exact_window=exact_window,
+    )
+    if w is None:
+        return skip
+    return _run_window(db, w, lock_wait_s=lock_wait_s)
+
+
+_S60_HIER_INSTRUCTIONS = (
+    "\n下面的材料按时间顺序排列：[上一段长期总结] 是更早窗口的长期总结，[分段摘要] 是本窗口内已有的短期摘要（JSON），"
+    "[原文] 是没有被短期摘要覆盖的对话原文。请把它们合并成本窗口的长期总结："
+    "只保留到窗口结束时仍然成立的目标/状态/未完成事项/约束，已解决的不要再列。"
+)
+
+
+def _is_placeholder_summary(obj: Optional[Dict[str, Any]]) -> bool:
+    """未配置 LLM 时写入的占位 schema 不携带信息，不能当作覆盖。"""
+    return not obj or obj == _default_summary_schema() or "_raw" in obj
+
+
+def _s4_covers(s4: SummaryS4, m: Any) -> bool:
+    if not (s4.from_turn <= m.turn_id <= s4.to_turn):
+        return False
+    # S4 默认按 thread 切，S60 按 memory 切：同一 session 里混了别的 thread/memory 时不能算覆盖
+    for attr in ("thread_id", "memory_id", "agent_id"):
+        a, b = getattr(s4, attr), getattr(m, attr)
+        if a is not None and b is not None and a != b:
+            return False
+    return True
+
+
+def _build_s60_hierarchical_input(
+    db: Session,
+    *,
+    session_id: str,
+    scope_type: str,
+    msgs: List[Any],
+    thread_id: Optional[str],
+    memory_id: Optional[str],
+    agent_id: Optional[str],
+) -> Tuple[Optional[str], Dict[str, Any]]:
+    """
+    S60 分层输入：上一段 S60 + 覆盖本窗口的 S4 + 未覆盖消息的原文。
+    返回 (输入文本, provenance)；覆盖不足时文本为 None，调用方回退整段原文。
+    """
+    from_turn = msgs[0].turn_id
+    to_turn = msgs[-1].turn_id
+
+    cand_q = (
+        db.query(SummaryS4)
+        .filter(SummaryS4.session_id == session_id)
+        .filter(SummaryS4.to_turn >= from_turn)
+        .filter(SummaryS4.from_turn <= to_turn)
+    )
+    # 先按 memory / agent 过滤（和 _build_scope_query 同样的维度）：别的 memory 的 S4 范围重叠时会挡住本 scope 的
+    if memory_id is not None:
+        cand_q = cand_q.filter(or_(SummaryS4.memory_id == memory_id, SummaryS4.memory_id.is_(None)))
+    if agent_id is not None:
+        cand_q = cand_q.filter(or_(SummaryS4.agent_id == agent_id, SummaryS4.agent_id.is_(None)))
+    candidates = cand_q.order_by(SummaryS4.from_turn.asc(), SummaryS4.created_at.desc()).all()
+    # 同一范围可能有多个版本：取最新一条；范围之间不重叠，贪心从前往后取
+    chosen: List[Tuple[SummaryS4, Dict[str, Any]]] = []
+    last_to = from_turn - 1
+    for s4 in candidates:
+        if s4.from_turn < from_turn or s4.to_turn > to_turn or s4.from_turn <= last_to:
+            continue
+        # 一条本窗口消息都盖不住的（别的 thread 的）不占位置
+        if not any(_s4_covers(s4, m) for m in msgs):
+            continue
+        obj = _safe_json_loads(s4.summary_json)
+        if _is_placeholder_summary(obj):
+            continue
+        chosen.append((s4, obj))
+        last_to = s4.to_turn
+
+    covered_by: Dict[int, int] = {}
+    for idx, (s4, _obj) in enumerate(chosen):
+        for m in msgs:
+            if _s4_covers(s4, m):
+                covered_by[m.turn_id] = idx
+    coverage = len(covered_by) / len(msgs)
+
+    # 上一段 S60 必须是同一个 scope 的（和 _build_scope_query 同样的维度），否则会把别的 memory/agent 的总结混进来
+    prev_q = (
+        db.query(SummaryS60)
+        .filter(SummaryS60.session_id == session_id)
+        .filter(SummaryS60.scope_type == scope_type)
+        .filter(SummaryS60.to_turn < from_turn)
+    )
+    if scope_type == "thread":
+        if thread_id is not None:
+            prev_q = prev_q.filter(SummaryS60.thread_id == thread_id)
+    elif scope_type == "memory":
+        if memory_id is not None:
+            prev_q = prev_q.filter(SummaryS60.memory_id == memory_id)
+        if agent_id is not None:
+            prev_q = prev_q.filter(SummaryS60.agent_id == agent_id)
+    prev = prev_q.order_by(SummaryS60.to_turn.desc()).first()
+    prev_obj = _safe_json_loads(prev.summary_json) if prev else None
+    if _is_placeholder_summary(prev_obj):
+        prev, prev_obj = None, None
+
+    provenance: Dict[str, Any] = {
+        "mode": "raw",
+        "coverage": round(coverage, 3),
+        "prev_s60": {"id": prev.id, "from_turn": prev.from_turn, "to_turn": prev.to_turn} if prev else None,
+        "s4": [{"id": s4.id, "from_turn": s4.from_turn, "to_turn": s4.to_turn} for s4, _ in chosen],
+        "raw_turns": [],
     }
+    if not chosen or coverage < S60_HIER_MIN_COVERAGE:
+        return None, provenance
+
+    # 原文部分的预算 = S60 总预算 - 摘要块（摘要块本身已经是压缩过的，不再裁）
+    summary_tokens = sum(count_tokens(_safe_json_dumps(obj)) for _, obj in chosen)
+    if prev_obj:
+        summary_tokens += count_tokens(_safe_json_dumps(prev_obj))
+    raw_msgs = [m for m in msgs if m.turn_id not in covered_by]
+    raw_lines, transcript_report = budget_lines(
+        raw_msgs, budget=max(S60_INPUT_MAX_TOKENS - summary_tokens, S60_INPUT_MAX_TOKENS // 4)
+    )
+    rendered = {id(m): line for m, line in zip(raw_msgs, raw_lines)}
+    provenance["transcript"] = transcript_report.as_dict()
+
+    blocks: List[str] = []
+    if prev_obj:
+        blocks.append(f"[上一段长期总结 turns {prev.from_turn}-{prev.to_turn}]\n{_safe_json_dumps(prev_obj)}")
+    emitted = set()
+    raw_run: List[Any] = []
+
+    def flush_raw() -> None:
+        if raw_run:
+            provenance["raw_turns"].append([raw_run[0].turn_id, raw_run[-1].turn_id])
+            lines = [rendered[id(m)] for m in raw_run if rendered[id(m)] is not None]
+            if lines:
+                blocks.append(f"[原文 turns {raw_run[0].turn_id}-{raw_run[-1].turn_id}]\n" + "\n".join(lines))
+            raw_run.clear()
 
+    for m in msgs:
+        idx = covered_by.get(m.turn_id)
+        if idx is None:
+            raw_run.append(m)
+            continue
+        flush_raw()
+        if idx not in emitted:
+            emitted.add(idx)
+            s4, obj = chosen[idx]
+            blocks.append(f"[分段摘要 turns {s4.from_turn}-{s4.to_turn}]\n{_safe_json_dumps(obj)}")
+    flush_raw()
 
-def run_s60(
+    provenance["mode"] = "hierarchical"
+    return "\n\n".join(blocks), provenance
+
+
+def prepare_s60_window(
     db: Session,
     *,
     session_id: str,
@@ -945,11 +1432,13 @@ def run_s60(
     memory_id: Optional[str] = None,
     agent_id: Optional[str] = None,
     summary_version: int = 1,
-) -> Dict[str, Any]:
-    """长期总结：你现在要的是 30 轮 user 消息。"""
+    collapsed_triggers: Optional[int] = None,
+    exact_window: bool = False,
+) -> Tuple[Optional[SummaryWindow], Optional[Dict[str, Any]]]:
+    """同 prepare_s4_window。"""
 
     scope_type = "memory"
-    scoped_user_turns = _resolve_scope_user_turns(
+    msgs = _load_scope_window(
         db,
         session_id=session_id,
         to_user_turn=to_user_turn,
@@ -958,26 +1447,11 @@ def run_s60(
         thread_id=thread_id,
         memory_id=memory_id,
         agent_id=agent_id,
-    )
-
-    msgs = (
-        _build_scope_query(
-            db,
-            session_id=session_id,
-            scope_type=scope_type,
-            thread_id=thread_id,
-            memory_id=memory_id,
-            agent_id=agent_id,
-        )
-        .filter(Message.user_turn.in_(scoped_user_turns))
-        .order_by(Message.turn_id.asc())
-        .all()
-        if scoped_user_turns
-        else []
+        exact_window=exact_window,
     )
 
     if not msgs:
-        return {"skipped": True, "reason": "no messages"}
+        return None, {"skipped": True, "reason": "no messages"}
 
     from_turn = min(m.turn_id for m in msgs)
     to_turn = max(m.turn_id for m in msgs)
@@ -993,10 +1467,7 @@ def run_s60(
         .first()
     )
     if existed:
-        return {"skipped": True, "reason": "exists", "to_turn": to_turn}
-
-    transcript = _render_transcript(msgs)
-    summary_obj = _summarize_with_optional_llm(transcript, level="长期")
+        return None, {"skipped": True, "reason": "exists", "to_turn": to_turn}
 
     first_msg = msgs[0]
     trace_thread_id = thread_id or getattr(first_msg, "thread_id", None)
@@ -1007,38 +1478,111 @@ def run_s60(
         f"{to_turn}:v{summary_version}"
     )
 
-    row = SummaryS60(
+    provenance: Dict[str, Any] = {"mode": "raw"}
+    if S60_MODE == "hierarchical":
+        hier_input, provenance = _build_s60_hierarchical_input(
+            db,
+            session_id=session_id,
+            scope_type=scope_type,
+            msgs=msgs,
+            thread_id=thread_id,
+            memory_id=memory_id,
+            agent_id=agent_id,
+        )
+    else:
+        hier_input = None
+    if hier_input is None:
+        transcript, transcript_report = build_transcript(msgs, budget=S60_INPUT_MAX_TOKENS)
+        provenance["transcript"] = transcript_report.as_dict()
+        provenance["raw_input_tokens"] = transcript_report.tokens_in
+        provenance["input_tokens"] = count_tokens(transcript)
+    else:
+        transcript = ""
+        provenance["raw_input_tokens"] = count_tokens(_render_transcript(msgs))
+        provenance["input_tokens"] = count_tokens(hier_input)
+
+    def summarize() -> Dict[str, Any]:
+        if hier_input is not None:
+            summary_obj = _summarize_with_optional_llm(
+                hier_input, level="长期", instructions=_S60_HIER_INSTRUCTIONS
+            )
+        else:
+            summary_obj = _summarize_with_optional_llm(transcript, level="长期")
+        _push_debug_event(
+            {
+                "stage": "run_s60.input",
+                "session_id": session_id,
+                "to_turn": to_turn,
+                "mode": provenance["mode"],
+                "input_tokens": provenance["input_tokens"],
+                "raw_input_tokens": provenance["raw_input_tokens"],
+                "transcript": provenance.get("transcript"),
+            }
+        )
+        return summary_obj
+
+    return SummaryWindow(
+        level="s60",
         session_id=session_id,
-        scope_type=scope_type,
-        thread_id=trace_thread_id,
-        memory_id=trace_memory_id,
-        agent_id=trace_agent_id,
-        summary_version=summary_version,
-        dedupe_key=dedupe_key,
         from_turn=from_turn,
         to_turn=to_turn,
-        summary_json=_safe_json_dumps(summary_obj),
-        model=model_name,
-        created_at=_now(),
-        meta_json=_safe_json_dumps(
-            {
-                "scope_type": scope_type,
-                "thread_id": trace_thread_id,
-                "memory_id": trace_memory_id,
-                "agent_id": trace_agent_id,
-                "to_user_turn": to_user_turn,
-                "window_user_turn": window_user_turn,
-                "summary_version": summary_version,
-                "dedupe_key": dedupe_key,
-            }
-        ),
+        dedupe_key=dedupe_key,
+        row_fields={
+            "scope_type": scope_type,
+            "thread_id": trace_thread_id,
+            "memory_id": trace_memory_id,
+            "agent_id": trace_agent_id,
+            "summary_version": summary_version,
+            "model": model_name,
+        },
+        meta={
+            "scope_type": scope_type,
+            "thread_id": trace_thread_id,
+            "memory_id": trace_memory_id,
+            "agent_id": trace_agent_id,
+            "to_user_turn": to_user_turn,
+            "window_user_turn": window_user_turn,
+            "summary_version": summary_version,
+            "dedupe_key": dedupe_key,
+            "provenance": provenance,
+            **({"collapsed_triggers": collapsed_triggers} if collapsed_triggers is not None else {}),
+        },
+        mode=provenance["mode"],
+        input_tokens=provenance["input_tokens"],
+        summarize=summarize,
+    ), None
+
+
+@traced("summarizer.run_s60")
+def run_s60(
+    db: Session,
+    *,
+    session_id: str,
+    to_user_turn: int,
+    window_user_turn: int = 30,
+    model_name: str = "summarizer_mvp",
+    thread_id: Optional[str] = None,
+    memory_id: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    summary_version: int = 1,
+    lock_wait_s: Optional[float] = None,
+    collapsed_triggers: Optional[int] = None,
+    exact_window: bool = False,
+) -> Dict[str, Any]:
+    """长期总结：你现在要的是 30 轮 user 消息。lock_wait_s / collapsed_triggers / exact_window 同 run_s4。"""
+    w, skip = prepare_s60_window(
+        db,
+        session_id=session_id,
+        to_user_turn=to_user_turn,
+        window_user_turn=window_user_turn,
+        model_name=model_name,
+        thread_id=thread_id,
+        memory_id=memory_id,
+        agent_id=agent_id,
+        summary_version=summary_version,
+        collapsed_triggers=collapsed_triggers,
+        exact_window=exact_window,
     )
-    db.add(row)
-    db.commit()
-
-    return {
-        "range": [from_turn, to_turn],
-        "summary": summary_obj,
-        "created_at": row.created_at.isoformat(),
-        "model": model_name,
-    }
+    if w is None:
+        return skip
+    return _run_window(db, w, lock_wait_s=lock_wait_s)
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Optional, Set
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.services.upstream_limiter import parse_retry_after
+
+# -----------------------------
+# 摘要 LLM 的 HTTP 客户端：进程内复用 requests.Session（keep-alive 连接池）+ 有界重试
+#
+#   SUMMARIZER_POOL_SIZE        每个 host 的连接池大小（默认 8）
+#   SUMMARIZER_MAX_RETRIES      429 / 5xx / 连接错误的最多重试次数（默认 3）
+#   SUMMARIZER_BACKOFF_BASE     退避基数秒（默认 0.5），full jitter：sleep = uniform(0, base * 2^attempt)
+#   SUMMARIZER_BACKOFF_MAX      单次最长等待（默认 10 秒；Retry-After 也按它截断）
+# JSON mode：response_format 被上游 400 拒绝时去掉它再发一次，并记住这个 base_url 不支持
+# -----------------------------
+
+SUMMARIZER_POOL_SIZE = int(os.getenv("SUMMARIZER_POOL_SIZE", "8"))
+SUMMARIZER_MAX_RETRIES = int(os.getenv("SUMMARIZER_MAX_RETRIES", "3"))
+SUMMARIZER_BACKOFF_BASE = float(os.getenv("SUMMARIZER_BACKOFF_BASE", "0.5"))
+SUMMARIZER_BACKOFF_MAX = float(os.getenv("SUMMARIZER_BACKOFF_MAX", "10"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_no_json_mode: Set[str] = set()
+
+
+def get_session() -> requests.Session:
+    """每个进程一个 Session（celery prefork 子进程不能复用父进程的连接）。"""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _lock:
+        if _session is None or _session_pid != pid:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=SUMMARIZER_POOL_SIZE, pool_maxsize=SUMMARIZER_POOL_SIZE)
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            _session, _session_pid = s, pid
+    return _session
+
+
+def _retry_after_secs(r: requests.Response) -> Optional[float]:
+    # 秒数 / HTTP-date 两种写法都认，和 proxy 的 limiter 共用解析
+    return parse_retry_after(r.headers.get("retry-after"))
+
+
+def _backoff_secs(attempt: int, retry_after: Optional[float] = None) -> float:
+    if retry_after is not None:
+        return min(retry_after, SUMMARIZER_BACKOFF_MAX)
+    return random.uniform(0, min(SUMMARIZER_BACKOFF_MAX, SUMMARIZER_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _looks_like_json_mode_rejection(r: requests.Response) -> bool:
+    if r.status_code not in (400, 422):
+        return False
+    body = (r.text or "")[:500].lower()
+    return "response_format" in body or "json_object" in body or "json mode" in body
+
+
+def post_chat_completions(
+    base_url: str,
+    *,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    timeout_s: float,
+) -> requests.Response:
+    """
+    POST {base_url}/chat/completions。返回最后一次响应（调用方 raise_for_status）；
+    连接错误重试耗尽时抛出最后一个异常。响应对象上附带 attempts（总请求次数）。
+    """
+    url = base_url.rstrip("/") + "/chat/completions"
+    if base_url in _no_json_mode:
+        payload = {k: v for k, v in payload.items() if k != "response_format"}
+
+    session = get_session()
+    attempt = 0
+    sent = 0
+    while True:
+        sent += 1
+        try:
+            r = session.post(url, headers=headers, json=payload, timeout=timeout_s)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= SUMMARIZER_MAX_RETRIES:
+                raise
+            delay = _backoff_secs(attempt)
+            print(f"[summarizer_client] {type(e).__name__} attempt={attempt + 1} retry_in={delay:.2f}s")
+            attempt += 1
+            time.sleep(delay)
+            continue
+
+        if "response_format" in payload and _looks_like_json_mode_rejection(r):
+            # 不支持 JSON mode 的上游：去掉再发（不算重试次数），后面统一靠解析兜底
+            _no_json_mode.add(base_url)
+            payload = {k: v for k, v in payload.items() if k != "response_format"}
+            print(f"[summarizer_client] json mode rejected status={r.status_code}, fallback to plain")
+            continue
+
+        if r.status_code in RETRY_STATUSES and attempt < SUMMARIZER_MAX_RETRIES:
+            delay = _backoff_secs(attempt, _retry_after_secs(r))
+            print(f"[summarizer_client] status={r.status_code} attempt={attempt + 1} retry_in={delay:.2f}s")
+            attempt += 1
+            time.sleep(delay)
+            continue
+
+        r.attempts = sent
+        return r
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, update
+from sqlalchemy.orm import Session as OrmSession
+
+from app.db.models import SummaryCache
+
+# -----------------------------
+# 摘要 LLM 结果缓存（内容寻址）
+#
+# key = sha256(system prompt, user prompt, model, temperature)：同一段 transcript 重跑（提交前崩溃、重试、
+# memory scope 换 thread、dedupe "exists" 竞争）直接命中，不再付一次 LLM 调用。
+#
+# SUMMARY_CACHE_BACKEND:
+#   db（默认）-> summary_cache 表，web / worker 共用；过期行由 reconcile_summary_jobs 顺带清理
+#   redis     -> SUMMARY_CACHE_REDIS_URL（默认 REDIS_URL），SETEX 原生过期
+#   none      -> 关闭
+# SUMMARY_CACHE_TTL_SECS 默认 7 天
+# -----------------------------
+
+SUMMARY_CACHE_BACKEND = (os.getenv("SUMMARY_CACHE_BACKEND", "db") or "db").strip().lower()
+SUMMARY_CACHE_TTL_SECS = int(os.getenv("SUMMARY_CACHE_TTL_SECS", str(7 * 24 * 3600)))
+_REDIS_PREFIX = "summary_cache:"
+
+_stats = {"lookups": 0, "hits": 0}
+_redis_client = None
+
+
+def cache_key(*, system: str, user: str, model: str, temperature: float) -> str:
+    raw = json.dumps([system, user, model, round(float(temperature), 4)], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cache_enabled() -> bool:
+    return SUMMARY_CACHE_BACKEND in {"db", "redis"}
+
+
+def cache_stats() -> Dict[str, Any]:
+    lookups = _stats["lookups"]
+    return {
+        "backend": SUMMARY_CACHE_BACKEND,
+        "lookups": lookups,
+        "hits": _stats["hits"],
+        "hit_rate": round(_stats["hits"] / lookups, 4) if lookups else 0.0,
+    }
+
+
+def _redis():
+    global _redis_client
+    if _redis_client is None:
+        import redis
+
+        from app.core.config import REDIS_URL
+
+        url = os.getenv("SUMMARY_CACHE_REDIS_URL", "") or REDIS_URL
+        _redis_client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis_client
+
+
+def _db_get(key: str) -> Optional[str]:
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        row = db.get(SummaryCache, key)
+        if row is None or row.expires_at <= datetime.utcnow():
+            return None
+        db.execute(
+            update(SummaryCache)
+            .where(SummaryCache.cache_key == key)
+            .values(hits=SummaryCache.hits + 1)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        return row.value_json
+    finally:
+        db.close()
+
+
+def _db_put(key: str, value_json: str, model: str) -> None:
+    from app.db.session import SessionLocal
+
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        db.merge(SummaryCache(
+            cache_key=key,
+            model=model,
+            value_json=value_json,
+            hits=0,
+            created_at=now,
+            expires_at=now + timedelta(seconds=SUMMARY_CACHE_TTL_SECS),
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+
+def cache_get(key: str) -> Optional[Dict[str, Any]]:
+    """命中返回解析后的 dict；未命中 / 关闭 / 后端出错都返回 None（缓存不影响主流程）。"""
+    if not cache_enabled():
+        return None
+    _stats["lookups"] += 1
+    try:
+        if SUMMARY_CACHE_BACKEND == "redis":
+            raw = _redis().get(_REDIS_PREFIX + key)
+            value = raw.decode("utf-8") if raw is not None else None
+        else:
+            value = _db_get(key)
+    except Exception as e:
+        print(f"[summary_cache] get failed backend={SUMMARY_CACHE_BACKEND} err={e!r}")
+        return None
+    if value is None:
+        return None
+    try:
+        obj = json.loads(value)
+    except Exception:
+        return None
+    if not isinstance(obj, dict):
+        return None
+    _stats["hits"] += 1
+    return obj
+
+
+def cache_put(key: str, obj: Dict[str, Any], *, model: str) -> None:
+    if not cache_enabled():
+        return
+    value_json = json.dumps(obj, ensure_ascii=False)
+    try:
+        if SUMMARY_CACHE_BACKEND == "redis":
+            _redis().setex(_REDIS_PREFIX + key, SUMMARY_CACHE_TTL_SECS, value_json.encode("utf-8"))
+        else:
+            _db_put(key, value_json, model)
+    except Exception as e:
+        print(f"[summary_cache] put failed backend={SUMMARY_CACHE_BACKEND} err={e!r}")
+
+
+def purge_expired_summary_cache(db: OrmSession, *, limit: int = 1000) -> int:
+    """db 后端的过期清理（redis 自带过期）。"""
+    if SUMMARY_CACHE_BACKEND != "db":
+        return 0
+    keys = [
+        k for (k,) in db.query(SummaryCache.cache_key)
+        .filter(SummaryCache.expires_at <= datetime.utcnow())
+        .limit(limit)
+        .all()
+    ]
+    if keys:
+        db.execute(delete(SummaryCache).where(SummaryCache.cache_key.in_(keys)))
+        db.commit()
+    return len(keys)
@@ -0,0 +1,393 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session as OrmSession
+
+from app.db.models import TriggerJob
+from app.services.debug_events import flush_debug_events
+from app.services.latest_summaries import invalidate_latest_summaries
+from app.services.summary_lock import summary_lease
+
+# -----------------------------
+# 摘要任务 outbox（复用 trigger_jobs 表，trigger_type = summary_s4 / summary_s60）
+#
+# chat_once 在写消息的同一个事务里 enqueue，提交后再 dispatch：
+#   SUMMARY_DISPATCH=inline（默认）-> 当前进程立即执行（行为和以前一致，只是挪到提交之后）
+#   SUMMARY_DISPATCH=celery         -> 发 app.tasks.run_summary_job，由 worker 执行
+# 进程在 dispatch 前挂掉也不会丢：reconcile_summary_jobs 会把遗留的 job 重新派发。
+#
+# 防抖（SUMMARY_DEBOUNCE_SECS > 0）：连发消息时（Telegram 一分钟 5~10 条很常见）不立刻跑，
+# job 以 queued 入队、scheduled_at = 安静期结束；安静期内同 scope 再次触发就合并进这个 job
+# （参数换成最新的 to_user_turn，meta_json.debounce.collapsed +1），同 session 的新消息顺延安静期，
+# 但最晚不超过首次触发后 SUMMARY_DEBOUNCE_MAX_DELAY_SECS。到期后 inline 模式由进程内定时器执行，
+# celery 模式用 countdown 投递；没到期被拉起时只是按剩余时间重新挂上。
+# -----------------------------
+
+SUMMARY_DISPATCH = (os.getenv("SUMMARY_DISPATCH", "inline") or "inline").strip().lower()
+SUMMARY_JOB_TYPES = ("summary_s4", "summary_s60")
+# running 超过这个时间视为执行方已经挂掉
+SUMMARY_JOB_STALE_SECS = int(os.getenv("SUMMARY_JOB_STALE_SECS", "900"))
+SUMMARY_JOB_MAX_ATTEMPTS = int(os.getenv("SUMMARY_JOB_MAX_ATTEMPTS", "3"))
+# run_summary_batch：一次认领多少个窗口、LLM 调用并发多少（和 SUMMARIZER_POOL_SIZE 对齐）
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", "50"))
+SUMMARY_BATCH_CONCURRENCY = int(os.getenv("SUMMARY_BATCH_CONCURRENCY", "8"))
+SUMMARY_DEBOUNCE_SECS = float(os.getenv("SUMMARY_DEBOUNCE_SECS", "0"))
+SUMMARY_DEBOUNCE_MAX_DELAY_SECS = float(os.getenv("SUMMARY_DEBOUNCE_MAX_DELAY_SECS", "120"))
+# 这些参数相同才算同一个 scope（to_user_turn 不算：合并后取最新的）
+_SCOPE_PARAMS = ("thread_id", "memory_id", "agent_id", "s4_scope", "window_user_turn", "summary_version")
+
+
+def _debounced_due(now: datetime, deadline: datetime) -> datetime:
+    return min(now + timedelta(seconds=SUMMARY_DEBOUNCE_SECS), deadline)
+
+
+def _debounce_meta(job: TriggerJob) -> Optional[Dict[str, Any]]:
+    try:
+        meta = json.loads(job.meta_json or "{}")
+    except Exception:
+        return None
+    debounce = meta.get("debounce") if isinstance(meta, dict) else None
+    return debounce if isinstance(debounce, dict) else None
+
+
+def _pending_debounced(db: OrmSession, session_id: str, trigger_types=SUMMARY_JOB_TYPES) -> List[TriggerJob]:
+    rows = (
+        db.query(TriggerJob)
+        .filter(TriggerJob.session_id == session_id)
+        .filter(TriggerJob.trigger_type.in_(trigger_types))
+        .filter(TriggerJob.status == "queued")
+        .order_by(TriggerJob.created_at.desc())
+        .all()
+    )
+    return [job for job in rows if _debounce_meta(job) is not None]
+
+
+def touch_debounced_jobs(db: OrmSession, *, session_id: str) -> int:
+    """同 session 来了新消息：还在等安静期的 job 顺延（不超过各自的 deadline）。只改不提交。"""
+    if SUMMARY_DEBOUNCE_SECS <= 0:
+        return 0
+    now = datetime.utcnow()
+    n = 0
+    for job in _pending_debounced(db, session_id):
+        deadline = datetime.fromisoformat(_debounce_meta(job)["deadline"])
+        res = db.execute(
+            update(TriggerJob)
+            .where(TriggerJob.id == job.id, TriggerJob.status == "queued")
+            .values(scheduled_at=_debounced_due(now, deadline))
+            .execution_options(synchronize_session=False)
+        )
+        n += res.rowcount
+    return n
+
+
+def _collapse_into_pending(db: OrmSession, trigger_type: str, *, session_id: str, params: Dict[str, Any]) -> bool:
+    """安静期内同 scope 的触发合并进已有 job。对方刚被认领时返回 False，调用方照常新建。"""
+    scope = {k: params.get(k) for k in _SCOPE_PARAMS}
+    now = datetime.utcnow()
+    for job in _pending_debounced(db, session_id, (trigger_type,)):
+        old_params = json.loads(job.trigger_payload_json or "{}")
+        if {k: old_params.get(k) for k in _SCOPE_PARAMS} != scope:
+            continue
+        meta = json.loads(job.meta_json or "{}")
+        debounce = meta["debounce"]
+        debounce["collapsed"] = int(debounce.get("collapsed") or 0) + 1
+        debounce["last_triggered_at"] = now.isoformat()
+        new_params = {**params, "collapsed_triggers": debounce["collapsed"]}
+        res = db.execute(
+            update(TriggerJob)
+            .where(TriggerJob.id == job.id, TriggerJob.status == "queued")
+            .values(
+                trigger_payload_json=json.dumps(new_params, ensure_ascii=False),
+                meta_json=json.dumps(meta, ensure_ascii=False),
+                scheduled_at=_debounced_due(now, datetime.fromisoformat(debounce["deadline"])),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return res.rowcount == 1
+    return False
+
+
+def enqueue_summary_job(
+    db: OrmSession, kind: str, *, session_id: str, params: Dict[str, Any], queued: bool = False
+) -> Optional[TriggerJob]:
+    """
+    只 add，不 commit：和调用方的消息写入同一个事务。inline 模式下直接标成 running（本进程认领）。
+    开了防抖时 job 延后执行；合并进已有 job 时返回 None（不需要再派发）。
+    queued=True：只入队、不防抖不认领，留给 run_summary_batch（回填用）。
+    """
+    now = datetime.utcnow()
+    trigger_type = f"summary_{kind}"
+    meta: Dict[str, Any] = {}
+    scheduled_at = now
+    debounce = SUMMARY_DEBOUNCE_SECS > 0 and not queued
+    if debounce:
+        if _collapse_into_pending(db, trigger_type, session_id=session_id, params=params):
+            return None
+        deadline = now + timedelta(seconds=SUMMARY_DEBOUNCE_MAX_DELAY_SECS)
+        meta["debounce"] = {"first_triggered_at": now.isoformat(), "deadline": deadline.isoformat(), "collapsed": 0}
+        params = {**params, "collapsed_triggers": 0}
+        scheduled_at = _debounced_due(now, deadline)
+
+    inline = SUMMARY_DISPATCH != "celery" and not debounce and not queued
+    job = TriggerJob(
+        session_id=session_id,
+        trigger_type=trigger_type,
+        trigger_payload_json=json.dumps(params, ensure_ascii=False),
+        status="running" if inline else "queued",
+        scheduled_at=scheduled_at,
+        started_at=now if inline else None,
+        attempts=1 if inline else 0,
+        created_at=now,
+        meta_json=json.dumps(meta, ensure_ascii=False),
+    )
+    db.add(job)
+    return job
+
+
+def _finish_job(job: TriggerJob, result: Dict[str, Any]) -> None:
+    if result.get("reason") == "locked":
+        job.status = "queued"
+        job.scheduled_at = datetime.utcnow()
+    else:
+        job.status = "done"
+    job.last_error = None
+    meta = json.loads(job.meta_json or "{}")
+    meta["result"] = {k: result.get(k) for k in ("skipped", "reason", "range", "to_turn") if k in result}
+    job.meta_json = json.dumps(meta, ensure_ascii=False)
+    job.finished_at = datetime.utcnow()
+
+
+def _fail_job(job: TriggerJob, err: Exception) -> None:
+    job.status = "failed" if (job.attempts or 0) >= SUMMARY_JOB_MAX_ATTEMPTS else "queued"
+    job.last_error = repr(err)[:2000]
+    job.finished_at = datetime.utcnow()
+    print(f"[summary_jobs] job={job.id} type={job.trigger_type} FAILED err={err!r}")
+
+
+def _claim(db: OrmSession, job_id: str) -> bool:
+    res = db.execute(
+        update(TriggerJob)
+        .where(TriggerJob.id == job_id, TriggerJob.status == "queued", TriggerJob.scheduled_at <= datetime.utcnow())
+        .values(status="running", started_at=datetime.utcnow(), attempts=TriggerJob.attempts + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return res.rowcount == 1
+
+
+def execute_summary_job(db: OrmSession, job_id: str, *, claimed: bool = False) -> Dict[str, Any]:
+    from app.services.summarizer import run_s4, run_s60
+
+    if not claimed and not _claim(db, job_id):
+        job = db.get(TriggerJob, job_id)
+        now = datetime.utcnow()
+        if job is not None and job.status == "queued" and job.scheduled_at and job.scheduled_at > now:
+            # 防抖中：调用方按剩余时间重新挂上
+            due_in_s = (job.scheduled_at - now).total_seconds()
+            return {"skipped": True, "reason": "not_due", "job_id": job_id, "due_in_s": due_in_s}
+        return {"skipped": True, "reason": "not_queued", "job_id": job_id}
+
+    job = db.get(TriggerJob, job_id)
+    if job is None:
+        return {"skipped": True, "reason": "missing", "job_id": job_id}
+    params = json.loads(job.trigger_payload_json or "{}")
+    runner = run_s4 if job.trigger_type == "summary_s4" else run_s60
+
+    try:
+        result = runner(db, **params)
+        _finish_job(job, result)
+    except Exception as e:
+        db.rollback()
+        job = db.get(TriggerJob, job_id)
+        _fail_job(job, e)
+        result = {"error": repr(e), "job_id": job_id}
+    db.commit()
+    # 调试事件在 job 提交之后再落到共享存储（不和本事务抢写锁）
+    flush_debug_events()
+    return result
+
+
+def _claim_due(db: OrmSession, trigger_type: str, limit: int) -> List[str]:
+    ids = [
+        r[0] for r in db.query(TriggerJob.id)
+        .filter(TriggerJob.trigger_type == trigger_type)
+        .filter(TriggerJob.status == "queued")
+        .filter(TriggerJob.scheduled_at <= datetime.utcnow())
+        .order_by(TriggerJob.scheduled_at.asc())
+        .limit(limit)
+        .all()
+    ]
+    return [job_id for job_id in ids if _claim(db, job_id)]
+
+
+def _run_claimed_batch(db: OrmSession, job_ids: List[str], *, concurrency: int, stats: Dict[str, Any]) -> None:
+    """
+    三段：串行 prepare（读库）-> 线程池并发 summarize（只调 LLM）-> 一次提交所有摘要行和 job 状态。
+    租约在提交之后才释放，其它进程不会在中途重复总结同一个窗口。
+    """
+    from app.services.summarizer import persist_window, prepare_s4_window, prepare_s60_window, window_exists
+
+    with ExitStack() as leases:
+        runnable = []
+        for job_id in job_ids:
+            job = db.get(TriggerJob, job_id)
+            params = json.loads(job.trigger_payload_json or "{}")
+            params.pop("lock_wait_s", None)
+            prepare = prepare_s4_window if job.trigger_type == "summary_s4" else prepare_s60_window
+            try:
+                # 每个 prepare 一个 savepoint：出 DB 错时只回滚它自己，整批的事务还能继续用、最后照常提交
+                with db.begin_nested():
+                    w, skip = prepare(db, **params)
+            except Exception as e:
+                _fail_job(job, e)
+                stats["failed"] += 1
+                continue
+            if w is not None and not leases.enter_context(summary_lease(w.lease_key, wait_s=0)):
+                skip = {"skipped": True, "reason": "locked", "to_turn": w.to_turn}
+            elif w is not None and window_exists(db, w):
+                skip = {"skipped": True, "reason": "exists", "to_turn": w.to_turn}
+            if w is None or skip is not None:
+                _finish_job(job, skip)
+                stats["skipped"] += 1
+                continue
+            runnable.append((job, w))
+
+        written = set()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = {pool.submit(w.summarize): (job, w) for job, w in runnable}
+            for fut in as_completed(futures):
+                job, w = futures[fut]
+                try:
+                    summary_obj = fut.result()
+                except Exception as e:
+                    _fail_job(job, e)
+                    stats["failed"] += 1
+                    continue
+                persist_window(db, w, summary_obj)
+                _finish_job(job, {"range": [w.from_turn, w.to_turn]})
+                written.add(w.session_id)
+                stats["summarized"] += 1
+                stats["input_tokens"] += w.input_tokens
+        db.commit()
+        for session_id in written:
+            invalidate_latest_summaries(session_id)
+
+
+def run_summary_batch(
+    db: OrmSession, *, limit: Optional[int] = None, concurrency: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    认领最多 limit 个到期的摘要 job，LLM 调用并发跑（积压 / 导入历史回填用）。
+    S4 先整批提交，S60 再跑：S60 分层输入要读到刚写好的 S4。
+    同一个 scope 的相邻窗口并发跑时，增量 S4 拿不到同批次的上一版，会按整窗重算（结果一样正确，只是输入多一些）。
+    """
+    limit = SUMMARY_BATCH_SIZE if limit is None else limit
+    concurrency = SUMMARY_BATCH_CONCURRENCY if concurrency is None else concurrency
+    stats: Dict[str, Any] = {"claimed": 0, "summarized": 0, "skipped": 0, "failed": 0, "input_tokens": 0}
+    t0 = time.perf_counter()
+    for trigger_type in SUMMARY_JOB_TYPES:
+        job_ids = _claim_due(db, trigger_type, limit - stats["claimed"])
+        stats["claimed"] += len(job_ids)
+        if job_ids:
+            _run_claimed_batch(db, job_ids, concurrency=concurrency, stats=stats)
+        if stats["claimed"] >= limit:
+            break
+    flush_debug_events()
+
+    secs = time.perf_counter() - t0
+    stats["secs"] = round(secs, 3)
+    stats["windows_per_min"] = round(stats["summarized"] * 60 / secs, 1) if secs > 0 else 0.0
+    stats["tokens_per_min"] = round(stats["input_tokens"] * 60 / secs, 1) if secs > 0 else 0.0
+    if stats["claimed"]:
+        print(
+            f"[summary_jobs] batch claimed={stats['claimed']} summarized={stats['summarized']} "
+            f"skipped={stats['skipped']} failed={stats['failed']} secs={stats['secs']} "
+            f"windows_per_min={stats['windows_per_min']} tokens_per_min={stats['tokens_per_min']}"
+        )
+    return stats
+
+
+def _run_due_inline(job_id: str) -> None:
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        result = execute_summary_job(db, job_id)
+    except Exception as e:
+        print(f"[summary_jobs] job={job_id} inline timer FAILED err={e!r}")
+        return
+    finally:
+        db.close()
+    if result.get("reason") == "not_due":
+        _arm_inline_timer(job_id, result["due_in_s"])
+
+
+def _arm_inline_timer(job_id: str, delay_s: float) -> None:
+    # 进程在到期前退出也不会丢：job 还是 queued，reconcile_summary_jobs 会补投
+    timer = threading.Timer(max(0.0, delay_s), _run_due_inline, args=[job_id])
+    timer.daemon = True
+    timer.start()
+
+
+def dispatch_summary_jobs(db: OrmSession, job_ids: List[str]) -> None:
+    """提交之后调用。"""
+    if not job_ids:
+        return
+    delays: Dict[str, float] = {}
+    if SUMMARY_DEBOUNCE_SECS > 0:
+        now = datetime.utcnow()
+        for job_id, scheduled_at in db.query(TriggerJob.id, TriggerJob.scheduled_at).filter(TriggerJob.id.in_(job_ids)):
+            delays[job_id] = max(0.0, (scheduled_at - now).total_seconds())
+    if SUMMARY_DISPATCH == "celery":
+        from app.celery_app import celery
+
+        for job_id in job_ids:
+            celery.send_task("app.tasks.run_summary_job", args=[job_id], countdown=delays.get(job_id) or None)
+        return
+    for job_id in job_ids:
+        if job_id in delays:
+            _arm_inline_timer(job_id, delays[job_id])
+        else:
+            execute_summary_job(db, job_id, claimed=True)
+
+
+def reconcile_summary_jobs(db: OrmSession, *, older_than_secs: int = 60, limit: int = 50) -> List[str]:
+    """
+    找回没被执行的 job：
+      - queued 超过 older_than_secs（celery 发送失败 / worker 没起）
+      - running 超过 SUMMARY_JOB_STALE_SECS（执行进程挂了）-> 退回 queued
+    返回重新排队的 job id（由调用方派发）。
+    """
+    now = datetime.utcnow()
+    stale = (
+        db.query(TriggerJob)
+        .filter(TriggerJob.trigger_type.in_(SUMMARY_JOB_TYPES))
+        .filter(TriggerJob.status == "running")
+        .filter(TriggerJob.started_at < now - timedelta(seconds=SUMMARY_JOB_STALE_SECS))
+        .limit(limit)
+        .all()
+    )
+    for job in stale:
+        job.status = "queued" if (job.attempts or 0) < SUMMARY_JOB_MAX_ATTEMPTS else "failed"
+        job.last_error = "stale running job"
+    db.commit()
+
+    rows = (
+        db.query(TriggerJob.id)
+        .filter(TriggerJob.trigger_type.in_(SUMMARY_JOB_TYPES))
+        .filter(TriggerJob.status == "queued")
+        .filter(TriggerJob.scheduled_at < now - timedelta(seconds=older_than_secs))
+        .order_by(TriggerJob.scheduled_at.asc())
+        .limit(limit)
+        .all()
+    )
+    return [r[0] for r in rows]
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as OrmSession
+
+from app.db.models import SummaryLease
+
+# -----------------------------
+# 摘要租约：同一个 dedupe_key（scope + ids + to_turn + version）同一时刻只有一个进程在调 LLM
+#
+# run_s4 / run_s60 的 "exists" 检查是先 SELECT 后 INSERT，两个并发 turn、或 web 和 worker 同时跑时
+# 都会通过检查、都付一次 LLM 调用。拿不到租约的一方直接跳过（reason=locked），或者等待对方写完。
+#
+# SUMMARY_LOCK_BACKEND:
+#   db（默认）-> summary_leases 表，先 INSERT 抢占（主键冲突 = 别人持有），过期的租约可以被 UPDATE 接管
+#   redis     -> SUMMARY_LOCK_REDIS_URL（默认 REDIS_URL），SET NX PX；释放时比对 owner
+#   none      -> 不加锁（单进程部署）
+# SUMMARY_LOCK_TTL_SECS：租约时长，要覆盖一次摘要调用（含重试），持有方崩溃后最多这么久可被接管
+# SUMMARY_LOCK_WAIT_SECS：拿不到时默认等多久（0 = 立即跳过）
+# -----------------------------
+
+SUMMARY_LOCK_BACKEND = (os.getenv("SUMMARY_LOCK_BACKEND", "db") or "db").strip().lower()
+SUMMARY_LOCK_TTL_SECS = int(os.getenv("SUMMARY_LOCK_TTL_SECS", "300"))
+SUMMARY_LOCK_WAIT_SECS = float(os.getenv("SUMMARY_LOCK_WAIT_SECS", "0"))
+_POLL_SECS = 0.2
+_REDIS_PREFIX = "summary_lease:"
+# 只删自己持有的锁
+_REDIS_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_redis_client = None
+
+
+def _new_owner() -> str:
+    # fork 之后 pid 会变，每次现取
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _redis():
+    global _redis_client
+    if _redis_client is None:
+        import redis
+
+        from app.core.config import REDIS_URL
+
+        url = os.getenv("SUMMARY_LOCK_REDIS_URL", "") or REDIS_URL
+        _redis_client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis_client
+
+
+def _db_try_acquire(key: str, owner: str) -> bool:
+    from app.db.session import SessionLocal
+
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=SUMMARY_LOCK_TTL_SECS)
+    # 独立连接、立即提交：租约必须对其它进程可见，不能挂在调用方的事务上
+    db = SessionLocal()
+    try:
+        try:
+            db.add(SummaryLease(lease_key=key, owner=owner, created_at=now, expires_at=expires_at))
+            db.commit()
+            return True
+        except IntegrityError:
+            db.rollback()
+        # 持有方崩溃留下的过期租约：条件 UPDATE 接管，并发接管只有一个成功
+        res = db.execute(
+            update(SummaryLease)
+            .where(SummaryLease.lease_key == key, SummaryLease.expires_at < now)
+            .values(owner=owner, created_at=now, expires_at=expires_at)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        return res.rowcount == 1
+    finally:
+        db.close()
+
+
+def _db_release(key: str, owner: str) -> None:
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        db.execute(delete(SummaryLease).where(SummaryLease.lease_key == key, SummaryLease.owner == owner))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _try_acquire(key: str, owner: str) -> bool:
+    if SUMMARY_LOCK_BACKEND == "redis":
+        return bool(_redis().set(_REDIS_PREFIX + key, owner, nx=True, px=SUMMARY_LOCK_TTL_SECS * 1000))
+    return _db_try_acquire(key, owner)
+
+
+def _release(key: str, owner: str) -> None:
+    if SUMMARY_LOCK_BACKEND == "redis":
+        _redis().eval(_REDIS_RELEASE, 1, _REDIS_PREFIX + key, owner)
+    else:
+        _db_release(key, owner)
+
+
+@contextmanager
+def summary_lease(key: str, *, wait_s: Optional[float] = None) -> Iterator[bool]:
+    """
+    with summary_lease(dedupe_key) as held:
+        if not held: 别人在跑这个窗口
+    wait_s > 0 时在这段时间内轮询重试；拿到租约后调用方应再查一次结果是否已经写入（对方可能刚写完）。
+    后端出错时按"拿到了"处理：锁只是省钱，不能因为它让摘要停摆。
+    """
+    if SUMMARY_LOCK_BACKEND not in {"db", "redis"}:
+        yield True
+        return
+
+    owner = _new_owner()
+    deadline = time.monotonic() + (SUMMARY_LOCK_WAIT_SECS if wait_s is None else wait_s)
+    held = False
+    backend_ok = True
+    while True:
+        try:
+            held = _try_acquire(key, owner)
+        except Exception as e:
+            print(f"[summary_lock] acquire failed backend={SUMMARY_LOCK_BACKEND} key={key} err={e!r}")
+            backend_ok = False
+            break
+        if held or time.monotonic() >= deadline:
+            break
+        time.sleep(_POLL_SECS)
+
+    try:
+        yield held or not backend_ok
+    finally:
+        if held:
+            try:
+                _release(key, owner)
+            except Exception as e:
+                print(f"[summary_lock] release failed backend={SUMMARY_LOCK_BACKEND} key={key} err={e!r}")
+
+
+def purge_expired_summary_leases(db: OrmSession) -> int:
+    """db 后端：清理持有方崩溃后没人接管的过期租约（redis 自带过期）。"""
+    if SUMMARY_LOCK_BACKEND != "db":
+        return 0
+    res = db.execute(delete(SummaryLease).where(SummaryLease.expires_at < datetime.utcnow()))
+    db.commit()
+    return res.rowcount or 0
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+# -----------------------------
+# Token budget（proxy 转发前的上下文裁剪）
+#
+# - 本地估算 token（不依赖 tokenizer，CJK 按字、其余按 ~4 字符/token）
+# - 每个模型一个上限：min(模型窗口, CONTEXT_BUDGET_MAX_TOKENS) - 预留输出 - 注入的 system block
+# - 超出预算时：先压缩过长的旧消息（保留头尾），再从最旧的对话开始整组丢弃
+#   被丢掉的历史已经被 S4/S60 覆盖，由注入的 Internal Memory block 代替
+# - 客户端自带的 system 消息（位置不变）和最后一条 user 消息永远保留
+# -----------------------------
+
+CONTEXT_BUDGET_ENABLED = os.getenv("CONTEXT_BUDGET_ENABLED", "1") == "1"
+# 成本控制上限：即使模型窗口更大，也最多发这么多
+CONTEXT_BUDGET_MAX_TOKENS = int(os.getenv("CONTEXT_BUDGET_MAX_TOKENS", "24000"))
+CONTEXT_BUDGET_DEFAULT_MODEL_LIMIT = int(os.getenv("CONTEXT_BUDGET_DEFAULT_MODEL_LIMIT", "32000"))
+CONTEXT_BUDGET_RESERVE_OUTPUT = int(os.getenv("CONTEXT_BUDGET_RESERVE_OUTPUT", "2048"))
+# 单条旧消息超过这个值时先压缩（保留头尾），而不是整条丢掉
+CONTEXT_BUDGET_MSG_MAX_TOKENS = int(os.getenv("CONTEXT_BUDGET_MSG_MAX_TOKENS", "1500"))
+
+# 模型名前缀 -> 上下文窗口；CONTEXT_BUDGET_MODEL_LIMITS='{"deepseek/": 64000}' 可覆盖/追加
+_DEFAULT_MODEL_LIMITS: Dict[str, int] = {
+    "openai/gpt-4o": 128000,
+    "gpt-4o": 128000,
+    "openai/gpt-4.1": 1000000,
+    "anthropic/claude": 200000,
+    "google/gemini": 1000000,
+    "deepseek/": 64000,
+    "qwen/": 32000,
+}
+
+
+def _load_model_limits() -> Dict[str, int]:
+    limits = dict(_DEFAULT_MODEL_LIMITS)
+    raw = os.getenv("CONTEXT_BUDGET_MODEL_LIMITS", "").strip()
+    if raw:
+        try:
+            for k, v in (json.loads(raw) or {}).items():
+                limits[str(k)] = int(v)
+        except Exception as e:
+            print(f"[token_budget] bad CONTEXT_BUDGET_MODEL_LIMITS err={e}")
+    return limits
+
+
+MODEL_LIMITS = _load_model_limits()
+
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+_MSG_OVERHEAD = 4
+_IMAGE_TOKENS = 765
+_TRIM_MARK = "\n…(中间内容已省略)…\n"
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    rest = len(text) - cjk
+    return cjk + (rest + 3) // 4
+
+
+def _content_text(content: Any) -> Tuple[str, int]:
+    """返回 (可估算文本, 额外固定开销)。多模态 content 里的图片按固定值计。"""
+    if content is None:
+        return "", 0
+    if isinstance(content, str):
+        return content, 0
+    if isinstance(content, list):
+        texts: List[str] = []
+        extra = 0
+        for part in content:
+            if isinstance(part, dict):
+                if part.get("type") == "text":
+                    texts.append(str(part.get("text") or ""))
+                elif part.get("type") in ("image_url", "input_image", "image"):
+                    extra += _IMAGE_TOKENS
+                else:
+                    texts.append(json.dumps(part, ensure_ascii=False))
+            else:
+                texts.append(str(part))
+        return "\n".join(texts), extra
+    return json.dumps(content, ensure_ascii=False), 0
+
+
+def estimate_message_tokens(m: Dict[str, Any]) -> int:
+    text, extra = _content_text(m.get("content"))
+    n = _MSG_OVERHEAD + estimate_tokens(text) + extra
+    for k in ("tool_calls", "function_call"):
+        if m.get(k) is not None:
+            n += estimate_tokens(json.dumps(m.get(k), ensure_ascii=False))
+    return n
+
+
+def estimate_messages_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(estimate_message_tokens(m) for m in messages or [] if isinstance(m, dict))
+
+
+def model_context_limit(model: str) -> int:
+    name = (model or "").strip().lower()
+    best = ""
+    for prefix in MODEL_LIMITS:
+        if name.startswith(prefix.lower()) and len(prefix) > len(best):
+            best = prefix
+    return MODEL_LIMITS[best] if best else CONTEXT_BUDGET_DEFAULT_MODEL_LIMIT
+
+
+@dataclass
+class BudgetReport:
+    budget: int
+    tokens_in: int
+    tokens_out: int
+    dropped: int = 0
+    compacted: int = 0
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            "X-Context-Budget": str(self.budget),
+            "X-Context-Tokens-In": str(self.tokens_in),
+            "X-Context-Tokens-Out": str(self.tokens_out),
+            "X-Context-Dropped": str(self.dropped),
+            "X-Context-Compacted": str(self.compacted),
+        }
+
+
+def _group_turns(messages: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    # assistant(tool_calls) 和后面跟着的 tool 消息是一组，要丢一起丢，避免上游报 tool_call_id 不匹配；
+    # 中间插着的 system 消息并入前一组（不会被丢，也不打断 tool 链）
+    groups: List[List[Dict[str, Any]]] = []
+    for m in messages:
+        if m.get("role") in ("tool", "system") and groups:
+            groups[-1].append(m)
+        else:
+            groups.append([m])
+    return groups
+
+
+def _compact_message(m: Dict[str, Any], max_tokens: int) -> Optional[Dict[str, Any]]:
+    content = m.get("content")
+    if not isinstance(content, str) or estimate_message_tokens(m) <= max_tokens:
+        return None
+    # 按字符比例截取头尾（估算值，够用）
+    ratio = max_tokens / float(estimate_tokens(content) or 1)
+    keep = max(1, int(len(content) * ratio / 2))
+    m2 = dict(m)
+    m2["content"] = content[:keep] + _TRIM_MARK + content[-keep:]
+    return m2
+
+
+def apply_token_budget(
+    messages: List[Dict[str, Any]],
+    *,
+    model: str,
+    system_tokens: int = 0,
+    max_output_tokens: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], BudgetReport]:
+    """
+    messages 是客户端原始对话（还没注入 Internal Memory / anchor）。
+    system_tokens 是即将注入的 system block 的估算值，计入预算。
+    """
+    try:
+        reserve = int(max_output_tokens) if max_output_tokens else CONTEXT_BUDGET_RESERVE_OUTPUT
+    except (TypeError, ValueError):
+        reserve = CONTEXT_BUDGET_RESERVE_OUTPUT
+    limit = min(model_context_limit(model), CONTEXT_BUDGET_MAX_TOKENS)
+    budget = max(0, limit - reserve - system_tokens)
+    tokens_in = estimate_messages_tokens(messages)
+    report = BudgetReport(budget=budget, tokens_in=tokens_in, tokens_out=tokens_in)
+    if not CONTEXT_BUDGET_ENABLED or tokens_in <= budget:
+        return messages, report
+
+    msgs = [m for m in messages if isinstance(m, dict)]
+    last_user_idx = max(
+        (i for i, m in enumerate(msgs) if m.get("role") == "user"),
+        default=max((i for i, m in enumerate(msgs) if m.get("role") != "system"), default=len(msgs)),
+    )
+    older, tail = msgs[:last_user_idx], msgs[last_user_idx:]
+
+    # 1) 压缩过长的旧消息（system 不动）
+    compacted_ids = set()
+    for i, m in enumerate(older):
+        if m.get("role") == "system":
+            continue
+        m2 = _compact_message(m, CONTEXT_BUDGET_MSG_MAX_TOKENS)
+        if m2 is not None:
+            older[i] = m2
+            compacted_ids.add(id(m2))
+
+    # 2) 从最新往回装，装不下的最旧部分整组丢弃；
+    #    system 消息算作所在组里不可丢的成员，留在原来的位置，只丢同组的其它消息
+    used = estimate_messages_tokens(tail) + estimate_messages_tokens([m for m in older if m.get("role") == "system"])
+    kept_groups: List[List[Dict[str, Any]]] = []
+    dropped = 0
+    full = False
+    for g in reversed(_group_turns(older)):
+        rest = [m for m in g if m.get("role") != "system"]
+        cost = estimate_messages_tokens(rest)
+        if not full and used + cost <= budget:
+            used += cost
+            kept_groups.append(g)
+            continue
+        full = True
+        dropped += len(rest)
+        kept_groups.append([m for m in g if m.get("role") == "system"])
+    kept_groups.reverse()
+
+    out = [m for g in kept_groups for m in g] + tail
+    report.dropped = dropped
+    # 压缩后又被丢掉的不算
+    report.compacted = sum(1 for m in out if id(m) in compacted_ids)
+    report.tokens_out = estimate_messages_tokens(out)
+    return out, report
+
+
+def build_trimmed_history_note(report: BudgetReport, has_summary: bool) -> str:
+    if not report.dropped:
+        return ""
+    if has_summary:
+        return f"【更早的 {report.dropped} 条对话已省略；上面的 Internal Memory 即其摘要，以它为准】"
+    return f"【更早的 {report.dropped} 条对话已省略】"
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import os
+from typing import Callable, Dict, Optional
+
+from app.services.token_budget import estimate_tokens
+
+# -----------------------------
+# 可插拔 tokenizer：写库时算 Message.content_tokens
+#
+# TOKENIZER:
+#   estimate（默认）        -> 本地估算，零依赖（与 proxy token budget 同一口径）
+#   tiktoken[:encoding]     -> 需要 pip install tiktoken，默认 cl100k_base；未安装时回退 estimate
+# 其它实现可以 register_tokenizer("name", fn) 后用 TOKENIZER=name 选中
+# -----------------------------
+
+TOKENIZER = (os.getenv("TOKENIZER", "estimate") or "estimate").strip()
+
+TokenCounter = Callable[[str], int]
+
+_registry: Dict[str, TokenCounter] = {"estimate": estimate_tokens}
+_active: Optional[TokenCounter] = None
+
+
+def register_tokenizer(name: str, fn: TokenCounter) -> None:
+    global _active
+    _registry[name] = fn
+    _active = None
+
+
+def _load_tiktoken(encoding: str) -> TokenCounter:
+    import tiktoken
+
+    enc = tiktoken.get_encoding(encoding or "cl100k_base")
+    return lambda text: len(enc.encode(text or "", disallowed_special=()))
+
+
+def get_tokenizer() -> TokenCounter:
+    global _active
+    if _active is not None:
+        return _active
+
+    name, _, arg = TOKENIZER.partition(":")
+    if name in _registry:
+        _active = _registry[name]
+    elif name == "tiktoken":
+        try:
+            _active = _registry[TOKENIZER] = _load_tiktoken(arg)
+        except Exception as e:
+            print(f"[tokenizer] tiktoken unavailable, fallback to estimate err={e}")
+            _active = estimate_tokens
+    else:
+        print(f"[tokenizer] unknown TOKENIZER={TOKENIZER!r}, fallback to estimate")
+        _active = estimate_tokens
+    return _active
+
+
+def tokenizer_name() -> str:
+    return TOKENIZER
+
+
+def count_tokens(text: Optional[str]) -> int:
+    return int(get_tokenizer()(text or ""))
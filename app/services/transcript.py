@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services.tokenizer import count_tokens
+
+# -----------------------------
+# 摘要输入的 transcript 预算（S4 / S60 共用，预算分开配）
+#
+# 以前窗口里的消息原样拼接：一段贴进来的日志或一条超长回复就能把摘要 prompt 撑爆，延迟也跟着涨。
+# 按顺序做：
+#   1) 去重：窗口内已经出现过的长行（>= TRANSCRIPT_DEDUPE_MIN_CHARS 字符）、连续重复的行直接去掉
+#   2) 单条上限：超过 TRANSCRIPT_MSG_MAX_TOKENS 的消息保留头尾、中间省略
+#   3) 总量还超预算：先把 assistant 的单条上限逐步减半，再减 user 的（用户说的话优先保留），
+#      仍然超出就从最旧的 assistant、再到最旧的 user 整条丢弃（最后一条消息永远保留）
+# 压缩比等统计随摘要写进 meta_json（s4_plan.transcript / provenance.transcript）。
+#
+# TRANSCRIPT_BUDGET_ENABLED（默认 1）、S4_INPUT_MAX_TOKENS（4000）、S60_INPUT_MAX_TOKENS（16000）
+# -----------------------------
+
+TRANSCRIPT_BUDGET_ENABLED = os.getenv("TRANSCRIPT_BUDGET_ENABLED", "1") == "1"
+S4_INPUT_MAX_TOKENS = int(os.getenv("S4_INPUT_MAX_TOKENS", "4000"))
+S60_INPUT_MAX_TOKENS = int(os.getenv("S60_INPUT_MAX_TOKENS", "16000"))
+TRANSCRIPT_MSG_MAX_TOKENS = int(os.getenv("TRANSCRIPT_MSG_MAX_TOKENS", "600"))
+TRANSCRIPT_DEDUPE_MIN_CHARS = int(os.getenv("TRANSCRIPT_DEDUPE_MIN_CHARS", "8"))
+
+# 逐步减半的单条上限不低于这个值（再短就只剩省略号了，不如整条丢）
+_MIN_CAP = 48
+_ELIDE_MARK = " …(中间省略)… "
+_DEDUPED_PLACEHOLDER = "(重复内容已省略)"
+
+
+@dataclass
+class TranscriptReport:
+    budget: int
+    tokens_in: int
+    tokens_out: int = 0
+    elided: int = 0
+    deduped_lines: int = 0
+    dropped: int = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "budget": self.budget,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "ratio": round(self.tokens_out / self.tokens_in, 3) if self.tokens_in else 1.0,
+            "elided": self.elided,
+            "deduped_lines": self.deduped_lines,
+            "dropped": self.dropped,
+        }
+
+
+def _line(m: Any, content: str) -> str:
+    # 和以前的 _render_transcript 同一格式
+    return f"{m.role}: {content}"
+
+
+def _dedupe(contents: List[str], report: TranscriptReport) -> List[str]:
+    seen = set()
+    out: List[str] = []
+    for content in contents:
+        kept: List[str] = []
+        prev = None
+        for raw in content.split("\n"):
+            key = raw.strip()
+            if key and (key == prev or (len(key) >= TRANSCRIPT_DEDUPE_MIN_CHARS and key in seen)):
+                report.deduped_lines += 1
+                continue
+            prev = key
+            if len(key) >= TRANSCRIPT_DEDUPE_MIN_CHARS:
+                seen.add(key)
+            kept.append(raw)
+        text = "\n".join(kept)
+        out.append(text if text.strip() or not content.strip() else _DEDUPED_PLACEHOLDER)
+    return out
+
+
+def _elide(text: str, tokens: int, cap: int) -> str:
+    if tokens <= cap:
+        return text
+    # 按字符比例取头尾（和 proxy 的 token_budget 同一做法，估算够用）
+    keep = max(1, int(len(text) * cap / float(tokens) / 2))
+    return text[:keep] + _ELIDE_MARK + text[-keep:]
+
+
+def budget_lines(msgs: List[Any], *, budget: int) -> Tuple[List[Optional[str]], TranscriptReport]:
+    """
+    每条消息渲染成一行（None = 被丢弃），和 msgs 一一对应；调用方自己拼（S60 分层输入要按段拼）。
+    """
+    verbatim = [_line(m, m.content or "") for m in msgs]
+    verbatim_tokens = [count_tokens(x) for x in verbatim]
+    report = TranscriptReport(budget=budget, tokens_in=sum(verbatim_tokens))
+    if not TRANSCRIPT_BUDGET_ENABLED or not msgs:
+        report.tokens_out = report.tokens_in
+        return list(verbatim), report
+
+    contents = _dedupe([m.content or "" for m in msgs], report)
+    content_tokens = [count_tokens(c) for c in contents]
+    is_user = [m.role == "user" for m in msgs]
+    caps = {True: TRANSCRIPT_MSG_MAX_TOKENS, False: TRANSCRIPT_MSG_MAX_TOKENS}
+
+    def render() -> Tuple[List[str], List[int]]:
+        lines = [_line(m, _elide(c, t, caps[u])) for m, c, t, u in zip(msgs, contents, content_tokens, is_user)]
+        return lines, [count_tokens(x) for x in lines]
+
+    lines, tokens = render()
+    # 先压 assistant，再压 user
+    for role_is_user in (False, True):
+        while sum(tokens) > budget and caps[role_is_user] > _MIN_CAP:
+            caps[role_is_user] = max(_MIN_CAP, caps[role_is_user] // 2)
+            lines, tokens = render()
+
+    out: List[Optional[str]] = list(lines)
+    total = sum(tokens)
+    if total > budget:
+        last = len(msgs) - 1
+        order = [i for i in range(last) if not is_user[i]] + [i for i in range(last) if is_user[i]]
+        for i in order:
+            if total <= budget:
+                break
+            total -= tokens[i]
+            out[i] = None
+            report.dropped += 1
+
+    report.elided = sum(1 for x, c, t, u in zip(out, contents, content_tokens, is_user) if x is not None and t > caps[u])
+    report.tokens_out = total
+    return out, report
+
+
+def build_transcript(msgs: List[Any], *, budget: int) -> Tuple[str, TranscriptReport]:
+    lines, report = budget_lines(msgs, budget=budget)
+    kept = [x for x in lines if x is not None]
+    if report.dropped:
+        kept.insert(0, f"…(省略 {report.dropped} 条较早的消息)…")
+    return "\n".join(kept), report
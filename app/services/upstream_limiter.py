@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Deque, Dict, Optional, Tuple
+
+# -----------------------------
+# Upstream admission control（AIMD 并发限流）
+#
+# - 每个 (upstream_url, api_key) 一个 limiter，进程内共享（uvicorn 单 event loop）
+# - 成功：limit 线性增长（每满一个窗口 +UPSTREAM_LIMIT_INCREASE）
+# - 429/503：limit 乘性下降，并按 retry-after 暂停放行
+# - 排队：按 thread_id 轮转（fair queue），总长度/单 thread 长度都有上限，超时直接拒绝
+# -----------------------------
+
+UPSTREAM_LIMITER_ENABLED = os.getenv("UPSTREAM_LIMITER_ENABLED", "1") == "1"
+UPSTREAM_LIMIT_INITIAL = float(os.getenv("UPSTREAM_LIMIT_INITIAL", "8"))
+UPSTREAM_LIMIT_MIN = float(os.getenv("UPSTREAM_LIMIT_MIN", "1"))
+UPSTREAM_LIMIT_MAX = float(os.getenv("UPSTREAM_LIMIT_MAX", "64"))
+UPSTREAM_LIMIT_INCREASE = float(os.getenv("UPSTREAM_LIMIT_INCREASE", "1"))
+UPSTREAM_LIMIT_DECREASE = float(os.getenv("UPSTREAM_LIMIT_DECREASE", "0.5"))
+# 同一波 429 里并发的请求会一起失败，窗口内只减一次，避免 limit 直接塌到 min
+UPSTREAM_LIMIT_DECREASE_WINDOW = float(os.getenv("UPSTREAM_LIMIT_DECREASE_WINDOW", "1.0"))
+UPSTREAM_QUEUE_MAX = int(os.getenv("UPSTREAM_QUEUE_MAX", "64"))
+UPSTREAM_QUEUE_PER_THREAD_MAX = int(os.getenv("UPSTREAM_QUEUE_PER_THREAD_MAX", "4"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "30"))
+UPSTREAM_RETRY_AFTER_MAX = float(os.getenv("UPSTREAM_RETRY_AFTER_MAX", "60"))
+
+_OVERLOAD_STATUS = {429, 503}
+
+
+class UpstreamLimiterError(RuntimeError):
+    """排队失败（队列满 / 等待超时），proxy 直接回 429。"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """retry-after 支持秒数和 HTTP-date 两种写法。"""
+    v = (value or "").strip()
+    if not v:
+        return None
+    try:
+        secs = float(v)
+    except ValueError:
+        try:
+            secs = parsedate_to_datetime(v).timestamp() - time.time()
+        except Exception:
+            return None
+    return max(0.0, min(secs, UPSTREAM_RETRY_AFTER_MAX))
+
+
+@dataclass
+class UpstreamPermit:
+    limiter: "AimdLimiter"
+    queued_ms: float
+    _released: bool = field(default=False, repr=False)
+
+    def release(self, status_code: Optional[int] = None, retry_after: Optional[str] = None) -> None:
+        """幂等：stream 的 finally 和兜底 background 都可能调到。"""
+        if self._released:
+            return
+        self._released = True
+        self.limiter._on_release(status_code, parse_retry_after(retry_after))
+
+
+class AimdLimiter:
+    def __init__(
+        self,
+        *,
+        initial: float = UPSTREAM_LIMIT_INITIAL,
+        min_limit: float = UPSTREAM_LIMIT_MIN,
+        max_limit: float = UPSTREAM_LIMIT_MAX,
+        increase: float = UPSTREAM_LIMIT_INCREASE,
+        decrease: float = UPSTREAM_LIMIT_DECREASE,
+        queue_max: int = UPSTREAM_QUEUE_MAX,
+        per_thread_max: int = UPSTREAM_QUEUE_PER_THREAD_MAX,
+    ):
+        self.min_limit = max(1.0, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.queue_max = queue_max
+        self.per_thread_max = per_thread_max
+        self.inflight = 0
+        self.blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._queued = 0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _has_capacity(self) -> bool:
+        return self.inflight < int(self.limit) and time.monotonic() >= self.blocked_until
+
+    def _retry_after_hint(self) -> float:
+        return max(1.0, self.blocked_until - time.monotonic())
+
+    async def acquire(self, thread_id: str, timeout: float = UPSTREAM_QUEUE_TIMEOUT) -> UpstreamPermit:
+        t0 = time.perf_counter()
+        if self._queued == 0 and self._has_capacity():
+            self.inflight += 1
+            return UpstreamPermit(self, 0.0)
+
+        key = thread_id or ""
+        q = self._queues.get(key)
+        if self._queued >= self.queue_max or (q is not None and len(q) >= self.per_thread_max):
+            raise UpstreamLimiterError("upstream_queue_full", self._retry_after_hint())
+
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        if q is None:
+            q = self._queues[key] = deque()
+        q.append(fut)
+        self._queued += 1
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=timeout)
+        except asyncio.TimeoutError:
+            if fut.done() and not fut.cancelled():
+                # 超时的同时刚好被放行：名额已经占了，照常返回
+                return UpstreamPermit(self, (time.perf_counter() - t0) * 1000)
+            self._drop_waiter(key, fut)
+            raise UpstreamLimiterError("upstream_queue_timeout", self._retry_after_hint())
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._on_release(None, None)
+            else:
+                self._drop_waiter(key, fut)
+            raise
+        return UpstreamPermit(self, (time.perf_counter() - t0) * 1000)
+
+    def _drop_waiter(self, key: str, fut: asyncio.Future) -> None:
+        q = self._queues.get(key)
+        if q is not None and fut in q:
+            q.remove(fut)
+            self._queued -= 1
+            if not q:
+                self._queues.pop(key, None)
+        if not fut.done():
+            fut.cancel()
+
+    def _dispatch(self) -> None:
+        # 按 thread 轮转放行：每个 thread 一次只拿一个名额，之后排到队尾
+        while self._queues and self._has_capacity():
+            key, q = next(iter(self._queues.items()))
+            fut = q.popleft()
+            self._queued -= 1
+            if q:
+                self._queues.move_to_end(key)
+            else:
+                self._queues.pop(key, None)
+            if fut.done():
+                continue
+            self.inflight += 1
+            fut.set_result(None)
+        self._schedule_wakeup()
+
+    def _schedule_wakeup(self) -> None:
+        # retry-after 暂停期间没有 release 事件，需要定时器把队列叫醒
+        if not self._queues or self._wakeup is not None:
+            return
+        delay = self.blocked_until - time.monotonic()
+        if delay <= 0:
+            return
+        loop = asyncio.get_running_loop()
+
+        def _wake() -> None:
+            self._wakeup = None
+            self._dispatch()
+
+        self._wakeup = loop.call_later(delay, _wake)
+
+    def _on_release(self, status_code: Optional[int], retry_after: Optional[float]) -> None:
+        self.inflight = max(0, self.inflight - 1)
+        if status_code in _OVERLOAD_STATUS:
+            now = time.monotonic()
+            if now - self._last_decrease >= UPSTREAM_LIMIT_DECREASE_WINDOW:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = now
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+        elif status_code is not None and status_code < 400:
+            # additive increase：每成功一个“窗口”（≈limit 次）limit +increase
+            self.limit = min(self.max_limit, self.limit + self.increase / max(self.limit, 1.0))
+        # 其他（4xx/5xx/网络异常）不调整 limit
+        self._dispatch()
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "queued": self._queued,
+            "blocked_for_s": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+        }
+
+
+_limiters: Dict[Tuple[str, str], AimdLimiter] = {}
+
+
+def _key_fingerprint(api_key: str) -> str:
+    # 不在内存 key 里保留明文 api key
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+
+
+def get_upstream_limiter(upstream_url: str, api_key: str) -> AimdLimiter:
+    k = (upstream_url, _key_fingerprint(api_key))
+    limiter = _limiters.get(k)
+    if limiter is None:
+        limiter = _limiters[k] = AimdLimiter()
+    return limiter
+
+
+async def acquire_upstream(upstream_url: str, api_key: str, thread_id: str) -> Optional[UpstreamPermit]:
+    """UPSTREAM_LIMITER_ENABLED=0 时返回 None（不限流）。"""
+    if not UPSTREAM_LIMITER_ENABLED:
+        return None
+    limiter = get_upstream_limiter(upstream_url, api_key)
+    return await limiter.acquire(thread_id, timeout=UPSTREAM_QUEUE_TIMEOUT)
+
+
+def limiter_snapshots() -> Dict[str, Dict[str, float]]:
+    return {f"{url}#{fp}": lim.snapshot() for (url, fp), lim in _limiters.items()}
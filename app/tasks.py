@@ -6,6 +6,13 @@ from datetime import datetime, timezone
 from app.celery_app import celery
 from app.db.session import SessionLocal
 from app.db.models import Message, TriggerJob
+from app.core.tracing import start_span
+from app.services.latest_summaries import get_latest_summaries
+from app.services.silence_scheduler import dispatch_due_silence, evaluate_silence, schedule_silence_many
+from app.services.silence_scheduler import scheduler_enabled as silence_scheduler_enabled
+from app.services.summary_cache import purge_expired_summary_cache
+from app.services.summary_lock import purge_expired_summary_leases
+from app.services.summary_jobs import SUMMARY_JOB_TYPES, execute_summary_job, reconcile_summary_jobs, run_summary_batch
 #from app.db.models import Session as ChatSession
 from app.db.models import TriggerJob, OutboxMessage, SummaryS4, SummaryS60, Message
 from app.db.models import Message, SummaryS4, SummaryS60
@@ -26,9 +33,11 @@ def tick():
 @celery.task(name="app.tasks.scan_triggers")
 def scan_triggers():
     """
-    MVP: 每分钟扫描一次
+    全量扫描所有 proactive session：
     规则：如果某 session 最后一次 user 消息距离现在 > threshold_minutes
          且最近 X 分钟内没创建过 silence job，则创建一个 TriggerJob
+    SILENCE_SCHEDULER_BACKEND=redis 时平时由 dispatch_silence_triggers 按到期时间触发，
+    这里降频成对账：补建漏掉的 job，并把每个 session 的下一次截止时间重新写回调度器。
     """
     from app.db.models import Session as ChatSession  # 如果还没导入就加上
 
@@ -37,59 +46,20 @@ def scan_triggers():
         # 查询所有启用了 proactive 的 session
         sessions = db.query(ChatSession).filter(ChatSession.proactive_enabled == True).all()
         created = 0
+        deadlines = []
+        now_naive = utc_now().replace(tzinfo=None)
 
         for s in sessions:
-            sid = s.id
-            threshold_minutes = s.silence_threshold_min or 240
-            cooldown_minutes = s.silence_cooldown_min or 120
-
-            # 1. 最后一次 user 消息
-            last_user = (db.query(Message)
-                         .filter(Message.session_id == sid, Message.role == "user")
-                         .order_by(Message.turn_id.desc())
-                         .first())
-            if not last_user:
-                continue
-
-            # 2. 计算静默时长（分钟）
-            now_naive = utc_now().replace(tzinfo=None)
-            silence_minutes = (now_naive - last_user.created_at).total_seconds() / 60.0
-            if silence_minutes < threshold_minutes:
-                continue
-
-            # 3. 检查冷却期（只看有效状态的任务）
-            recent_job = (db.query(TriggerJob)
-                          .filter(
-                              TriggerJob.session_id == sid,
-                              TriggerJob.trigger_type == "silence",
-                              TriggerJob.status.in_(["queued", "running", "done"])
-                          )
-                          .order_by(TriggerJob.created_at.desc())
-                          .first())
-            if recent_job:
-                delta = (now_naive - recent_job.created_at).total_seconds() / 60.0
-                if delta < cooldown_minutes:
-                    continue
-
-            # 4. 创建新 job
-            payload = {
-                "silence_minutes": round(silence_minutes, 1),
-                "threshold_minutes": threshold_minutes,
-                "cooldown_minutes": cooldown_minutes,
-            }
-            job = TriggerJob(
-                session_id=sid,
-                trigger_type="silence",
-                trigger_payload_json=json.dumps(payload, ensure_ascii=False),
-                status="queued",
-            )
-            db.add(job)
-            created += 1
+            made, next_due = evaluate_silence(db, s, now_naive)
+            created += made
+            if next_due is not None:
+                deadlines.append((s.id, next_due))
 
         db.commit()
+        schedule_silence_many(deadlines)
         if created:
             print(f"[scan_triggers] created {created} silence job(s)")
-        return {"created": created}
+        return {"created": created, "sessions": len(sessions)}
 
     except Exception as e:
         db.rollback()
@@ -98,17 +68,32 @@ def scan_triggers():
         db.close()
 
 
+@celery.task(name="app.tasks.dispatch_silence_triggers")
+def dispatch_silence_triggers():
+    """只处理调度器里已经到期的 session（SILENCE_SCHEDULER_BACKEND=redis）。"""
+    if not silence_scheduler_enabled():
+        return {"skipped": True}
+    db = SessionLocal()
+    try:
+        stats = dispatch_due_silence(db, utc_now().replace(tzinfo=None))
+        if stats["created"]:
+            print(f"[dispatch_silence_triggers] due={stats['due']} created={stats['created']}")
+        return stats
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
 def build_brief(db, session_id: str) -> dict:
-    s4 = (db.query(SummaryS4).filter(SummaryS4.session_id == session_id)
-          .order_by(SummaryS4.to_turn.desc()).first())
-    s60 = (db.query(SummaryS60).filter(SummaryS60.session_id == session_id)
-           .order_by(SummaryS60.to_turn.desc()).first())
+    latest = get_latest_summaries(db, session_id)
     recent = (db.query(Message).filter(Message.session_id == session_id)
               .order_by(Message.turn_id.desc()).limit(12).all()[::-1])
 
     return {
-        "s60": json.loads(s60.summary_json) if s60 else None,
-        "s4": json.loads(s4.summary_json) if s4 else None,
+        "s60": latest.s60["summary"] if latest.s60 else None,
+        "s4": latest.s4["summary"] if latest.s4 else None,
         "recent": [{"role": m.role, "turn": m.turn_id, "content": m.content} for m in recent],
     }
 
@@ -193,6 +178,7 @@ def process_trigger_jobs(limit: int = 5):
         jobs = (
             db.query(TriggerJob)
             .filter(TriggerJob.status == "queued")
+            .filter(~TriggerJob.trigger_type.in_(SUMMARY_JOB_TYPES))  # 摘要 job 走 run_summary_job
             .order_by(TriggerJob.scheduled_at.asc())
             .limit(limit)
             .all()
@@ -201,93 +187,103 @@ def process_trigger_jobs(limit: int = 5):
         for job in jobs:
             processed += 1
 
-            # ---- mark running ----
-            job.status = "running"
-            job.started_at = _now_naive()
-            job.attempts = (job.attempts or 0) + 1
-            db.add(job)
-            db.commit()
-
-            # ---- build context for decider ----
-            context_text = build_telegram_text(db, job.session_id, job.trigger_type, recent=6)
-
-            # ---- decide (LLM) ----
-            try:
-                decision_obj = decide_message(
-                    trigger_type=job.trigger_type,
-                    session_id=job.session_id,
-                    context_text=context_text,
-                )
-                decision = decision_obj.get("decision", "skip")
-                text = (decision_obj.get("text") or "").strip()
-                reason = (decision_obj.get("reason") or "").strip()
-                model = (decision_obj.get("model") or "unknown").strip()
-            except Exception as e:
-                # 决策失败也要落库，别让任务静默
-                decision = "skip"
-                text = ""
-                reason = f"decider_error: {repr(e)}"
-                model = "unknown"
-
-            # ---- create outbox record ----
-            out = OutboxMessage(
-                job_id=job.id,
-                channel="telegram",
-                recipient=os.getenv("TG_CHAT_ID", "").strip(),
-                decision=decision,
-                message_text=text if decision == "send" else None,
-                status="pending",
-                created_at=_now_naive(),
-                model_trace_json=json.dumps(
-                    {"model": model, "reason": reason, "decision": decision},
-                    ensure_ascii=False
-                ),
-            )
-            db.add(out)
-            db.commit()
-            db.refresh(out)
-
-            # ---- send if needed ----
             try:
-                if decision == "send" and out.recipient and text:
-                    send_telegram_message(text, chat_id=out.recipient)
-                    out.status = "sent"
-                    out.sent_at = _now_naive()
-                else:
-                    out.status = "sent" if decision == "skip" else "failed"
-                    if decision != "skip":
-                        # 走到这里通常是 chat_id 空 / text 空
-                        out.model_trace_json = json.dumps(
-                            {"model": model, "reason": reason, "decision": decision, "warn": "missing chat_id or text"},
-                            ensure_ascii=False
-                        )
-
-                # job done
-                job.status = "done" if out.status == "sent" else "failed"
-                job.finished_at = _now_naive()
-                job.last_error = None if out.status == "sent" else (out.model_trace_json or "send_failed")
-
-                db.add(out)
+                job_meta = json.loads(job.meta_json or "{}")
+            except Exception:
+                job_meta = {}
+            job_trace = job_meta.get("trace") if isinstance(job_meta, dict) else None
+            with start_span(
+                "trigger_job.process",
+                links_from=job_trace if isinstance(job_trace, dict) else None,
+                attributes={"trigger.job_id": job.id, "trigger.type": job.trigger_type, "gateway.session_id": job.session_id},
+            ):
+                # ---- mark running ----
+                job.status = "running"
+                job.started_at = _now_naive()
+                job.attempts = (job.attempts or 0) + 1
                 db.add(job)
                 db.commit()
 
-                print(f"[process_trigger_jobs] job={job.id} decision={decision} out_status={out.status}")
-
-            except Exception as e:
-                out.status = "failed"
-                out.model_trace_json = json.dumps(
-                    {"error": repr(e), "decision": decision, "model": model},
-                    ensure_ascii=False
+                # ---- build context for decider ----
+                context_text = build_telegram_text(db, job.session_id, job.trigger_type, recent=6)
+
+                # ---- decide (LLM) ----
+                try:
+                    decision_obj = decide_message(
+                        trigger_type=job.trigger_type,
+                        session_id=job.session_id,
+                        context_text=context_text,
+                    )
+                    decision = decision_obj.get("decision", "skip")
+                    text = (decision_obj.get("text") or "").strip()
+                    reason = (decision_obj.get("reason") or "").strip()
+                    model = (decision_obj.get("model") or "unknown").strip()
+                except Exception as e:
+                    # 决策失败也要落库，别让任务静默
+                    decision = "skip"
+                    text = ""
+                    reason = f"decider_error: {repr(e)}"
+                    model = "unknown"
+
+                # ---- create outbox record ----
+                out = OutboxMessage(
+                    job_id=job.id,
+                    channel="telegram",
+                    recipient=os.getenv("TG_CHAT_ID", "").strip(),
+                    decision=decision,
+                    message_text=text if decision == "send" else None,
+                    status="pending",
+                    created_at=_now_naive(),
+                    model_trace_json=json.dumps(
+                        {"model": model, "reason": reason, "decision": decision},
+                        ensure_ascii=False
+                    ),
                 )
-                job.status = "failed"
-                job.finished_at = _now_naive()
-                job.last_error = repr(e)
-
                 db.add(out)
-                db.add(job)
                 db.commit()
-
-                print(f"[process_trigger_jobs] job={job.id} FAILED err={repr(e)}")
+                db.refresh(out)
+
+                # ---- send if needed ----
+                try:
+                    if decision == "send" and out.recipient and text:
+                        send_telegram_message(text, chat_id=out.recipient)
+                        out.status = "sent"
+                        out.sent_at = _now_naive()
+                    else:
+                        out.status = "sent" if decision == "skip" else "failed"
+                        if decision != "skip":
+                            # 走到这里通常是 chat_id 空 / text 空
+                            out.model_trace_json = json.dumps(
+                                {"model": model, "reason": reason, "decision": decision, "warn": "missing chat_id or text"},
+                                ensure_ascii=False
+                            )
+
+                    # job done
+                    job.status = "done" if out.status == "sent" else "failed"
+                    job.finished_at = _now_naive()
+                    job.last_error = None if out.status == "sent" else (out.model_trace_json or "send_failed")
+
+                    db.add(out)
+                    db.add(job)
+                    db.commit()
+
+                    print(f"[process_trigger_jobs] job={job.id} decision={decision} out_status={out.status}")
+
+                except Exception as e:
+                    out.status = "failed"
+                    out.model_trace_json = json.dumps(
+                        {"error": repr(e), "decision": decision, "model": model},
+                        ensure_ascii=False
+                    )
+                    job.status = "failed"
+                    job.finished_at = _now_naive()
+                    job.last_error = repr(e)
+
+                    db.add(out)
+                    db.add(job)
+                    db.commit()
+
+                    print(f"[process_trigger_jobs] job={job.id} FAILED err={repr(e)}")
 
         return {"processed": processed}
 
@@ -321,3 +317,43 @@ def process_trigger_jobs(limit: int = 5):
 
 
     
+
+
+@celery.task(name="app.tasks.run_summary_job")
+def run_summary_job(job_id: str):
+    """chat_once 提交后投递（SUMMARY_DISPATCH=celery），或由 reconcile_summary_jobs 补投。"""
+    db = SessionLocal()
+    try:
+        result = execute_summary_job(db, job_id)
+    finally:
+        db.close()
+    if result.get("reason") == "not_due":
+        # 防抖期间被新消息顺延了：按剩余时间重新投递
+        run_summary_job.apply_async(args=[job_id], countdown=result["due_in_s"])
+    return result
+
+
+@celery.task(name="app.tasks.run_summary_batch")
+def run_summary_batch_task(limit: int | None = None, concurrency: int | None = None):
+    """积压 / 回填：一次认领一批到期的摘要 job，LLM 并发调用，结果整批提交；返回吞吐统计。"""
+    db = SessionLocal()
+    try:
+        return run_summary_batch(db, limit=limit, concurrency=concurrency)
+    finally:
+        db.close()
+
+
+@celery.task(name="app.tasks.reconcile_summary_jobs")
+def reconcile_summary_jobs_task():
+    db = SessionLocal()
+    try:
+        job_ids = reconcile_summary_jobs(db)
+        purged = purge_expired_summary_cache(db)
+        purge_expired_summary_leases(db)
+    finally:
+        db.close()
+    for job_id in job_ids:
+        run_summary_job.delay(job_id)
+    if job_ids:
+        print(f"[reconcile_summary_jobs] requeued {len(job_ids)} job(s)")
+    return {"requeued": len(job_ids), "cache_purged": purged}
@@ -0,0 +1,42 @@
+import sys
+import os
+import argparse
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db.session import SessionLocal
+from app.db.models import Message
+from app.services.tokenizer import count_tokens, tokenizer_name
+
+def main():
+    ap = argparse.ArgumentParser(description="回填 messages.content_tokens（默认只补 NULL）")
+    ap.add_argument("--batch", type=int, default=500)
+    ap.add_argument("--all", action="store_true", help="换了 TOKENIZER 后全部重算")
+    args = ap.parse_args()
+
+    db = SessionLocal()
+    try:
+        total = 0
+        last_id = ""
+        while True:
+            # 按主键 keyset 分批，避免一次把全表正文读进内存
+            q = db.query(Message.id, Message.content).filter(Message.id > last_id)
+            if not args.all:
+                q = q.filter(Message.content_tokens.is_(None))
+            rows = q.order_by(Message.id.asc()).limit(args.batch).all()
+            if not rows:
+                break
+            db.bulk_update_mappings(
+                Message,
+                [{"id": mid, "content_tokens": count_tokens(content)} for mid, content in rows],
+            )
+            db.commit()
+            total += len(rows)
+            last_id = rows[-1][0]
+            print(f"backfill batch={len(rows)} total={total}")
+        print(f"backfill done tokenizer={tokenizer_name()} rows={total}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
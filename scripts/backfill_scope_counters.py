@@ -0,0 +1,19 @@
+import sys
+import os
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db.session import SessionLocal
+from app.services.scope_counters import rebuild_scope_counters
+
+def main():
+    # 先跑 alembic upgrade head（scope_counters 表），再跑这个
+    db = SessionLocal()
+    try:
+        n = rebuild_scope_counters(db)
+        print(f"backfill done scope_counters={n}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import sys
+import os
+import json
+import argparse
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func
+
+from app.db.session import SessionLocal
+from app.db.models import Message, TriggerJob
+from app.services.chat_service import S4_SUMMARY_VERSION
+from app.services.summary_jobs import SUMMARY_JOB_TYPES, enqueue_summary_job, run_summary_batch
+
+# 导入历史后补摘要：按 chat_once 的触发规则（每 N 个 user_turn）把缺的 S4 / S60 窗口入队（exact_window，
+# 窗口按 to_user_turn 精确定位），再用 run_summary_batch 一批批并发跑完（已有摘要的窗口在 prepare 阶段直接跳过）
+#   python scripts/backfill_summaries.py --session-id <sid> [--session-id ...]
+#   python scripts/backfill_summaries.py --all --batch 100 --concurrency 16
+#   python scripts/backfill_summaries.py --all --enqueue-only        # 只入队，交给 worker 的 app.tasks.run_summary_batch
+
+def _pending_payloads(db, session_id):
+    rows = (
+        db.query(TriggerJob.trigger_type, TriggerJob.trigger_payload_json)
+        .filter(TriggerJob.session_id == session_id)
+        .filter(TriggerJob.trigger_type.in_(SUMMARY_JOB_TYPES))
+        .filter(TriggerJob.status.in_(("queued", "running")))
+        .all()
+    )
+    return {(t, p) for t, p in rows}
+
+
+def enqueue_session(db, session_id, args):
+    pending = _pending_payloads(db, session_id)
+    n = 0
+
+    def add(kind, params):
+        nonlocal n
+        if (f"summary_{kind}", json.dumps(params, ensure_ascii=False)) in pending:
+            return
+        enqueue_summary_job(db, kind, session_id=session_id, params=params, queued=True)
+        n += 1
+
+    combos = (
+        db.query(Message.thread_id, Message.memory_id, Message.agent_id)
+        .filter(Message.session_id == session_id)
+        .distinct()
+        .all()
+    )
+
+    def user_turns(**filters):
+        q = db.query(func.count(Message.id)).filter(Message.session_id == session_id, Message.role == "user")
+        for col, value in filters.items():
+            if value is not None:
+                q = q.filter(getattr(Message, col) == value)
+        return int(q.scalar() or 0)
+
+    # S4：thread scope，每个 thread 各自计数（和 summarizer 取窗口的口径一致：都在本 session 内）
+    for thread_id in sorted({t for t, _, _ in combos}, key=lambda x: x or ""):
+        memory_id, agent_id = next((m, a) for t, m, a in combos if t == thread_id)
+        for k in range(args.s4_every, user_turns(thread_id=thread_id) + 1, args.s4_every):
+            add("s4", dict(
+                session_id=session_id, to_user_turn=k, window_user_turn=args.s4_window, model_name=args.model_name,
+                thread_id=thread_id, memory_id=memory_id, agent_id=agent_id, s4_scope="thread",
+                summary_version=S4_SUMMARY_VERSION, exact_window=True,
+            ))
+    # S60：memory scope（memory_id / agent_id）
+    for memory_id, agent_id in sorted({(m, a) for _, m, a in combos}, key=lambda x: (x[0] or "", x[1] or "")):
+        for k in range(args.s60_every, user_turns(memory_id=memory_id, agent_id=agent_id) + 1, args.s60_every):
+            add("s60", dict(
+                session_id=session_id, to_user_turn=k, window_user_turn=args.s60_window, model_name=args.model_name,
+                thread_id=None, memory_id=memory_id, agent_id=agent_id, summary_version=1, exact_window=True,
+            ))
+    db.commit()
+    return n
+
+
+def main():
+    ap = argparse.ArgumentParser(description="导入历史后批量补 S4 / S60 摘要")
+    ap.add_argument("--session-id", action="append", default=[])
+    ap.add_argument("--all", action="store_true", help="所有有消息的 session")
+    ap.add_argument("--s4-every", type=int, default=4)
+    ap.add_argument("--s4-window", type=int, default=4)
+    ap.add_argument("--s60-every", type=int, default=30)
+    ap.add_argument("--s60-window", type=int, default=30)
+    ap.add_argument("--model-name", default="summarizer_mvp")
+    ap.add_argument("--batch", type=int, default=None, help="默认 SUMMARY_BATCH_SIZE")
+    ap.add_argument("--concurrency", type=int, default=None, help="默认 SUMMARY_BATCH_CONCURRENCY")
+    ap.add_argument("--enqueue-only", action="store_true")
+    args = ap.parse_args()
+
+    db = SessionLocal()
+    try:
+        session_ids = list(args.session_id)
+        if args.all:
+            session_ids += [r[0] for r in db.query(Message.session_id).distinct().all()]
+        if not session_ids:
+            ap.error("需要 --session-id 或 --all")
+
+        enqueued = sum(enqueue_session(db, sid, args) for sid in dict.fromkeys(session_ids))
+        print(f"enqueued windows={enqueued} sessions={len(session_ids)}")
+        if args.enqueue_only:
+            return
+
+        total = {"summarized": 0, "skipped": 0, "failed": 0, "input_tokens": 0, "secs": 0.0}
+        while True:
+            stats = run_summary_batch(db, limit=args.batch, concurrency=args.concurrency)
+            if not stats["claimed"]:
+                break
+            for k in total:
+                total[k] += stats[k]
+        secs = total["secs"] or 1e-9
+        print(
+            f"backfill done summarized={total['summarized']} skipped={total['skipped']} failed={total['failed']} "
+            f"secs={secs:.1f} windows_per_min={total['summarized'] * 60 / secs:.1f} "
+            f"tokens_per_min={total['input_tokens'] * 60 / secs:.0f}"
+        )
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
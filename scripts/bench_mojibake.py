@@ -0,0 +1,332 @@
+import sys
+import os
+import time
+import argparse
+from typing import Any, Dict, List, Optional
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import summarizer
+
+# mojibake 检测 / 修复的 micro-benchmark：对照改造前的实现，确认输出（含 repair.decision 事件）完全一致并给出耗时
+#   python scripts/bench_mojibake.py [--repeat 200]
+# 样本：真实的 "UTF-8 被按 latin-1 / cp1252 解码" 乱码（单层、双层、带控制字符）+ 干净中文 / 英文 / emoji
+
+
+# ========= 改造前的实现（对照组，原样保留）=========
+
+_legacy_events: List[Dict[str, Any]] = []
+
+
+def _push_debug_event(event: Dict[str, Any]) -> None:
+    _legacy_events.append(event)
+
+
+def _count_cjk_chars(s: str) -> int:
+    return sum(1 for ch in s if "一" <= ch <= "鿿")
+
+
+def _strip_ctrl(s: str) -> str:
+    # 去掉 U+0080..U+009F 控制字符（常见转码噪声）
+    return "".join(ch for ch in s if not ("\u0080" <= ch <= "\u009f"))
+
+
+def _mojibake_score(text: str) -> int:
+    if not text:
+        return 0
+    # 兼容两边：常见“UTF-8 被按 latin-1/cp1252 解码”污染标记 + 控制符噪声 + 异常拉丁串
+    marker_chars = ("Ã", "Â", "æ", "å", "è", "ç", "ä", "ð")
+    marker_hits = sum(text.count(m) for m in marker_chars)
+    ctrl_hits = _ctrl_char_count(text)
+    bad_latin_runs = _bad_latin_run_count(text)
+    return marker_hits + ctrl_hits + bad_latin_runs
+
+
+def _mojibake_markers_hit(text: str) -> List[str]:
+    if not text:
+        return []
+
+    hits: List[str] = []
+    marker_chars = ("Ã", "Â", "æ", "å", "è", "ç", "ä", "ð")
+    for marker in marker_chars:
+        count = text.count(marker)
+        if count > 0:
+            hits.append(f"char:{marker}x{count}")
+
+    ctrl_hits = _ctrl_char_count(text)
+    if ctrl_hits > 0:
+        hits.append(f"range:U+0080-U+009Fx{ctrl_hits}")
+
+    bad_latin_runs = _bad_latin_run_count(text)
+    if bad_latin_runs > 0:
+        hits.append(f"pattern:bad_latin_runsx{bad_latin_runs}")
+
+    return hits
+
+
+def _ctrl_char_count(text: str) -> int:
+    return sum(1 for ch in text if "\u0080" <= ch <= "\u009f")
+
+
+def _bad_latin_run_count(text: str) -> int:
+    bad_chars = {"æ", "å", "è", "ç", "Ã", "Â"}
+    run_count = 0
+    in_run = False
+    for ch in text:
+        if ch in bad_chars:
+            if not in_run:
+                run_count += 1
+                in_run = True
+        else:
+            in_run = False
+    return run_count
+
+
+def _looks_mojibake_text(text: str) -> bool:
+    return _mojibake_score(text) > 0 or _ctrl_char_count(text) > 0
+
+
+def _try_recode(s: str, src: str) -> Optional[str]:
+    byte_candidates = []
+    for seed in (s, _strip_ctrl(s)):
+        try:
+            byte_candidates.append(seed.encode(src, errors="strict"))
+        except Exception:
+            continue
+
+    for b in byte_candidates:
+        for decode_errors in ("strict", "replace"):
+            try:
+                t = b.decode("utf-8", errors=decode_errors)
+                return _strip_ctrl(t)
+            except Exception:
+                continue
+    return None
+
+
+def _maybe_repair_mojibake_text(
+    text: str,
+    *,
+    session_id: Optional[str] = None,
+    field_path: Optional[str] = None,
+) -> str:
+    """尝试修复“UTF-8 bytes 被按 latin-1/cp1252 解码后再传输”的文本污染。"""
+    if not text:
+        return text
+
+    # 如果本来中文就足够、且没有明显 mojibake 标记，就只做控制字符清理
+    bad_markers = ("Ã", "Â", "æ", "ä", "å", "ç", "ð")
+    if _count_cjk_chars(text) >= 2 and not any(m in text for m in bad_markers):
+        return _strip_ctrl(text)
+
+    def metrics(s: str) -> Dict[str, int]:
+        return {
+            "cjk_count": _count_cjk_chars(s),
+            "mojibake_marker_count": _mojibake_score(s),
+            "replacement_char_count": s.count("�"),
+            "ctrl_char_count": _ctrl_char_count(s),
+            "bad_latin_runs": _bad_latin_run_count(s),
+        }
+
+    def ordering_key(m: Dict[str, int]) -> tuple[int, int, int, int, int]:
+        # 优先级：CJK 更多 > mojibake 更少 > 控制/替换字符更少 > 异常拉丁串更少
+        return (
+            m["cjk_count"],
+            -m["mojibake_marker_count"],
+            -(m["ctrl_char_count"] + m["replacement_char_count"]),
+            -m["bad_latin_runs"],
+            -m["replacement_char_count"],
+        )
+
+    original_score = _mojibake_score(text)
+    max_rounds = 2 + (1 if original_score > 2 else 0) + (1 if original_score > 5 else 0)
+
+    best = _strip_ctrl(text)
+    best_metrics = metrics(best)
+
+    candidates = {text}
+    for _ in range(max_rounds):
+        next_round = set()
+        for seed in list(candidates):
+            for src in ("latin-1", "cp1252"):
+                candidate = _try_recode(seed, src)
+                if candidate and candidate not in candidates:
+                    next_round.add(candidate)
+        if not next_round:
+            break
+        candidates.update(next_round)
+
+    for candidate in candidates:
+        cleaned = _strip_ctrl(candidate)
+        current_metrics = metrics(cleaned)
+
+        # 统一按指标排序，选择最优候选。
+        if ordering_key(current_metrics) > ordering_key(best_metrics):
+            best = cleaned
+            best_metrics = current_metrics
+
+    # 若没有获得任何提升，保留原文本（仅清理控制字符）避免过修复
+    if not _looks_mojibake_text(text):
+        return _strip_ctrl(text)
+
+    base_clean = _strip_ctrl(text)
+    latin1_utf8 = _try_recode(base_clean, "latin-1")
+    cp1252_utf8 = _try_recode(base_clean, "cp1252")
+
+    candidate_scores: Dict[str, Dict[str, Any]] = {
+        "raw": metrics(base_clean),
+        "latin1_utf8": metrics(latin1_utf8) if latin1_utf8 else {"decode_failed": 1},
+        "cp1252_utf8": metrics(cp1252_utf8) if cp1252_utf8 else {"decode_failed": 1},
+    }
+
+    chosen = "raw"
+    if latin1_utf8 and _strip_ctrl(latin1_utf8) == best:
+        chosen = "latin1_utf8"
+    elif cp1252_utf8 and _strip_ctrl(cp1252_utf8) == best:
+        chosen = "cp1252_utf8"
+
+    raw_metrics = candidate_scores["raw"]
+    chosen_metrics = metrics(best)
+    reason = "keep_raw_no_improvement"
+    if chosen != "raw":
+        if chosen_metrics["cjk_count"] > raw_metrics["cjk_count"]:
+            reason = "higher_cjk_lower_noise"
+        elif (
+            chosen_metrics["mojibake_marker_count"] < raw_metrics["mojibake_marker_count"]
+            or chosen_metrics["ctrl_char_count"] < raw_metrics["ctrl_char_count"]
+            or chosen_metrics["replacement_char_count"] < raw_metrics["replacement_char_count"]
+        ):
+            reason = "lower_noise"
+        else:
+            reason = "better_ordering_score"
+
+    _push_debug_event(
+        {
+            "stage": "repair.decision",
+            "session_id": session_id,
+            "field_path": field_path,
+            "raw_preview": text[:120],
+            "candidate_scores": candidate_scores,
+            "chosen": chosen,
+            "reason": reason,
+            "selected_preview": best[:120],
+            "total_candidates": len(candidates),
+            "max_rounds": max_rounds,
+        }
+    )
+
+    return _strip_ctrl(best)
+
+
+# ========= 样本 =========
+
+_ZH = [
+    "我们讨论了一下周末去爬山的计划，需要准备水和零食",
+    "用户最近工作压力很大，希望晚上能早点休息",
+    "关心/轻松",
+    "还没决定是去公园还是去咖啡店",
+    "约束：周三之前必须交报告",
+]
+_CLEAN = _ZH + [
+    "无明显推进",
+    "User wants to finish the report before Friday",
+    "ok",
+    "今天心情不错 😀 一起去散步吧",
+    "goal: 完成 MVP；state: 已接入 Telegram",
+]
+
+
+def _mojibake_samples() -> List[str]:
+    out: List[str] = []
+    for s in _ZH:
+        b = s.encode("utf-8")
+        out.append(b.decode("latin-1"))                                   # 单层 latin-1（带 U+0080..U+009F 控制符）
+        out.append(b.decode("cp1252", errors="replace"))                  # 单层 cp1252
+        out.append(b.decode("latin-1").encode("utf-8").decode("latin-1"))  # 双层
+        out.append(s[:6] + b[6:30].decode("latin-1"))                     # 半截污染
+    return out
+
+
+def _summary_objs(mojibake: List[str]) -> List[Dict[str, Any]]:
+    clean = {
+        "goal": _ZH[0],
+        "state": _ZH[1],
+        "open_loops": [_ZH[3], "无"],
+        "constraints": [_ZH[4]],
+        "tone_notes": [_ZH[2]],
+    }
+    dirty = dict(clean, state=mojibake[0], open_loops=[mojibake[5], _ZH[3]])
+    # 稳态：绝大多数摘要是干净的
+    return [clean] * 9 + [dirty]
+
+
+def _bench(fn, items, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for x in items:
+            fn(x)
+    return (time.perf_counter() - t0) / (repeat * len(items)) * 1e6
+
+
+def _legacy_obj(obj: Any) -> Any:
+    if isinstance(obj, str):
+        return _maybe_repair_mojibake_text(obj)
+    if isinstance(obj, list):
+        return [_legacy_obj(x) for x in obj]
+    if isinstance(obj, dict):
+        return {k: _legacy_obj(v) for k, v in obj.items()}
+    return obj
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+
+    dirty = _mojibake_samples()
+    samples = _CLEAN + dirty
+
+    # 1) 输出一致性（修复文本 + repair.decision 事件）
+    mismatches = 0
+    new_events: List[Dict[str, Any]] = []
+    push = summarizer._push_debug_event
+    summarizer._push_debug_event = lambda event, **kw: new_events.append(event)
+    for s in samples:
+        _legacy_events.clear()
+        new_events.clear()
+        old = _maybe_repair_mojibake_text(s)
+        new = summarizer._maybe_repair_mojibake_text(s)
+        old_ev = [{k: v for k, v in e.items() if k != "ts"} for e in _legacy_events]
+        new_ev = [{k: v for k, v in e.items() if k != "ts"} for e in new_events]
+        if old != new or old_ev != new_ev:
+            mismatches += 1
+            print(f"MISMATCH {s!r}: legacy={old!r} new={new!r}")
+    summarizer._push_debug_event = push
+    repaired = sum(1 for s in dirty if summarizer._maybe_repair_mojibake_text(s) != s)
+    print(f"samples={len(samples)} clean={len(_CLEAN)} mojibake={len(dirty)} repaired={repaired} mismatches={mismatches}")
+
+    # 2) 耗时（每次调用 µs）；new_cold 每轮清空记忆化缓存，只体现单次扫描 + 有界搜索
+    def new_cold(s: str) -> str:
+        summarizer._repair_decision.cache_clear()
+        summarizer._try_recode.cache_clear()
+        return summarizer._maybe_repair_mojibake_text(s)
+
+    rows = [
+        ("clean_str", _CLEAN),
+        ("mojibake_str", dirty),
+    ]
+    for name, items in rows:
+        old_us = _bench(_maybe_repair_mojibake_text, items, args.repeat)
+        cold_us = _bench(new_cold, items, max(1, args.repeat // 10))
+        new_us = _bench(summarizer._maybe_repair_mojibake_text, items, args.repeat)
+        print(f"{name:14s} legacy={old_us:8.2f}us new_cold={cold_us:8.2f}us new={new_us:8.2f}us "
+              f"speedup={old_us / new_us:6.1f}x")
+
+    objs = _summary_objs(dirty)
+    old_us = _bench(_legacy_obj, objs, args.repeat)
+    new_us = _bench(summarizer._repair_mojibake_in_obj, objs, args.repeat)
+    print(f"{'summary_obj':14s} legacy={old_us:8.2f}us new={new_us:8.2f}us speedup={old_us / new_us:6.1f}x")
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import sys
+import os
+import time
+import argparse
+import tempfile
+from datetime import datetime
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from app.db.session import Base, make_engine
+from app.db.models import Message
+from app.services.summarizer import _build_scope_query, _load_scope_window
+
+# S4/S60 取窗口的耗时：单个长 session（默认 10 万条消息）上对比旧实现（整段历史 ORM 行 + 再取一次）和 _load_scope_window
+#   python scripts/bench_scope_window.py
+#   python scripts/bench_scope_window.py --messages 200000 --repeat 20 --url postgresql+psycopg://u:p@127.0.0.1/bench
+
+SID, TID, MID, AID = "bench-scope", "bench-thread", "bench-memory", "bench-agent"
+
+
+def legacy_window(db, *, to_user_turn, window_user_turn, scope_type):
+    """改造前的写法：limit(to_user_turn) 读整段 user 消息（含正文），Python 里去重后再按 IN 取一遍。"""
+    scope = dict(session_id=SID, scope_type=scope_type, thread_id=TID, memory_id=MID, agent_id=AID)
+    rows = (
+        _build_scope_query(db, **scope)
+        .filter(Message.role == "user")
+        .order_by(Message.turn_id.desc())
+        .limit(to_user_turn)
+        .all()
+    )
+    ordered, seen = [], set()
+    for row in reversed(rows):
+        if row.user_turn is None or row.user_turn in seen:
+            continue
+        seen.add(row.user_turn)
+        ordered.append(row.user_turn)
+    turns = ordered[-window_user_turn:]
+    if not turns:
+        return []
+    return (
+        _build_scope_query(db, **scope)
+        .filter(Message.user_turn.in_(turns))
+        .order_by(Message.turn_id.asc())
+        .all()
+    )
+
+
+def seed(engine, n_messages: int) -> int:
+    now = datetime.utcnow()
+    user_turns = n_messages // 2
+    body = "今天天气不错，我们去公园散步吧，顺便买杯咖啡。" * 4
+    with engine.begin() as conn:
+        batch = []
+        for t in range(1, user_turns + 1):
+            for k, role in enumerate(("user", "assistant")):
+                batch.append({
+                    "id": f"m{t}-{k}", "session_id": SID, "turn_id": t * 2 - 1 + k, "user_turn": t, "role": role,
+                    "content": body, "content_tokens": 60, "created_at": now, "lang": "zh", "platform": "bench",
+                    "thread_id": TID, "memory_id": MID, "agent_id": AID, "meta_json": "{}",
+                })
+            if len(batch) >= 10000:
+                conn.execute(Message.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(Message.__table__.insert(), batch)
+        conn.execute(text("ANALYZE"))
+    return user_turns
+
+
+def timed(fn, repeat: int):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="")
+    ap.add_argument("--messages", type=int, default=100_000)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_scope.db")
+    engine = make_engine(url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    user_turns = seed(engine, args.messages)
+    Local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    print(f"url={engine.url.render_as_string(hide_password=True)} messages={args.messages} user_turns={user_turns}")
+    for level, scope_type, window in (("s4", "thread", 4), ("s60", "memory", 30)):
+        db = Local()
+        try:
+            old_s, old = timed(lambda: legacy_window(
+                db, to_user_turn=user_turns, window_user_turn=window, scope_type=scope_type), args.repeat)
+            db.expunge_all()
+            new_s, new = timed(lambda: _load_scope_window(
+                db, session_id=SID, to_user_turn=user_turns, window_user_turn=window, scope_type=scope_type,
+                thread_id=TID, memory_id=MID, agent_id=AID), args.repeat)
+        finally:
+            db.close()
+        same = [m.turn_id for m in old] == [m.turn_id for m in new]
+        print(f"{level} window={window} rows={len(new)} legacy_ms={old_s * 1000:.1f} "
+              f"new_ms={new_s * 1000:.2f} speedup={old_s / new_s:.0f}x same_window={same}")
+
+if __name__ == "__main__":
+    main()
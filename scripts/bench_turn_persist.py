@@ -0,0 +1,57 @@
+import sys
+import os
+import time
+import argparse
+import tempfile
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.orm import sessionmaker
+
+from app.db.session import Base, make_engine
+from app.services.chat_service import chat_once
+
+# 写路径吞吐：每轮 chat_once（session upsert + user/assistant 两条消息 + 计数 + 摘要入队）
+#   python scripts/bench_turn_persist.py                                   # 临时 SQLite 文件
+#   python scripts/bench_turn_persist.py --url postgresql+psycopg://u:p@127.0.0.1/bench
+# 默认不触发摘要（只测持久化）；--with-summary 按 4/30 轮触发，走本地兜底摘要（不配 LLM key 时）
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="")
+    ap.add_argument("--turns", type=int, default=500)
+    ap.add_argument("--sessions", type=int, default=10)
+    ap.add_argument("--with-summary", action="store_true")
+    args = ap.parse_args()
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = make_engine(url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    Local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    every = (4, 30) if args.with_summary else (10 ** 9, 10 ** 9)
+    db = Local()
+    try:
+        t0 = time.perf_counter()
+        for i in range(args.turns):
+            chat_once(
+                db,
+                f"bench-{i % args.sessions}",
+                f"第{i}轮：今天天气不错，我们去公园散步吧",
+                "好呀，我也想出去走走，顺便买杯咖啡",
+                s4_every_user_turns=every[0],
+                s60_every_user_turns=every[1],
+                thread_id=f"bench-{i % args.sessions}",
+                memory_id="bench-memory",
+                agent_id="bench-agent",
+            )
+        dt = time.perf_counter() - t0
+    finally:
+        db.close()
+
+    print(f"url={engine.url.render_as_string(hide_password=True)} turns={args.turns} sessions={args.sessions} "
+          f"with_summary={args.with_summary} secs={dt:.2f} turns_per_sec={args.turns / dt:.1f}")
+
+if __name__ == "__main__":
+    main()
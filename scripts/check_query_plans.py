@@ -0,0 +1,164 @@
+import sys
+import os
+import re
+import argparse
+import tempfile
+from datetime import datetime
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from app.db.session import Base, make_engine
+from app.db.models import Message, Session as ChatSession, SummaryS4, SummaryS60, TriggerJob
+from app.services.context_builder import _recent_messages_query
+from app.services.latest_summaries import _latest_rows_query
+from app.services.summarizer import _WINDOW_COLUMNS, _build_scope_query
+from app.services.summary_jobs import SUMMARY_JOB_TYPES
+
+# 热查询的执行计划检查：任何一条退化成全表扫描就以非 0 退出（加索引 / 改查询后跑一遍）
+#   python scripts/check_query_plans.py                      # 临时 SQLite：create_all + 造数据 + ANALYZE
+#   python scripts/check_query_plans.py --url sqlite:///./gateway.db --no-seed   # 检查已迁移的库
+#   python scripts/check_query_plans.py --url postgresql+psycopg://u:p@127.0.0.1/gw
+# Postgres 小表上优化器本来就偏向 Seq Scan，所以检查时 SET enable_seqscan = off，只验证"索引可用"。
+
+SID, TID, MID, AID = "plan-s0", "plan-t0", "plan-m0", "plan-a0"
+
+
+def hot_queries(db):
+    """(名字, Query)。和业务代码里的写法保持一致。"""
+    thread = dict(session_id=SID, scope_type="thread", thread_id=TID, memory_id=None, agent_id=None)
+    memory = dict(session_id=SID, scope_type="memory", thread_id=None, memory_id=MID, agent_id=AID)
+    user_turn_only = (Message.user_turn,)
+    return [
+        # summarizer._resolve_scope_user_turns
+        ("scope_user_turns.thread",
+         _build_scope_query(db, columns=user_turn_only, **thread)
+         .filter(Message.role == "user", Message.user_turn.isnot(None)).order_by(Message.turn_id.desc()).limit(4)),
+        ("scope_user_turns.memory",
+         _build_scope_query(db, columns=user_turn_only, **memory)
+         .filter(Message.role == "user", Message.user_turn.isnot(None)).order_by(Message.turn_id.desc()).limit(30)),
+        # summarizer._load_scope_window 取窗口内消息
+        ("scope_window_messages",
+         _build_scope_query(db, columns=_WINDOW_COLUMNS, **thread)
+         .filter(Message.user_turn.in_([1, 2, 3, 4])).order_by(Message.turn_id.asc())),
+        # chat_service._count_scoped_user_turns（计数行缺失时的 COUNT 回退，跨 session 的 memory scope）
+        ("count_user_turns.memory",
+         db.query(Message.id).filter(Message.role == "user", Message.memory_id == MID, Message.agent_id == AID)),
+        # context_builder / proxy / tasks._build_context：最新摘要 + 最近消息
+        ("latest_s4",
+         db.query(SummaryS4).filter(SummaryS4.session_id == SID).order_by(SummaryS4.to_turn.desc()).limit(1)),
+        ("latest_s60",
+         db.query(SummaryS60).filter(SummaryS60.session_id == SID).order_by(SummaryS60.to_turn.desc()).limit(1)),
+        ("recent_messages",
+         db.query(Message).filter(Message.session_id == SID).order_by(Message.turn_id.desc()).limit(12)),
+        # context_builder.build_context_packs（批量：窗口函数取每个 session 的最近 N 条 / 最新摘要）
+        ("batch_recent_messages", _recent_messages_query(db, [SID, "plan-s1", "plan-s2"], 16)),
+        ("batch_latest_s4", _latest_rows_query(db, SummaryS4, [SID, "plan-s1", "plan-s2"])),
+        ("batch_latest_s60", _latest_rows_query(db, SummaryS60, [SID, "plan-s1", "plan-s2"])),
+        # run_s4 / run_s60 幂等检查
+        ("s60_exists",
+         db.query(SummaryS60).filter(
+             SummaryS60.session_id == SID, SummaryS60.scope_type == "memory", SummaryS60.thread_id == None,
+             SummaryS60.memory_id == MID, SummaryS60.agent_id == AID, SummaryS60.to_turn == 80,
+         ).limit(1)),
+        ("s4_exists",
+         db.query(SummaryS4).filter(
+             SummaryS4.session_id == SID, SummaryS4.scope_type == "thread", SummaryS4.thread_id == TID,
+             SummaryS4.memory_id == None, SummaryS4.agent_id == None, SummaryS4.to_turn == 8,
+         ).limit(1)),
+        # tasks.scan_triggers（sessions.proactive_enabled 是低选择性布尔列，表也小，不建索引、不检查）
+        ("last_user_message",
+         db.query(Message).filter(Message.session_id == SID, Message.role == "user")
+         .order_by(Message.turn_id.desc()).limit(1)),
+        ("recent_silence_job",
+         db.query(TriggerJob).filter(
+             TriggerJob.session_id == SID, TriggerJob.trigger_type == "silence",
+             TriggerJob.status.in_(["queued", "running", "done"]),
+         ).order_by(TriggerJob.created_at.desc()).limit(1)),
+        # tasks.process_trigger_jobs
+        ("queued_trigger_jobs",
+         db.query(TriggerJob).filter(TriggerJob.status == "queued", ~TriggerJob.trigger_type.in_(SUMMARY_JOB_TYPES))
+         .order_by(TriggerJob.scheduled_at.asc()).limit(20)),
+    ]
+
+
+def seed(db, sessions: int, turns: int) -> None:
+    now = datetime.utcnow()
+    for s in range(sessions):
+        sid = f"plan-s{s}"
+        db.add(ChatSession(id=sid, proactive_enabled=(s % 10 == 0), last_turn_id=turns * 2, last_user_turn=turns))
+        rows = []
+        for t in range(1, turns + 1):
+            for k, role in enumerate(("user", "assistant")):
+                rows.append({
+                    "session_id": sid, "turn_id": t * 2 - 1 + k, "user_turn": t, "role": role,
+                    "content": "x", "content_tokens": 1, "created_at": now,
+                    "thread_id": f"plan-t{s % 3}", "memory_id": f"plan-m{s % 5}", "agent_id": "plan-a0",
+                })
+        db.bulk_insert_mappings(Message, rows)
+        for t in range(4, turns + 1, 4):
+            db.add(SummaryS4(session_id=sid, scope_type="thread", thread_id=f"plan-t{s % 3}",
+                             from_turn=t * 2 - 7, to_turn=t * 2, summary_json="{}", created_at=now))
+        db.add(SummaryS60(session_id=sid, scope_type="thread", from_turn=1, to_turn=turns * 2,
+                          summary_json="{}", created_at=now))
+        db.add(TriggerJob(session_id=sid, trigger_type="silence", status="done", created_at=now, scheduled_at=now))
+        db.add(TriggerJob(session_id=sid, trigger_type="summary_s4", status="done", created_at=now, scheduled_at=now))
+    db.commit()
+
+
+def explain(db, query) -> str:
+    sql = str(query.statement.compile(dialect=db.get_bind().dialect, compile_kwargs={"literal_binds": True}))
+    if db.get_bind().dialect.name == "sqlite":
+        rows = db.execute(text("EXPLAIN QUERY PLAN " + sql)).all()
+        return "\n".join(r[-1] for r in rows)
+    rows = db.execute(text("EXPLAIN " + sql)).all()
+    return "\n".join(r[0] for r in rows)
+
+
+# SQLite: "SCAN messages" / "SCAN messages USING INDEX x" 都是整表（整索引）扫描；SEARCH 才是走索引定位
+#         （窗口函数子查询的 "SCAN (subquery-N)" / "SCAN anon_N" 扫的是物化后的中间结果，不算）
+# Postgres: 关掉 seqscan 之后还出现 Seq Scan 说明没有可用索引
+_FULL_SCAN = re.compile(r"^\s*(?:--)?SCAN (?!CONSTANT ROW|\(subquery-\d+\)|anon_\d+)|Seq Scan", re.M)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="热查询执行计划检查（EXPLAIN），出现全表扫描时 exit 1")
+    ap.add_argument("--url", default="")
+    ap.add_argument("--no-seed", action="store_true", help="不建表不造数据，直接检查 --url 指向的库")
+    ap.add_argument("--sessions", type=int, default=50)
+    ap.add_argument("--turns", type=int, default=40)
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "plans.db")
+    engine = make_engine(url)
+    if not args.no_seed:
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        if not args.no_seed:
+            seed(db, args.sessions, args.turns)
+            db.execute(text("ANALYZE"))
+            db.commit()
+        if engine.dialect.name == "postgresql":
+            db.execute(text("SET enable_seqscan = off"))
+
+        failed = 0
+        for name, query in hot_queries(db):
+            plan = explain(db, query)
+            bad = bool(_FULL_SCAN.search(plan))
+            failed += bad
+            print(f"{'FAIL' if bad else 'ok  '} {name}")
+            if bad or args.verbose:
+                for line in plan.splitlines():
+                    print(f"       {line}")
+        print(f"checked={len(hot_queries(db))} failed={failed} url={engine.url.render_as_string(hide_password=True)}")
+    finally:
+        db.close()
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
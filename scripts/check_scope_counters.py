@@ -0,0 +1,28 @@
+import sys
+import os
+import json
+import argparse
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db.session import SessionLocal
+from app.services.scope_counters import check_scope_counters
+
+def main():
+    ap = argparse.ArgumentParser(description="scope_counters vs messages 一致性检查")
+    ap.add_argument("--fix", action="store_true", help="把不一致的计数改成 messages 真值")
+    args = ap.parse_args()
+
+    db = SessionLocal()
+    try:
+        problems = check_scope_counters(db, fix=args.fix)
+        for p in problems:
+            print(json.dumps(p, ensure_ascii=False))
+        print(f"check done mismatched={len(problems)} fixed={args.fix}")
+        # 非 0 退出码方便挂 cron / CI
+        sys.exit(1 if problems and not args.fix else 0)
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import sys
+import os
+import json
+import argparse
+# 把项目根目录加入 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 只读对比：关掉摘要缓存、调试事件只留在进程内（这两个都是 import 时读的，必须在 import app 之前设置）
+os.environ["SUMMARY_CACHE_BACKEND"] = "none"
+os.environ["DEBUG_EVENTS_BACKEND"] = "memory"
+
+from app.db.session import SessionLocal
+from app.db.models import Message, SummaryS4
+from app.services.summarizer import (
+    _WINDOW_COLUMNS,
+    _render_transcript,
+    _safe_json_loads,
+    _summarize_s4_with_debug_events,
+)
+from app.services.tokenizer import count_tokens
+
+# 整窗（summary_version=2）vs 增量（summary_version=3）S4 对比：不写库，只打印
+#   python scripts/compare_s4_versions.py --session-id <sid> [--last 5]
+# 对 session 最近 N 条 S4 的窗口各跑一次两种模式（增量以上一条已存的 S4 为基准），输出 token 数和两边结果（JSON lines）
+# 没配置 SUMMARIZER_BASE_URL / SUMMARIZER_API_KEY 时两边都是占位 schema，只有 token 数有参考意义
+
+def main():
+    ap = argparse.ArgumentParser(description="S4 整窗 vs 增量 对比（不写库）")
+    ap.add_argument("--session-id", required=True)
+    ap.add_argument("--last", type=int, default=5)
+    args = ap.parse_args()
+
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(SummaryS4)
+            .filter(SummaryS4.session_id == args.session_id)
+            .order_by(SummaryS4.to_turn.desc())
+            .limit(args.last + 1)
+            .all()[::-1]
+        )
+        if len(rows) < 2:
+            print("need at least 2 S4 rows for this session")
+            return
+
+        totals = {"full": 0, "incremental": 0}
+        for base, row in zip(rows, rows[1:]):
+            q = db.query(*_WINDOW_COLUMNS).filter(
+                Message.session_id == row.session_id,
+                Message.turn_id >= row.from_turn,
+                Message.turn_id <= row.to_turn,
+            )
+            if row.scope_type == "thread" and row.thread_id is not None:
+                q = q.filter(Message.thread_id == row.thread_id)
+            msgs = q.order_by(Message.turn_id.asc()).all()
+            new_msgs = [m for m in msgs if m.turn_id > base.to_turn]
+            if not msgs or not new_msgs:
+                continue
+
+            full_input = _render_transcript(msgs)
+            inc_input = _render_transcript(new_msgs)
+            base_obj = _safe_json_loads(base.summary_json)
+            full = _summarize_s4_with_debug_events(full_input, session_id=row.session_id, to_turn=row.to_turn)
+            inc = _summarize_s4_with_debug_events(
+                inc_input,
+                session_id=row.session_id,
+                to_turn=row.to_turn,
+                previous=base_obj,
+                previous_to_turn=base.to_turn,
+            )
+            full_tokens = count_tokens(full_input)
+            # 增量输入还要带上一版总结
+            inc_tokens = count_tokens(inc_input) + count_tokens(json.dumps(base_obj, ensure_ascii=False))
+            totals["full"] += full_tokens
+            totals["incremental"] += inc_tokens
+            print(json.dumps({
+                "range": [row.from_turn, row.to_turn],
+                "base_to_turn": base.to_turn,
+                "stored_version": row.summary_version,
+                "input_tokens": {"full": full_tokens, "incremental": inc_tokens},
+                "full": full,
+                "incremental": inc,
+                "same_fields": sorted(k for k in full if full.get(k) == inc.get(k)),
+            }, ensure_ascii=False))
+        print(json.dumps({"total_input_tokens": totals}, ensure_ascii=False))
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()